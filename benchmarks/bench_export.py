@@ -0,0 +1,116 @@
+# benchmarks/bench_export.py
+
+"""
+发送协议对比：批量摄取接口 (JSON) 与 OTLP/HTTP (protobuf，可 gzip) 每条记录的请求体字节数、
+编码 CPU 和发送到本地桩服务时的整体 CPU。
+
+用法:
+    python -m benchmarks.bench_export --records 5000 --batch-size 100 --body-kb 1 8
+"""
+
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sls_processor import ingestion, otlp
+from sls_processor.processor import LangfuseDataProcessor
+
+from .gateway_logs import make_gateway_logs
+from .stub_langfuse import StubLangfuseServer
+
+PROTOCOLS = (('ingestion', None), ('otlp', 'none'), ('otlp', 'gzip'))
+
+
+def _prose(rng: random.Random, vocabulary: list, chars: int) -> str:
+    """从随机词表取词拼成正文：gateway_logs 的正文是重复短句，gzip 压缩率远高于真实对话。"""
+    words, length = [], 0
+    while length < chars:
+        word = rng.choice(vocabulary)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:chars]
+
+
+def make_payloads(count: int, body_kb: float, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+                  for _ in range(3000)]
+    vocabulary += [''.join(chr(0x4e00 + rng.randrange(3000)) for _ in range(rng.randint(1, 4)))
+                   for _ in range(3000)]
+    now = time.time()
+    logs = []
+    while len(logs) < count:
+        shape = rng.choices(('chat', 'stream', 'tool_call', 'fallback', 'error'), (60, 20, 8, 7, 5))[0]
+        logs.extend(make_gateway_logs(len(logs), rng, shape, body_kb, start=now - rng.uniform(0, 60)))
+    for log in logs:
+        log['question'] = _prose(rng, vocabulary, int(body_kb * 1024))
+        if log.get('answer') and not log['answer'].startswith('{'):
+            log['answer'] = _prose(rng, vocabulary, int(body_kb * 256))
+    return [LangfuseDataProcessor.convert_to_langfuse_format(log) for log in logs[:count]]
+
+
+def make_client(url: str, protocol: str, compression: str, concurrency: int):
+    if protocol == 'ingestion':
+        return ingestion.LangfuseIngestionClient(host=url, public_key="pk", secret_key="sk",
+                                                 max_connections=concurrency)
+    return otlp.OtlpExporter(endpoint=f"{url}{otlp.LANGFUSE_OTLP_PATH}", max_connections=concurrency,
+                             compression=compression)
+
+
+def encode_cost(batches: list, protocol: str, compression: str) -> float:
+    """只编码不发送，返回每条记录的 CPU 微秒数。"""
+    started = time.process_time()
+    for batch in batches:
+        if protocol == 'ingestion':
+            ingestion.encode_batch(batch)
+        else:
+            otlp.encode_body(batch, compression)
+    return (time.process_time() - started) * 1e6 / sum(len(batch) for batch in batches)
+
+
+def send_all(stub: StubLangfuseServer, batches: list, protocol: str, compression: str, concurrency: int) -> dict:
+    client = make_client(stub.url, protocol, compression, concurrency)
+    bytes_before, cpu_before = stub.bytes_received, stub.cpu_seconds
+    records = sum(len(batch) for batch in batches)
+    started, cpu_started = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(concurrency) as executor:
+        sent = sum(sum(results) for results in executor.map(client.send_batch, batches))
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started - (stub.cpu_seconds - cpu_before)
+    client.close()
+    return {
+        'sent': sent,
+        'records_per_second': records / elapsed,
+        'wire_bytes_per_record': (stub.bytes_received - bytes_before) / records,
+        'cpu_us_per_record': cpu * 1e6 / records,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--body-kb", type=float, nargs="+", default=[1, 8])
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="桩服务单次请求延迟")
+    args = parser.parse_args()
+
+    print(f"{'body KB':>8} {'protocol':>15} {'bytes/rec':>10} {'encode us/rec':>14} {'cpu us/rec':>11} {'records/s':>10}")
+    with StubLangfuseServer(latency_ms=args.latency_ms) as stub:
+        for body_kb in args.body_kb:
+            payloads = make_payloads(args.records, body_kb)
+            batches = [payloads[i:i + args.batch_size] for i in range(0, len(payloads), args.batch_size)]
+            for protocol, compression in PROTOCOLS:
+                name = protocol if compression is None else f"{protocol}/{compression}"
+                encode = encode_cost(batches, protocol, compression)
+                result = send_all(stub, batches, protocol, compression, args.concurrency)
+                assert result['sent'] == len(payloads), f"{name}: 只有 {result['sent']}/{len(payloads)} 条发送成功"
+                print(f"{body_kb:>8g} {name:>15} {result['wire_bytes_per_record']:>10.0f} {encode:>14.1f} "
+                      f"{result['cpu_us_per_record']:>11.1f} {result['records_per_second']:>10.0f}")
+
+
+if __name__ == "__main__":
+    threading.current_thread().name = "bench"
+    main()
@@ -0,0 +1,93 @@
+# benchmarks/bench_fetch.py
+
+"""
+拉取线程微基准：每条日志构建 dict vs 只读取 trace_id 并放入 LogRecordView，
+以及把转换阶段算进来之后的端到端开销；同时校验两条路径的转换结果一致。
+
+用法:
+    python -m benchmarks.bench_fetch --records 20000 --repeat 5
+"""
+
+import argparse
+import time
+
+from aliyun.log.proto import LogGroupList
+
+from sls_processor.processor import LangfuseDataProcessor
+from sls_processor.records import LogRecordView, find_content
+
+from .bench_sender import make_log
+
+convert = LangfuseDataProcessor.convert_to_langfuse_format
+
+
+def build_log_groups(count: int, group_size: int = 100) -> LogGroupList:
+    """构造与 SLS 拉取结果同结构的 protobuf LogGroupList。"""
+    log_groups = LogGroupList()
+    for start in range(0, count, group_size):
+        log_group = log_groups.LogGroups.add()
+        for index in range(start, min(count, start + group_size)):
+            log = log_group.Logs.add()
+            log.Time = int(time.time())
+            for key, value in make_log(index).items():
+                content = log.Contents.add()
+                content.Key = key
+                content.Value = str(value)
+    return LogGroupList.FromString(log_groups.SerializeToString())
+
+
+def fetch_dict(log_groups) -> list:
+    queued = []
+    for log_group in log_groups.LogGroups:
+        for log in log_group.Logs:
+            log_contents = {content.Key: content.Value for content in log.Contents}
+            trace_id = log_contents.get('trace_id', '')
+            if trace_id and trace_id != '-' and len(trace_id) > 10:
+                queued.append(log_contents)
+    return queued
+
+
+def fetch_view(log_groups) -> list:
+    queued, hint = [], -1
+    for log_group in log_groups.LogGroups:
+        for log in log_group.Logs:
+            contents = log.Contents
+            trace_id, hint = find_content(contents, 'trace_id', hint)
+            if trace_id and trace_id != '-' and len(trace_id) > 10:
+                queued.append(LogRecordView(contents))
+    return queued
+
+
+def best_time(run, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    log_groups = build_log_groups(args.records)
+    for expected, view in zip(fetch_dict(log_groups), fetch_view(log_groups)):
+        assert convert(expected) == convert(view), expected['trace_id']
+
+    n = args.records
+    fetch = {name: best_time(lambda f=f: f(log_groups), args.repeat)
+             for name, f in (('dict', fetch_dict), ('view', fetch_view))}
+    total = {name: best_time(lambda f=f: [convert(r) for r in f(log_groups)], args.repeat)
+             for name, f in (('dict', fetch_dict), ('view', fetch_view))}
+
+    print(f"{'path':>6} {'fetch us/rec':>13} {'fetch+convert us/rec':>21}")
+    for name in ('dict', 'view'):
+        print(f"{name:>6} {fetch[name] * 1e6 / n:>13.2f} {total[name] * 1e6 / n:>21.2f}")
+    print(f"fetch thread speedup: {fetch['dict'] / fetch['view']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# benchmarks/bench_json.py
+
+"""
+JSON编解码基准：标准库 vs orjson，覆盖 ai_log 解析、批量请求体编码和死信行编码，
+question/answer 使用多KB的真实感长文本。
+
+用法:
+    python -m benchmarks.bench_json --records 2000 --body-kb 4 16
+"""
+
+import argparse
+import random
+import time
+
+from sls_processor.ingestion import build_ingestion_events
+from sls_processor.jsoncodec import OrjsonCodec, StdlibCodec
+from sls_processor.processor import LangfuseDataProcessor
+
+from .bench_sender import make_log
+
+SAMPLE_TEXT = ("请根据以下上下文回答问题，并给出引用来源。The quick brown fox jumps over the lazy dog. "
+               "上下文：大语言模型网关日志包含请求、响应、token 用量和耗时等信息。\n")
+
+
+def long_text(kb: int) -> str:
+    repeat = kb * 1024 // len(SAMPLE_TEXT.encode('utf-8')) + 1
+    return SAMPLE_TEXT * repeat
+
+
+def timed(fn, repeat: int = 3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_codec(codec, records: list, batch_size: int) -> dict:
+    ai_logs = [record['ai_log'] for record in records]
+    payloads = [LangfuseDataProcessor.convert_to_langfuse_format(record) for record in records]
+    batches = [
+        {"batch": [event for payload in payloads[i:i + batch_size] for event in build_ingestion_events(payload)]}
+        for i in range(0, len(payloads), batch_size)
+    ]
+    encoded = [codec.dumpb(batch) for batch in batches]
+
+    n = len(records)
+    return {
+        "parse ai_log": timed(lambda: [codec.loads(s) for s in ai_logs]) / n * 1e6,
+        "encode batch": timed(lambda: [codec.dumpb(b) for b in batches]) / n * 1e6,
+        "decode batch": timed(lambda: [codec.loads(b) for b in encoded]) / n * 1e6,
+        "dlq line": timed(lambda: [codec.dumpb(r) for r in records]) / n * 1e6,
+        "bytes/record": sum(len(b) for b in encoded) / n,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--body-kb", type=int, nargs="+", default=[4, 16])
+    args = parser.parse_args()
+
+    codecs = [StdlibCodec()]
+    try:
+        codecs.append(OrjsonCodec())
+    except ImportError:
+        print("orjson 未安装，仅测试标准库")
+
+    for kb in args.body_kb:
+        random.seed(kb)
+        records = [make_log(i) for i in range(args.records)]
+        for record in records:
+            record['question'] = long_text(kb)
+            record['answer'] = long_text(max(1, kb // 2))
+        print(f"\nquestion ≈ {kb}KB, answer ≈ {max(1, kb // 2)}KB (us/record)")
+        results = {codec.name: bench_codec(codec, records, args.batch_size) for codec in codecs}
+        print(f"{'':>14}" + "".join(f"{name:>12}" for name in results))
+        for metric in next(iter(results.values())):
+            print(f"{metric:>14}" + "".join(f"{r[metric]:>12.1f}" for r in results.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# benchmarks/bench_mapping.py
+
+"""
+转换器微基准：编译后的字段映射 vs 重构前的手写转换器，并校验两者输出一致。
+
+用法:
+    python -m benchmarks.bench_mapping --records 20000 --repeat 5
+"""
+
+import argparse
+import time
+
+from sls_processor.processor import LangfuseDataProcessor
+
+from .bench_sender import make_log
+from .legacy_converter import LegacyLangfuseDataProcessor
+
+
+def best_rate(convert, records: list, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for record in records:
+            convert(record)
+        best = min(best, time.perf_counter() - started)
+    return len(records) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    records = [make_log(i) for i in range(args.records)]
+    for record in records:
+        assert LangfuseDataProcessor.convert_to_langfuse_format(record) == \
+            LegacyLangfuseDataProcessor.convert_to_langfuse_format(record), record['trace_id']
+
+    legacy = best_rate(LegacyLangfuseDataProcessor.convert_to_langfuse_format, records, args.repeat)
+    compiled = best_rate(LangfuseDataProcessor.convert_to_langfuse_format, records, args.repeat)
+    print(f"{'converter':>10} {'records/s':>12} {'us/record':>10}")
+    print(f"{'legacy':>10} {legacy:>12.0f} {1e6 / legacy:>10.2f}")
+    print(f"{'compiled':>10} {compiled:>12.0f} {1e6 / compiled:>10.2f}")
+    print(f"speedup: {compiled / legacy:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
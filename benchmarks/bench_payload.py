@@ -0,0 +1,54 @@
+# benchmarks/bench_payload.py
+
+"""
+载荷整形对比：不同截断上限 / 去重模式下每条记录的请求体字节数和组装耗时。
+
+用法:
+    python -m benchmarks.bench_payload --records 500 --body-kb 4 64 --max-chars 0 8000
+"""
+
+import argparse
+import copy
+import time
+
+from sls_processor import ingestion, payload
+from sls_processor.processor import LangfuseDataProcessor
+
+from .bench_sender import make_log
+
+
+def measure(payloads: list, shaper: payload.PayloadShaper) -> tuple:
+    payload._shaper = shaper
+    batch = copy.deepcopy(payloads)
+    started = time.perf_counter()
+    body, _, _ = ingestion.encode_batch(batch)
+    elapsed = time.perf_counter() - started
+    return len(body) / len(payloads), elapsed * 1e6 / len(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=500)
+    parser.add_argument("--body-kb", type=int, nargs="+", default=[4, 64])
+    parser.add_argument("--max-chars", type=int, nargs="+", default=[0, 8000])
+    args = parser.parse_args()
+
+    print(f"{'body KB':>8} {'max chars':>10} {'dedup':>11} {'bytes/rec':>11} {'us/rec':>8}")
+    for body_kb in args.body_kb:
+        records = []
+        for i in range(args.records):
+            record = make_log(i)
+            record['question'] = "请总结以下内容：" + "x" * (body_kb * 1024)
+            record['answer'] = "总结：" + "y" * (body_kb * 256)
+            records.append(record)
+        payloads = [LangfuseDataProcessor.convert_to_langfuse_format(record) for record in records]
+        for max_chars in args.max_chars:
+            for dedup in payload.DEDUP_MODES:
+                shaper = payload.PayloadShaper(max_input_chars=max_chars, max_output_chars=max_chars,
+                                               dedup=dedup)
+                size, cost = measure(payloads, shaper)
+                print(f"{body_kb:>8} {max_chars:>10} {dedup:>11} {size:>11.0f} {cost:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
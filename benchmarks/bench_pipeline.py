@@ -0,0 +1,276 @@
+# benchmarks/bench_pipeline.py
+
+"""
+端到端流水线压测：合成网关 LogGroup → LogQueueProducer.process（假检查点 tracker）→ SpillQueue
+→ 发送端（thread: SenderPool / asyncio: AsyncSenderPipeline）→ 进程内的 Langfuse 桩服务。
+
+报告 记录/秒、入队到确认的 p50/p99 延迟、每条记录的 CPU 时间（扣除桩服务自身的 CPU）和峰值 RSS。
+默认尽快投喂（闭环，延迟主要是排队时间，反映吞吐上限）；--feed-rate 按固定速率投喂（开环），
+延迟反映未饱和时的处理耗时。每种模式在独立的子进程中运行，峰值 RSS 互不影响。
+完全离线，不需要 SLS 或 Langfuse 凭证。
+
+--check 使用 benchmarks/thresholds.json 中的场景参数运行，任一指标超出回归阈值时以退出码 1 结束。
+
+用法:
+    python -m benchmarks.bench_pipeline --records 20000 --mode thread asyncio --latency-ms 20 --error-rate 0.01
+    python -m benchmarks.bench_pipeline --check
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+from sls_processor.checkpoint import CheckpointCommitter
+from sls_processor.consumer import LogQueueProducer
+from sls_processor.ingestion import AsyncLangfuseIngestionClient, LangfuseIngestionClient
+from sls_processor.processor import LangfuseDataProcessor
+from sls_processor.spill_queue import SpillQueue
+
+from .gateway_logs import build_gateway_log_groups
+from .stub_langfuse import StubLangfuseServer
+
+THRESHOLDS_FILE = os.path.join(os.path.dirname(__file__), 'thresholds.json')
+MODES = ('thread', 'asyncio')
+convert = LangfuseDataProcessor.convert_to_langfuse_format
+
+
+class FakeCheckpointTracker:
+    """模拟 SDK 的 ConsumerCheckpointTracker：每次拉取前推进游标，提交只做记录。"""
+
+    def __init__(self):
+        self.cursor = 0
+        self.saved = None
+
+    def advance(self):
+        self.cursor += 1
+
+    def get_cursor(self) -> str:
+        return str(self.cursor)
+
+    def save_check_point(self, persistent: bool, cursor: str = None):
+        self.saved = cursor
+
+
+class _TimedAck:
+    """记录从入队到确认的延迟，再转交原来的批次确认句柄。"""
+    __slots__ = ('ack', 'started', 'latencies')
+
+    def __init__(self, ack, latencies: list):
+        self.ack = ack
+        self.started = time.perf_counter()
+        self.latencies = latencies
+
+    def done(self):
+        self.latencies.append(time.perf_counter() - self.started)
+        self.ack.done()
+
+
+class TimedQueue(SpillQueue):
+    def __init__(self, latencies: list, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = latencies
+
+    def put(self, item: tuple, block: bool = True, timeout: float = None):
+        super().put((item[0], _TimedAck(item[1], self.latencies)), block, timeout)
+
+
+def _rss_mb() -> float:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+
+def _wait_acked(latencies: list, expected: int, timeout: float = 300):
+    deadline = time.monotonic() + timeout
+    while len(latencies) < expected:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"超时：{len(latencies)}/{expected} 条记录已确认")
+        time.sleep(0.005)
+
+
+def _start_thread_sender(url: str, queue, scenario: dict):
+    from sls_processor.sender_pool import SenderPool
+
+    client = LangfuseIngestionClient(host=url, public_key="pk", secret_key="sk",
+                                     max_connections=scenario['concurrency'])
+    pool = SenderPool(queue, client, convert, dead_letter=lambda records: True,
+                      concurrency=scenario['concurrency'], batch_size=scenario['batch_size'],
+                      batch_max_wait=0.05, max_retries=3, retry_delay=0.05, max_retry_delay=0.2)
+    pool.start()
+
+    def stop():
+        pool.stop()
+        client.close()
+    return stop
+
+
+def _start_async_sender(url: str, queue, scenario: dict):
+    from sls_processor.async_pipeline import AsyncSenderPipeline
+
+    ready = threading.Event()
+    state = {}
+
+    async def serve():
+        client = AsyncLangfuseIngestionClient(host=url, public_key="pk", secret_key="sk",
+                                              max_connections=scenario['concurrency'])
+        pipeline = AsyncSenderPipeline(queue, client, convert, dead_letter=lambda records: True,
+                                       batch_size=scenario['batch_size'], batch_max_wait=0.05,
+                                       max_in_flight=scenario['concurrency'], max_retries=3,
+                                       retry_delay=0.05, max_retry_delay=0.2)
+        state['loop'], state['pipeline'] = asyncio.get_running_loop(), pipeline
+        ready.set()
+        await pipeline.run()
+        await client.close()
+
+    thread = threading.Thread(target=asyncio.run, args=(serve(),), name="AsyncPipeline", daemon=True)
+    thread.start()
+    ready.wait()
+
+    def stop():
+        state['loop'].call_soon_threadsafe(state['pipeline'].close)
+        thread.join(timeout=30)
+    return stop
+
+
+def run_scenario(mode: str, scenario: dict) -> dict:
+    """在当前进程中运行一次压测并返回指标。"""
+    pulls, valid = build_gateway_log_groups(scenario['records'], scenario['group_size'], seed=scenario['seed'],
+                                            body_kb=scenario.get('body_kb'))
+    baseline_rss = _rss_mb()
+    latencies: list = []
+    queue = TimedQueue(latencies)
+    producer = LogQueueProducer(queue, CheckpointCommitter())
+    producer.initialize(0)
+    tracker = FakeCheckpointTracker()
+
+    with StubLangfuseServer(latency_ms=scenario['latency_ms'], error_rate=scenario['error_rate']) as stub:
+        start_sender = _start_thread_sender if mode == 'thread' else _start_async_sender
+        stop_sender = start_sender(stub.url, queue, scenario)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_started = usage.ru_utime + usage.ru_stime
+        started = time.perf_counter()
+        fed = 0
+        for log_groups in pulls:  # 相当于 SDK 拉取线程，队列满时在 process 中阻塞
+            tracker.advance()
+            producer.process(log_groups, tracker)
+            fed += sum(len(log_group.Logs) for log_group in log_groups.LogGroups)
+            if scenario['feed_rate'] > 0:
+                delay = started + fed / scenario['feed_rate'] - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        _wait_acked(latencies, valid)
+        elapsed = time.perf_counter() - started
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = usage.ru_utime + usage.ru_stime - cpu_started - stub.cpu_seconds
+        stop_sender()
+    queue.close()
+
+    return {
+        'mode': mode,
+        'records': valid,
+        'records_per_second': valid / elapsed,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'cpu_us_per_record': cpu * 1e6 / valid,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'baseline_rss_mb': baseline_rss,  # 生成的输入数据和已加载模块占用的内存
+    }
+
+
+def _child(mode: str, scenario: dict, conn):
+    try:
+        conn.send(run_scenario(mode, scenario))
+    except Exception as e:
+        conn.send({'mode': mode, 'error': repr(e)})
+    finally:
+        conn.close()
+
+
+def run_isolated(mode: str, scenario: dict) -> dict:
+    """在新的子进程中运行，避免前一次运行的内存高水位影响峰值 RSS。"""
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(mode, scenario, child), name=f"bench-{mode}")
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def check(result: dict, limits: dict) -> list:
+    failures = []
+    if result['records_per_second'] < limits.get('min_records_per_second', 0):
+        failures.append(f"records/s {result['records_per_second']:.0f} < {limits['min_records_per_second']}")
+    for key in ('p99_ms', 'cpu_us_per_record', 'peak_rss_mb'):
+        limit = limits.get(f'max_{key}')
+        if limit is not None and result[key] > limit:
+            failures.append(f"{key} {result[key]:.1f} > {limit}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--mode", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--group-size", type=int, default=200, help="每次拉取（每个 LogGroup）的日志条数")
+    parser.add_argument("--body-kb", type=float, default=None, help="固定正文大小，默认按对数正态分布随机")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="桩服务单次请求延迟")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="桩服务事件级错误率")
+    parser.add_argument("--concurrency", type=int, default=8, help="发送并发 / asyncio 在途批次上限")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--feed-rate", type=float, default=0, help="按固定速率投喂（条/秒），0 表示尽快投喂")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--check", action="store_true", help="按 thresholds.json 的场景运行并检查回归阈值")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    scenario = {'records': args.records, 'group_size': args.group_size, 'body_kb': args.body_kb,
+                'latency_ms': args.latency_ms, 'error_rate': args.error_rate, 'concurrency': args.concurrency,
+                'batch_size': args.batch_size, 'feed_rate': args.feed_rate, 'seed': args.seed}
+    thresholds = {}
+    if args.check:
+        with open(THRESHOLDS_FILE, encoding='utf-8') as f:
+            spec = json.load(f)
+        scenario.update(spec['scenario'])
+        thresholds = spec['thresholds']
+
+    results = [run_isolated(mode, scenario) for mode in args.mode]
+    if args.json:
+        print(json.dumps({'scenario': scenario, 'results': results}, indent=2))
+    else:
+        print(f"scenario: {scenario}")
+        print(f"{'mode':>8} {'records/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'cpu us/rec':>11} {'peak RSS MB':>12} {'input MB':>9}")
+        for result in results:
+            if 'error' in result:
+                print(f"{result['mode']:>8} failed: {result['error']}")
+                continue
+            print(f"{result['mode']:>8} {result['records_per_second']:>10.0f} {result['p50_ms']:>8.1f} "
+                  f"{result['p99_ms']:>8.1f} {result['cpu_us_per_record']:>11.1f} {result['peak_rss_mb']:>12.1f} {result['baseline_rss_mb']:>9.1f}")
+
+    failed = False
+    for result in results:
+        if 'error' in result:
+            failed = True
+        elif args.check:
+            failures = check(result, thresholds.get(result['mode'], {}))
+            for failure in failures:
+                print(f"REGRESSION [{result['mode']}]: {failure}")
+            failed = failed or bool(failures)
+    if args.check and not failed:
+        print("all thresholds passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# benchmarks/bench_sender.py
+
+"""
+发送链路吞吐压测：对比不同并发和批大小下 SenderPool 的记录/秒。
+
+用法:
+    python -m benchmarks.bench_sender --records 20000 --concurrency 1 4 8 --batch-size 50 100
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from queue import Queue
+
+from sls_processor.ingestion import LangfuseIngestionClient
+from sls_processor.processor import LangfuseDataProcessor
+from sls_processor.sender_pool import SenderPool
+
+from .stub_langfuse import StubLangfuseServer
+
+
+def make_log(index: int) -> dict:
+    """生成一条结构接近AI网关访问日志的记录。"""
+    model = random.choice(["qwen-max", "qwen-plus", "deepseek-v3"])
+    ai_log = {
+        "api": f"chat-api@{random.randint(1, 3)}",
+        "model": model,
+        "consumer": f"tenant-{index % 7}",
+        "input_token": random.randint(50, 4000),
+        "output_token": random.randint(10, 1000),
+        "total_token": 0,
+        "llm_service_duration": random.randint(200, 9000),
+        "response_type": "normal",
+        "chat_id": str(uuid.uuid4()),
+        "chat_round": 1,
+    }
+    return {
+        "trace_id": uuid.uuid4().hex,
+        "request_id": str(uuid.uuid4()),
+        "question": "请总结以下内容：" + "x" * random.randint(100, 2000),
+        "answer": "总结：" + "y" * random.randint(50, 1000),
+        "ai_log": json.dumps(ai_log),
+        "response_code": "200",
+        "duration": str(random.randint(200, 10000)),
+        "method": "POST",
+        "path": "/v1/chat/completions",
+        "original_path": "/v1/chat/completions",
+        "response_code_details": "via_upstream",
+        "user_agent": "OpenAI/Python 1.54.0",
+        "protocol": "HTTP/1.1",
+        "authority": "gateway.example.com",
+        "upstream_service_time": str(random.randint(150, 9000)),
+        "response_tx_duration": str(random.randint(1, 50)),
+        "bytes_sent": str(random.randint(200, 20000)),
+        "bytes_received": str(random.randint(200, 20000)),
+        "downstream_remote_address": f"10.0.{index % 255}.{index % 97}:443",
+        "upstream_local_address": "10.1.0.8:52314",
+        "upstream_host": "10.2.0.15:8080",
+        "_container_ip_": "10.3.0.21",
+        "cluster_id": "c-gateway-prod",
+        "_namespace_": "prod",
+        "route_name": "llm-route",
+        "_time_": "2025-01-01T00:00:00.123Z",
+        "start_time": "2025-01-01T00:00:00.000Z",
+    }
+
+
+def run_once(url: str, records: list, concurrency: int, batch_size: int) -> float:
+    log_queue = Queue()
+    for record in records:
+        log_queue.put((record, None))
+
+    client = LangfuseIngestionClient(host=url, public_key="pk", secret_key="sk",
+                                     max_connections=concurrency)
+    dead = []
+    pool = SenderPool(log_queue, client, LangfuseDataProcessor.convert_to_langfuse_format,
+                      dead_letter=lambda records: dead.extend(records) or True, concurrency=concurrency, batch_size=batch_size,
+                      batch_max_wait=0.05, max_retries=3, retry_delay=0.1)
+    started = time.perf_counter()
+    pool.start()
+    while pool.stats['processed'] < len(records):
+        time.sleep(0.01)
+    pool.stop()
+    elapsed = time.perf_counter() - started
+    client.close()
+    return len(records) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="桩服务单次请求延迟")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="桩服务事件级错误率")
+    args = parser.parse_args()
+
+    records = [make_log(i) for i in range(args.records)]
+    with StubLangfuseServer(latency_ms=args.latency_ms, error_rate=args.error_rate) as stub:
+        print(f"{'concurrency':>12} {'batch_size':>11} {'records/s':>12}")
+        for concurrency in args.concurrency:
+            for batch_size in args.batch_size:
+                rate = run_once(stub.url, records, concurrency, batch_size)
+                print(f"{concurrency:>12} {batch_size:>11} {rate:>12.0f}")
+
+
+if __name__ == "__main__":
+    threading.current_thread().name = "bench"
+    main()
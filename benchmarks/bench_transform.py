@@ -0,0 +1,55 @@
+# benchmarks/bench_transform.py
+
+"""
+转换阶段吞吐压测：对比单线程 convert_to_langfuse_format 与 N 进程 TransformPool。
+
+用法:
+    python -m benchmarks.bench_transform --records 50000 --workers 2 4 8 --batch-size 400
+"""
+
+import argparse
+import os
+import time
+
+from sls_processor.processor import LangfuseDataProcessor
+from sls_processor.transform_pool import TransformPool
+
+from .bench_sender import make_log
+
+
+def bench_single(records: list) -> float:
+    started = time.perf_counter()
+    for record in records:
+        LangfuseDataProcessor.convert_to_langfuse_format(record)
+    return len(records) / (time.perf_counter() - started)
+
+
+def bench_pool(records: list, workers: int, batch_size: int, chunk_size: int) -> float:
+    pool = TransformPool(workers, chunk_size)
+    pool.transform(records[:batch_size])  # 预热：拉起子进程
+    started = time.perf_counter()
+    for i in range(0, len(records), batch_size):
+        pool.transform(records[i:i + batch_size])
+    rate = len(records) / (time.perf_counter() - started)
+    pool.shutdown()
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, os.cpu_count() or 1])
+    parser.add_argument("--batch-size", type=int, default=400, help="每次提交给转换池的记录数")
+    parser.add_argument("--chunk-size", type=int, default=50, help="每个子进程任务的记录数")
+    args = parser.parse_args()
+
+    records = [make_log(i) for i in range(args.records)]
+    print(f"{'mode':>12} {'records/s':>12}")
+    print(f"{'single':>12} {bench_single(records):>12.0f}")
+    for workers in sorted(set(args.workers)):
+        rate = bench_pool(records, workers, args.batch_size, args.chunk_size)
+        print(f"{f'{workers} procs':>12} {rate:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# benchmarks/gateway_logs.py
+
+"""
+合成 AI 网关访问日志：按真实流量的大致比例混合多种 ai_log 形态，token 数和正文长度按对数正态分布，
+输出与 SLS 拉取结果同结构的 protobuf LogGroupList。使用固定随机种子，结果可复现。
+
+形态:
+    chat       普通对话
+    stream     流式响应 (response_type=stream)，多轮对话
+    tool_call  工具调用，answer 为 JSON
+    fallback   主模型失败后切换备用模型：同一 trace_id 的 2~3 条记录
+    error      上游 5xx，answer 为空，ai_log 字段不全
+    no_ai_log  没有 ai_log 字段
+    no_trace   trace_id 为 "-"，会被消费端过滤
+"""
+
+import json
+import random
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+from aliyun.log.proto import LogGroupList
+
+SHAPES = ('chat', 'stream', 'tool_call', 'fallback', 'error', 'no_ai_log', 'no_trace')
+SHAPE_WEIGHTS = (50, 20, 8, 8, 6, 4, 4)
+MODELS = ('qwen-max', 'qwen-plus', 'qwen-turbo', 'deepseek-v3', 'deepseek-r1')
+MAX_BODY_CHARS = 64 * 1024
+
+
+def _body_chars(rng: random.Random, body_kb: Optional[float]) -> int:
+    """正文长度：指定 body_kb 时固定，否则中位数约 1K 字符、长尾到 64K 的对数正态分布。"""
+    if body_kb is not None:
+        return int(body_kb * 1024)
+    return min(MAX_BODY_CHARS, int(rng.lognormvariate(7.0, 1.2)))
+
+
+def _text(rng: random.Random, prefix: str, chars: int) -> str:
+    # 中英文混合，UTF-8 长度与真实对话接近
+    unit = "请根据上下文回答问题。The quick brown fox jumps over the lazy dog. "
+    body = unit * (chars // len(unit) + 1)
+    offset = rng.randrange(len(unit))
+    return prefix + body[offset:offset + chars]
+
+
+def _base_log(rng: random.Random, index: int, trace_id: str, start: float) -> dict:
+    duration = int(rng.lognormvariate(7.5, 0.8))
+    return {
+        "trace_id": trace_id,
+        "request_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "response_code": "200",
+        "duration": str(duration),
+        "method": "POST",
+        "path": "/v1/chat/completions",
+        "original_path": "/v1/chat/completions",
+        "response_code_details": "via_upstream",
+        "user_agent": rng.choice(("OpenAI/Python 1.54.0", "langchain/0.3", "curl/8.5.0")),
+        "protocol": "HTTP/1.1",
+        "authority": "gateway.example.com",
+        "upstream_service_time": str(max(1, duration - rng.randint(1, 100))),
+        "response_tx_duration": str(rng.randint(1, 50)),
+        "bytes_sent": str(rng.randint(200, 20000)),
+        "bytes_received": str(rng.randint(200, 20000)),
+        "downstream_remote_address": f"10.0.{index % 255}.{index % 97}:443",
+        "upstream_local_address": "10.1.0.8:52314",
+        "upstream_host": f"10.2.0.{rng.randint(1, 30)}:8080",
+        "_container_ip_": "10.3.0.21",
+        "cluster_id": "c-gateway-prod",
+        "_namespace_": "prod",
+        "route_name": "llm-route",
+        "_time_": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(start + duration / 1000)) + ".123Z",
+        "start_time": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(start)) + f".{index % 1000:03d}Z",
+    }
+
+
+def _ai_log(rng: random.Random, index: int, model: str, question: str, answer: str, **extra) -> str:
+    input_token = max(1, int(len(question) / 3 * rng.uniform(0.8, 1.2)))
+    output_token = max(1, int(len(answer) / 3 * rng.uniform(0.8, 1.2)))
+    ai_log = {
+        "api": f"chat-api@{rng.randint(1, 3)}",
+        "model": model,
+        "consumer": f"tenant-{index % 7}",
+        "input_token": input_token,
+        "output_token": output_token,
+        "total_token": input_token + output_token,
+        "llm_service_duration": rng.randint(200, 9000),
+        "response_type": "normal",
+        "chat_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "chat_round": 1,
+    }
+    ai_log.update(extra)
+    return json.dumps(ai_log, ensure_ascii=False)
+
+
+def make_gateway_logs(index: int, rng: random.Random, shape: str, body_kb: Optional[float] = None,
+                      start: Optional[float] = None) -> List[dict]:
+    """生成一次请求对应的日志（fallback 形态返回多条同 trace_id 的记录）。"""
+    start = time.time() if start is None else start
+    trace_id = uuid.UUID(int=rng.getrandbits(128)).hex
+    model = rng.choice(MODELS)
+    question = _text(rng, "请总结以下内容：", _body_chars(rng, body_kb))
+    answer = _text(rng, "总结：", max(16, _body_chars(rng, body_kb) // 4))
+    log = _base_log(rng, index, trace_id, start)
+    log.update(question=question, answer=answer)
+
+    if shape == 'chat':
+        log["ai_log"] = _ai_log(rng, index, model, question, answer)
+    elif shape == 'stream':
+        log["ai_log"] = _ai_log(rng, index, model, question, answer, response_type="stream",
+                                chat_round=rng.randint(2, 12))
+    elif shape == 'tool_call':
+        log["answer"] = json.dumps({"tool_calls": [{"type": "function", "function": {
+            "name": "search", "arguments": json.dumps({"query": question[:64]}, ensure_ascii=False)}}]},
+            ensure_ascii=False)
+        log["ai_log"] = _ai_log(rng, index, model, question, log["answer"], response_type="tool_call")
+    elif shape == 'fallback':
+        attempts = rng.randint(2, 3)
+        logs = []
+        for attempt in range(attempts):
+            record = dict(log)
+            record["request_id"] = str(uuid.UUID(int=rng.getrandbits(128)))
+            record["start_time"] = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(start + attempt)) + ".000Z"
+            fallback_model = MODELS[(MODELS.index(model) + attempt) % len(MODELS)]
+            if attempt < attempts - 1:
+                record.update(response_code="503", answer="", response_code_details="upstream_reset")
+                record["ai_log"] = json.dumps({"model": fallback_model, "response_type": "error"})
+            else:
+                record["ai_log"] = _ai_log(rng, index, fallback_model, question, answer,
+                                           fallback_from=model)
+            logs.append(record)
+        return logs
+    elif shape == 'error':
+        log.update(response_code=rng.choice(("500", "502", "504")), answer="",
+                   response_code_details="upstream_reset_before_response_started")
+        log["ai_log"] = json.dumps({"model": model, "api": "chat-api@1"})
+    elif shape == 'no_ai_log':
+        pass
+    elif shape == 'no_trace':
+        log["trace_id"] = "-"
+        log["ai_log"] = _ai_log(rng, index, model, question, answer)
+    else:
+        raise ValueError(f"未知的日志形态: {shape}")
+    return [log]
+
+
+def build_gateway_log_groups(count: int, group_size: int = 100, seed: int = 42,
+                             body_kb: Optional[float] = None, shapes: Tuple[str, ...] = SHAPES,
+                             weights: Optional[Tuple[int, ...]] = None) -> Tuple[List[LogGroupList], int]:
+    """
+    生成约 count 条日志，按 group_size 条一个 LogGroup、每个 LogGroup 一次拉取返回。
+    返回 (每次拉取的 LogGroupList 列表, 有效 trace 记录数)。
+    """
+    rng = random.Random(seed)
+    if weights is None:
+        weights = tuple(SHAPE_WEIGHTS[SHAPES.index(shape)] for shape in shapes)
+    now = time.time()
+    logs: List[dict] = []
+    while len(logs) < count:
+        shape = rng.choices(shapes, weights)[0]
+        logs.extend(make_gateway_logs(len(logs), rng, shape, body_kb, start=now - rng.uniform(0, 60)))
+    del logs[count:]
+
+    pulls = []
+    for begin in range(0, count, group_size):
+        log_groups = LogGroupList()
+        log_group = log_groups.LogGroups.add()
+        for record in logs[begin:begin + group_size]:
+            log = log_group.Logs.add()
+            log.Time = int(now)
+            for key, value in record.items():
+                content = log.Contents.add()
+                content.Key = key
+                content.Value = str(value)
+        pulls.append(LogGroupList.FromString(log_groups.SerializeToString()))
+    valid = sum(1 for record in logs if record["trace_id"] != "-")
+    return pulls, valid
@@ -0,0 +1,118 @@
+# benchmarks/stub_langfuse.py
+
+"""
+本地 Langfuse 摄取接口桩：模拟 /api/public/ingestion 的延迟、错误率和整体不可用，
+用于离线压测发送链路，不需要真实的 Langfuse 实例。
+同时接受 OTLP/HTTP protobuf 请求（路径以 /v1/traces 结尾，可 gzip 压缩），按 span 计数。
+"""
+
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubLangfuseServer:
+    """在后台线程中运行的 Langfuse 桩服务。"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency_ms: float = 20.0,
+                 error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.outage = False  # 置为 True 时所有请求返回 503，模拟 Langfuse 故障
+        self.events_received = 0
+        self.requests_received = 0
+        self.bytes_received = 0
+        self.cpu_seconds = 0.0  # 处理请求消耗的 CPU，进程内压测时从总 CPU 中扣除
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 支持 keep-alive
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if stub.outage:
+                    self._reply(503, {"status": "unavailable"})
+                    return
+                self._reply(200, {"status": "OK"})
+
+            def do_POST(self):
+                cpu_started = time.thread_time()
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if stub.latency_ms:
+                    time.sleep(stub.latency_ms / 1000)  # 睡眠不计入 thread_time
+                if self.path.endswith('/v1/traces'):
+                    self._otlp(raw)
+                    with stub._lock:
+                        stub.cpu_seconds += time.thread_time() - cpu_started
+                    return
+                batch = json.loads(raw).get("batch", []) if raw else []
+                with stub._lock:
+                    stub.requests_received += 1
+                    stub.events_received += len(batch)
+                    stub.bytes_received += len(raw)
+                if stub.outage:
+                    self._reply(503, {"message": "stub outage"})
+                else:
+                    successes, errors = [], []
+                    for event in batch:
+                        if stub.error_rate and random.random() < stub.error_rate:
+                            errors.append({"id": event.get("id"), "status": 500, "message": "stub error"})
+                        else:
+                            successes.append({"id": event.get("id"), "status": 201})
+                    self._reply(207, {"successes": successes, "errors": errors})
+                with stub._lock:
+                    stub.cpu_seconds += time.thread_time() - cpu_started
+
+            def _otlp(self, raw: bytes):
+                from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import (
+                    ExportTraceServiceRequest, ExportTraceServiceResponse,
+                )
+                data = gzip.decompress(raw) if self.headers.get("Content-Encoding") == "gzip" else raw
+                request = ExportTraceServiceRequest.FromString(data)
+                spans = sum(len(scope.spans) for resource in request.resource_spans for scope in resource.scope_spans)
+                with stub._lock:
+                    stub.requests_received += 1
+                    stub.events_received += spans
+                    stub.bytes_received += len(raw)
+                # OTLP 没有逐条结果，error_rate 按请求整体失败
+                if stub.outage or (stub.error_rate and random.random() < stub.error_rate):
+                    self._reply(503, {"message": "stub outage"})
+                    return
+                body = ExportTraceServiceResponse().SerializeToString()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-protobuf")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="StubLangfuse", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
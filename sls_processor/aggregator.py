@@ -0,0 +1,200 @@
+# sls_processor/aggregator.py
+
+"""
+按 trace_id 聚合记录的时间窗口。
+
+网关的重试、fallback 会产生多条相同 trace_id 的日志。聚合器从队列取出记录后按 trace_id
+缓冲 TRACE_AGGREGATION_WINDOW_MS（从该 trace 的第一条记录算起），窗口到期后把整组记录
+一起交给发送端；同一组记录总是进入同一个批次，由 ingestion.encode_batch 合并为一个
+trace-create 和 N 个 generation-create。
+
+- 内存有界：缓冲的记录数、字节数超过上限时，最早开始的 trace 组提前释放（不丢弃）；
+  单个 trace 的记录数达到上限时也立即释放。
+- 记录的确认句柄随记录一起缓冲，发送成功后才确认，检查点语义不变。
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+from queue import Empty
+from typing import Deque, List, Optional
+
+from . import metrics
+from .records import peek_field, record_size
+
+logger = logging.getLogger(__name__)
+
+# --- trace 聚合配置 (窗口为 0 表示不缓冲，仅合并同一批次内的记录) ---
+TRACE_AGGREGATION_WINDOW_MS = float(os.getenv('TRACE_AGGREGATION_WINDOW_MS', '0'))
+TRACE_AGGREGATION_MAX_RECORDS = int(os.getenv('TRACE_AGGREGATION_MAX_RECORDS', '5000'))
+TRACE_AGGREGATION_MAX_MB = float(os.getenv('TRACE_AGGREGATION_MAX_MB', '64'))
+TRACE_AGGREGATION_MAX_PER_TRACE = int(os.getenv('TRACE_AGGREGATION_MAX_PER_TRACE', '20'))
+
+
+class _Group:
+    __slots__ = ('started', 'items', 'nbytes')
+
+    def __init__(self, started: float):
+        self.started = started
+        self.items: List[tuple] = []
+        self.nbytes = 0
+
+
+class TraceAggregator:
+    """
+    包装 SpillQueue 的聚合阶段：后台线程从 source 取记录并按 trace_id 分组，
+    发送端通过 get_batch / get / get_nowait 取出到期的记录组，接口与 SpillQueue 一致。
+    """
+
+    def __init__(self, source, window: float = TRACE_AGGREGATION_WINDOW_MS / 1000,
+                 max_records: int = TRACE_AGGREGATION_MAX_RECORDS,
+                 max_bytes: int = int(TRACE_AGGREGATION_MAX_MB * 1024 * 1024),
+                 max_per_trace: int = TRACE_AGGREGATION_MAX_PER_TRACE):
+        self.source = source
+        self.window = window
+        self.max_records = max(1, max_records)
+        self.max_bytes = max_bytes
+        self.max_per_trace = max(1, max_per_trace)
+        self._groups: 'collections.OrderedDict[str, _Group]' = collections.OrderedDict()  # 按首条到达顺序
+        self._ready: Deque[List[tuple]] = collections.deque()
+        self._buffered = 0
+        self._buffered_bytes = 0
+        self._ready_count = 0
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="TraceAggregator", daemon=True)
+
+    def start(self) -> 'TraceAggregator':
+        metrics.TRACE_AGGREGATION_BUFFERED.set_function(lambda: self._buffered)
+        self._thread.start()
+        logger.info(f"🧩 trace 聚合已启用: 窗口 {self.window * 1000:.0f}ms, 最多缓冲 {self.max_records} 条 / "
+                    f"{self.max_bytes / 1024 / 1024:.0f}MB, 单个 trace 最多 {self.max_per_trace} 条")
+        return self
+
+    # --- 缓冲 ---
+
+    def _release(self, key: str):
+        group = self._groups.pop(key)
+        self._buffered -= len(group.items)
+        self._buffered_bytes -= group.nbytes
+        self._ready.append(group.items)
+        self._ready_count += len(group.items)
+
+    def _release_due(self, now: float) -> Optional[float]:
+        """释放到期和超出容量的组，返回距下一个组到期的秒数（没有缓冲时返回 None）。"""
+        while self._groups:
+            key, group = next(iter(self._groups.items()))
+            over_capacity = self._buffered > self.max_records or self._buffered_bytes > self.max_bytes
+            if not over_capacity and now - group.started < self.window and not self._closing:
+                return group.started + self.window - now
+            self._release(key)
+        return None
+
+    def _add(self, item: tuple):
+        key = peek_field(item[0], 'trace_id') or ''
+        size = record_size(item[0])
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _Group(time.monotonic())
+        group.items.append(item)
+        group.nbytes += size
+        self._buffered += 1
+        self._buffered_bytes += size
+        if len(group.items) >= self.max_per_trace:
+            self._release(key)
+
+    def _run(self):
+        wait = self.window
+        while True:
+            with self._cond:
+                # 已释放未取走的记录过多时暂停取数，反压留在 source 队列中
+                while self._ready_count >= self.max_records and not self._closing:
+                    self._cond.wait(0.1)
+                closing = self._closing
+            try:
+                item = self.source.get_nowait() if closing else self.source.get(timeout=max(0.001, min(wait, 0.1)))
+            except Empty:
+                item = None
+            with self._cond:
+                if item is not None:
+                    self._add(item)
+                wait = self._release_due(time.monotonic()) or self.window
+                if self._ready:
+                    self._cond.notify_all()
+                if closing and item is None:
+                    self._release_due(time.monotonic())
+                    self._cond.notify_all()
+                    return
+
+    def close(self, timeout: float = 10):
+        """取空 source 并立即释放所有缓冲的组，之后 get 只返回剩余的已释放记录。"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    # --- 取数 ---
+
+    def _pop_groups(self, max_items: int) -> List[tuple]:
+        batch: List[tuple] = []
+        while self._ready and len(batch) < max_items:
+            group = self._ready[0]
+            room = max_items - len(batch)
+            if batch and len(group) > room:
+                break  # 不拆分记录组，留给下一批
+            if len(group) > room:
+                batch.extend(group[:room])
+                self._ready[0] = group[room:]
+            else:
+                batch.extend(self._ready.popleft())
+        self._ready_count -= len(batch)
+        self._cond.notify_all()
+        return batch
+
+    def get_batch(self, max_items: int, timeout: float, max_wait: float) -> List[tuple]:
+        """等待最多 timeout 秒取到第一组，再在 max_wait 秒内继续攒整组记录直到 max_items 条。"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._ready, timeout):
+                return []
+            batch = self._pop_groups(max_items)
+            deadline = time.monotonic() + max_wait
+            while len(batch) < max_items:
+                if not self._ready:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait_for(lambda: self._ready, remaining):
+                        break
+                more = self._pop_groups(max_items - len(batch))
+                if not more:
+                    break
+                batch.extend(more)
+            return batch
+
+    def get(self, block: bool = True, timeout: float = None) -> tuple:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._ready, timeout if block else 0):
+                raise Empty
+            return self._pop_groups(1)[0]
+
+    def get_nowait(self) -> tuple:
+        return self.get(block=False)
+
+    # --- 状态 ---
+
+    def qsize(self) -> int:
+        return self.source.qsize() + self._buffered + self._ready_count
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def watch(self):
+        self.source.watch()
+
+
+def maybe_aggregate(source, window: float = TRACE_AGGREGATION_WINDOW_MS / 1000):
+    """窗口大于 0 时返回已启动的 TraceAggregator，否则原样返回 source。"""
+    if window <= 0:
+        return source
+    return TraceAggregator(source, window=window).start()
@@ -0,0 +1,337 @@
+# sls_processor/async_pipeline.py
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import signal
+import time
+from typing import Any, Callable, Dict, List
+
+from . import metrics
+from .dedup import get_dedup_cache
+from .ingestion import build_async_exporter, build_exporter
+from .profiling import DEQUEUED, SENT, TRANSFORMED, StageTracer, get_stage_tracer
+from .processor import (
+    BATCH_MAX_WAIT_MS, BATCH_SIZE, MAX_RETRIES, RETRY_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS,
+    TRANSFORM_CHUNK_SIZE, TRANSFORM_WORKERS,
+    LangfuseDataProcessor, get_dead_letter_store, start_dead_letter_replayer, watch_transform_caches,
+    write_to_dead_letter_queue,
+)
+from .log_utils import RateLimitedLogger, Sampler
+from .aggregator import maybe_aggregate
+from .resilience import AdaptiveConcurrency, CircuitBreaker, SendResults, backoff_delay
+from .rollups import close_rollups, get_rollup_aggregator
+from .scheduler import maybe_schedule
+from .sender_pool import short_trace_id, transform_guarded
+from .sources import Source
+from .spill_queue import SpillQueue
+from .transform_pool import TransformPool
+
+logger = logging.getLogger(__name__)
+limited_logger = RateLimitedLogger(logger)
+success_sampler = Sampler()
+
+# --- asyncio 模式配置 ---
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', '32'))
+ASYNC_MAX_IN_FLIGHT_BATCHES = int(os.getenv('ASYNC_MAX_IN_FLIGHT_BATCHES', '64'))
+ASYNC_QUEUE_SIZE = int(os.getenv('ASYNC_QUEUE_SIZE', '10000'))
+
+
+class AsyncSenderPipeline:
+    """
+    事件循环内的发送阶段：从 SpillQueue（或 TraceAggregator）攒批，在途批次数由 AIMD 限制器自适应调整，
+    失败批次在独立任务中以指数退避重试，最终失败或熔断期间的记录写入死信队列。
+    """
+
+    def __init__(self, queue: SpillQueue, client, convert: Callable[[Dict[str, Any]], Dict[str, Any]],
+                 dead_letter: Callable[[List[Dict[str, Any]]], bool], batch_size: int = 100,
+                 batch_max_wait: float = 0.5, max_in_flight: int = 64,
+                 max_retries: int = 3, retry_delay: float = 5.0, max_retry_delay: float = 60.0,
+                 transform_pool=None, dedup=None, rollups=None):
+        self.queue = queue
+        self.client = client
+        self.convert = convert
+        self.dead_letter = dead_letter
+        self.batch_size = max(1, batch_size)
+        self.batch_max_wait = batch_max_wait
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # 配置了多进程转换池时，转换放到线程中等待子进程结果，不占用事件循环
+        self.transform_pool = transform_pool
+        # 发送去重：最近已送达的重复记录不再发送，直接确认
+        self.dedup = dedup
+        # 可选的窗口汇总，统计在后台线程中进行
+        self.rollups = rollups
+        self.tracer = get_stage_tracer()
+        self.stats = {'processed': 0, 'success': 0, 'error': 0, 'skipped': 0,
+                      'retries': 0, 'dead_letter': 0, 'diverted': 0, 'batches': 0}
+        self.breaker = CircuitBreaker()
+        self.limiter = AdaptiveConcurrency(max_limit=max_in_flight)
+        self._slot_released = asyncio.Condition()
+        # 队列是线程安全的阻塞队列，由专用线程按批取数，每批只切换一次线程
+        self._fetcher = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="QueueFetch")
+        self._tasks = set()
+        self._closing = False
+
+    def close(self):
+        """停止接收新批次：队列取空后 run() 等待在途发送和重试完成再返回。"""
+        self._closing = True
+
+    async def _next_batch(self) -> List[tuple]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._fetcher, self.queue.get_batch, self.batch_size, 0.5, self.batch_max_wait)
+
+    async def _acquire_slot(self):
+        async with self._slot_released:
+            await self._slot_released.wait_for(self.limiter.try_acquire)
+
+    async def _release_slot(self, latency: float, ok: bool):
+        self.limiter.release(latency, ok)
+        async with self._slot_released:
+            self._slot_released.notify_all()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def run(self):
+        while not (self._closing and self.queue.empty()):
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            self.stats['processed'] += len(batch)
+            self.stats['batches'] += 1
+            if self.tracer is not None:
+                StageTracer.mark(batch, DEQUEUED)
+            metrics.BATCH_SIZE.observe(len(batch))
+            started = time.monotonic()
+            if self.transform_pool is not None:
+                batch, payloads, rejected = await asyncio.get_running_loop().run_in_executor(
+                    None, transform_guarded, self.transform_pool.transform, self.convert, batch)
+            else:
+                batch, payloads, rejected = transform_guarded(
+                    lambda records: [self.convert(record) for record in records], self.convert, batch)
+            metrics.TRANSFORM_SECONDS.observe(time.monotonic() - started)
+            if rejected:
+                await self._reject(rejected)
+                if not batch:
+                    continue
+            if self.tracer is not None:
+                StageTracer.mark(batch, TRANSFORMED)
+            if self.rollups is not None:
+                self.rollups.observe(payloads)
+            if not self.breaker.allow():
+                await self._divert(batch)
+                continue
+            await self._acquire_slot()  # 在途批次达到上限时暂停取数，反压到队列
+            self._spawn(self._send(batch, payloads, attempt=0))
+
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        self._fetcher.shutdown(wait=False)
+
+    async def _send(self, batch: List[tuple], payloads: List[Dict[str, Any]], attempt: int):
+        """调用方已通过熔断检查并占用了一个并发槽位。"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = SendResults.failed(len(payloads))
+        try:
+            if self.dedup is None:
+                results = SendResults.of(await self.client.send_batch(payloads))
+            else:
+                results = await self.dedup.send_async(payloads, self.client.send_batch)
+        except Exception as e:
+            # 编码等异常按整批失败处理，记录进入重试，最终写入死信
+            limited_logger.error('send_error', f"❌ 批量发送异常 ({len(payloads)} 条): {e!r}", exc_info=True)
+        finally:
+            latency = loop.time() - started
+            succeeded = sum(results)
+            metrics.record_send(latency, succeeded, len(results) - succeeded)
+            ok = not results.transport_failed  # 逐条被拒绝的记录不影响熔断和并发
+            self.breaker.record(ok)
+            await self._release_slot(latency, ok)
+        if self.tracer is not None:
+            StageTracer.mark(batch, SENT)
+
+        failed, failed_payloads = [], []
+        for item, payload, ok in zip(batch, payloads, results):
+            if ok:
+                self.stats['success'] += 1
+                if item[1] is not None:
+                    item[1].done()
+                if success_sampler():
+                    logger.info(f"✅ 发送成功 (抽样 1/{success_sampler.every}): "
+                                f"Trace [ {short_trace_id(item)}... ] | "
+                                f"API [ {payload.get('trace_name', 'N/A')} ]")
+            else:
+                failed.append(item)
+                failed_payloads.append(payload)
+
+        if not failed:
+            return
+        if attempt + 1 >= self.max_retries:
+            await self._give_up(failed)
+            return
+        self.stats['retries'] += len(failed)
+        limited_logger.warning('send_failed', f"❌ 批量发送失败 {len(failed)} 条 "
+                                              f"(尝试 {attempt + 1}/{self.max_retries})，转入重试")
+        self._spawn(self._retry(failed, failed_payloads, attempt + 1))
+
+    async def _retry(self, batch: List[tuple], payloads: List[Dict[str, Any]], attempt: int):
+        if not self._closing:
+            await asyncio.sleep(backoff_delay(attempt, self.retry_delay, self.max_retry_delay))
+        metrics.RETRIES.inc(len(batch))
+        if not self.breaker.allow():
+            await self._divert(batch)
+            return
+        await self._acquire_slot()
+        await self._send(batch, payloads, attempt)
+
+    async def _divert(self, items: List[tuple]):
+        """熔断打开期间不再尝试发送，记录直接写入死信存储，由回放线程在恢复后补发。"""
+        self.stats['diverted'] += len(items)
+        self.stats['dead_letter'] += len(items)
+        metrics.DEAD_LETTER_RECORDS.labels('circuit_open').inc(len(items))
+        limited_logger.warning('divert', f"⚡ 熔断打开，{len(items)} 条记录直接写入死信存储")
+        await self._write_dead_letter(items)
+
+    async def _give_up(self, items: List[tuple]):
+        metrics.DEAD_LETTER_RECORDS.labels('exhausted').inc(len(items))
+        self.stats['error'] += len(items)
+        self.stats['dead_letter'] += len(items)
+        limited_logger.error('give_up', f"🚨 {len(items)} 条记录发送最终失败，已转入死信队列: "
+                                        f"Trace [ {short_trace_id(items[0])}... ] 等")
+        await self._write_dead_letter(items)
+
+    async def _reject(self, items: List[tuple]):
+        """无法转换的记录不重试，直接写入死信存储。"""
+        metrics.DEAD_LETTER_RECORDS.labels('transform_error').inc(len(items))
+        self.stats['error'] += len(items)
+        self.stats['dead_letter'] += len(items)
+        await self._write_dead_letter(items)
+
+    async def _write_dead_letter(self, items: List[tuple], attempt: int = 0):
+        """
+        整组写入死信存储（一次落盘），成功后确认。写入失败时退避后重写，既不确认也不丢弃；
+        关闭时仍失败的记录不确认，由检查点保证重启后重新消费。
+        """
+        try:
+            written = await asyncio.get_running_loop().run_in_executor(
+                None, self.dead_letter, [item[0] for item in items])
+        except Exception as e:
+            logger.error(f"❌ 写入死信队列异常: {e!r}", exc_info=True)
+            written = False
+        if written:
+            for item in items:
+                if item[1] is not None:
+                    item[1].done()
+            return
+        if self._closing:
+            logger.error(f"🚨 {len(items)} 条记录无法写入死信队列，关闭前不再重试；它们未被确认，重启后会重新消费")
+            return
+        delay = backoff_delay(attempt + 1, self.retry_delay, self.max_retry_delay)
+        limited_logger.error('dead_letter_failed', f"🚨 {len(items)} 条记录写入死信队列失败，{delay:.0f}s 后重试")
+        self._spawn(self._rewrite_dead_letter(items, attempt + 1, delay))
+
+    async def _rewrite_dead_letter(self, items: List[tuple], attempt: int, delay: float):
+        if not self._closing:
+            await asyncio.sleep(delay)
+        await self._write_dead_letter(items, attempt)
+
+
+async def _serve(input_source: Source):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    queue = SpillQueue(maxsize=ASYNC_QUEUE_SIZE)
+    scheduled = maybe_schedule(queue)
+    source = maybe_aggregate(scheduled)
+    client = build_async_exporter(max_connections=ASYNC_MAX_CONNECTIONS)
+    transform_pool = TransformPool(TRANSFORM_WORKERS, TRANSFORM_CHUNK_SIZE) if TRANSFORM_WORKERS > 0 else None
+    pipeline = AsyncSenderPipeline(
+        source, client,
+        convert=LangfuseDataProcessor.convert_to_langfuse_format,
+        dead_letter=write_to_dead_letter_queue,
+        batch_size=BATCH_SIZE,
+        batch_max_wait=BATCH_MAX_WAIT_MS / 1000,
+        max_in_flight=ASYNC_MAX_IN_FLIGHT_BATCHES,
+        max_retries=MAX_RETRIES,
+        retry_delay=RETRY_DELAY_SECONDS,
+        max_retry_delay=RETRY_MAX_DELAY_SECONDS,
+        transform_pool=transform_pool,
+        dedup=get_dedup_cache(),
+        rollups=get_rollup_aggregator(),
+    )
+    source.watch()
+    metrics.watch_resilience(pipeline.breaker, pipeline.limiter)
+    watch_transform_caches()
+    sender_task = asyncio.create_task(pipeline.run())
+    # 死信回放在独立线程中使用同步客户端，限速发送，不占用事件循环
+    replay_client = build_exporter(max_connections=2)
+    replayer = start_dead_letter_replayer(replay_client)
+    logger.info(f"🚀 asyncio 发送管道已启动: 连接池 {ASYNC_MAX_CONNECTIONS}, "
+                f"在途批次上限 {ASYNC_MAX_IN_FLIGHT_BATCHES}, 队列容量 {ASYNC_QUEUE_SIZE}")
+
+    # 输入源（SLS 拉取或文件读取）在自己的线程中运行，直接写入线程安全的 SpillQueue
+    await loop.run_in_executor(None, input_source.start, queue)
+
+    async def wait_finished():
+        while not input_source.finished():
+            await asyncio.sleep(1)
+
+    stop_waiter = asyncio.create_task(stop.wait())
+    finished_waiter = asyncio.create_task(wait_finished())
+    await asyncio.wait({stop_waiter, finished_waiter, sender_task}, return_when=asyncio.FIRST_COMPLETED)
+    if sender_task.done():
+        logger.error("asyncio 发送管道似乎已停止，正在退出应用...", exc_info=sender_task.exception())
+    elif finished_waiter.done():
+        logger.info("📄 输入已全部读取，发送完毕后退出...")
+    else:
+        logger.info("🛑 收到停止信号，开始关闭...")
+    stop_waiter.cancel()
+    finished_waiter.cancel()
+
+    # --- 优雅停机流程 ---
+    # 前两步出错（包括发送管道已异常退出）时仍执行第 3 步：死信存储的 close 会落盘未提交的写入
+    try:
+        logger.info(f"1/3 - 正在停止输入源 {input_source.name} (不再接收新日志)...")
+        await loop.run_in_executor(None, input_source.shutdown)
+
+        logger.info(f"2/3 - 等待日志队列处理完毕，队列剩余: {source.qsize()} 条...")
+        if scheduled is not queue:
+            await loop.run_in_executor(None, scheduled.close)
+        if source is not scheduled:
+            await loop.run_in_executor(None, source.close)
+        pipeline.close()
+        if not sender_task.done():  # 已退出的发送管道的异常在上面已经记录
+            try:
+                await asyncio.wait_for(sender_task, timeout=30)
+            except asyncio.TimeoutError:
+                logger.warning("asyncio 发送管道在超时后仍未退出。")
+            except Exception as e:
+                logger.error(f"asyncio 发送管道退出时出错: {e!r}", exc_info=True)
+    finally:
+        logger.info("3/3 - 正在关闭Langfuse连接池...")
+        await client.close()
+        if replayer is not None:
+            await loop.run_in_executor(None, replayer.stop)
+        replay_client.close()
+        get_dead_letter_store().close()
+        queue.close()
+        if pipeline.dedup is not None:
+            pipeline.dedup.close()
+        close_rollups()
+        if transform_pool is not None:
+            transform_pool.shutdown()
+    logger.info(f"📊 处理统计: {pipeline.stats}")
+    logger.info("✅ 应用已成功关闭。")
+
+
+def run_async_pipeline(input_source: Source):
+    """以 asyncio 运行时运行 消费 → 转换 → 发送 全链路，直到收到 SIGINT/SIGTERM 或有限输入处理完毕。"""
+    asyncio.run(_serve(input_source))
@@ -0,0 +1,315 @@
+# sls_processor/backfill.py
+
+"""
+历史区间回放：按时间范围重新拉取 SLS 日志并发送到 Langfuse，用于 Langfuse 故障或映射变更后的补数。
+
+    python -m sls_processor.backfill --from "2024-05-01 00:00:00+8:00" --to "2024-05-01 06:00:00+8:00"
+
+- 不经过消费组：用 get_cursor 把时间范围换算成每个分片的起止游标，多个分片并行 pull_logs。
+- 记录进入与实时服务相同的队列和发送路径（convert_to_langfuse_format、SenderPool、重试和死信）。
+  最终失败的记录写入同一个死信目录，但回放进程不启动死信回放，由实时服务按自己的限速补发。
+- 进度按分片记录在本地状态文件中，只推进到已确认（发送成功或写入死信）的最高连续游标；
+  中断后以相同参数重新运行即从断点继续。
+- 按 BACKFILL_MAX_RECORDS_PER_SECOND 限速，避免占满 SLS 分片读配额和 Langfuse 容量、拖慢实时消费。
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from queue import Full
+from typing import Dict, List, Optional
+
+from aliyun.log import LogClient
+from aliyun.log.util import parse_timestamp
+
+# 先导入 main：加载 .env 并配置日志，之后导入的模块才能读到 .env 中的配置
+from .main import (
+    ACCESS_KEY_ID, ACCESS_KEY_SECRET, ENDPOINT, LOGSTORE_NAME, PROJECT_NAME, _install_stop_handler,
+)
+from . import metrics
+from .checkpoint import ShardOffsetTracker
+from .consumer import is_valid_trace_id, size_before_query
+from .dedup import DedupCache
+from .processor import SENDER_CONCURRENCY, LangfuseSender, process_logs_from_queue
+from .pushdown import build_consumer_query
+from .records import LogRecordView, PulledArena, find_content
+from .resilience import backoff_delay
+from .spill_queue import SpillQueue
+
+logger = logging.getLogger(__name__)
+
+# --- 回放配置 ---
+BACKFILL_SHARD_PARALLELISM = int(os.getenv('BACKFILL_SHARD_PARALLELISM', '4'))
+BACKFILL_PULL_LOG_GROUPS = int(os.getenv('BACKFILL_PULL_LOG_GROUPS', '1000'))
+BACKFILL_MAX_RECORDS_PER_SECOND = float(os.getenv('BACKFILL_MAX_RECORDS_PER_SECOND', '2000'))  # 0 表示不限速
+BACKFILL_STATE_FILE = os.getenv('BACKFILL_STATE_FILE', '.backfill_state.json')
+BACKFILL_PULL_RETRIES = int(os.getenv('BACKFILL_PULL_RETRIES', '5'))
+BACKFILL_PROGRESS_INTERVAL_SECONDS = float(os.getenv('BACKFILL_PROGRESS_INTERVAL_SECONDS', '10'))
+
+
+class Throttle:
+    """多个拉取线程共享的限速器：按条数预约时间片，超出速率的调用方睡眠等待。"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, count: int, stop: threading.Event):
+        if self.rate <= 0 or count <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + count / self.rate
+        if start > now:
+            stop.wait(start - now)
+
+
+class BackfillState:
+    """
+    本地进度文件：{from, to, project, logstore, shards: {分片: {cursor, end}}}。
+    cursor 是已确认的最高连续游标，等于 end 时该分片回放完成。
+    """
+
+    def __init__(self, path: str, from_ts: int, to_ts: int):
+        self.path = path
+        self.from_ts = from_ts
+        self.to_ts = to_ts
+        self.shards: Dict[str, Dict[str, str]] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, from_ts: int, to_ts: int) -> 'BackfillState':
+        state = cls(path, from_ts, to_ts)
+        if not os.path.exists(path):
+            return state
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if (data.get('from'), data.get('to'), data.get('project'), data.get('logstore')) != \
+                (from_ts, to_ts, PROJECT_NAME, LOGSTORE_NAME):
+            raise SystemExit(f"状态文件 {path} 属于另一次回放 (from={data.get('from')}, to={data.get('to')}, "
+                             f"logstore={data.get('logstore')})，请指定新的 --state-file 或删除它")
+        state.shards = data.get('shards', {})
+        return state
+
+    def save(self):
+        with self.lock:
+            data = {'from': self.from_ts, 'to': self.to_ts, 'project': PROJECT_NAME, 'logstore': LOGSTORE_NAME,
+                    'shards': self.shards}
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def is_done(self, shard_id: int) -> bool:
+        progress = self.shards.get(str(shard_id))
+        return bool(progress) and progress.get('cursor') == progress.get('end')
+
+
+class Backfill:
+    """按分片并行拉取 [from_ts, to_ts) 的日志放入队列，由 process_logs_from_queue 发送。"""
+
+    def __init__(self, client: LogClient, state: BackfillState, log_queue: SpillQueue, stop: threading.Event,
+                 parallelism: int = BACKFILL_SHARD_PARALLELISM, max_rate: float = BACKFILL_MAX_RECORDS_PER_SECOND,
+                 pull_log_groups: int = BACKFILL_PULL_LOG_GROUPS):
+        self.client = client
+        self.state = state
+        self.log_queue = log_queue
+        self.stop = stop
+        self.parallelism = max(1, parallelism)
+        self.throttle = Throttle(max_rate)
+        self.pull_log_groups = pull_log_groups
+        self.trackers: Dict[int, ShardOffsetTracker] = {}
+        self.pulled = 0
+        self.queued = 0
+        self.query = build_consumer_query()
+        self._pulled_bytes = metrics.SLS_BYTES.labels('pulled')
+        self._received_bytes = metrics.SLS_BYTES.labels('received')
+        self._forwarded_bytes = metrics.SLS_BYTES.labels('forwarded')
+        self._counter_lock = threading.Lock()
+
+    # --- 拉取 ---
+
+    def _cursor(self, shard_id: int, timestamp: int) -> str:
+        return self.client.get_cursor(PROJECT_NAME, LOGSTORE_NAME, shard_id, timestamp).get_cursor()
+
+    def _pull(self, shard_id: int, cursor: str, end: str):
+        for attempt in range(BACKFILL_PULL_RETRIES + 1):
+            try:
+                return self.client.pull_logs(PROJECT_NAME, LOGSTORE_NAME, shard_id, cursor,
+                                             count=self.pull_log_groups, end_cursor=end, query=self.query)
+            except Exception as e:
+                if attempt == BACKFILL_PULL_RETRIES or self.stop.is_set():
+                    raise
+                delay = backoff_delay(attempt, 1.0, 30.0)
+                logger.warning(f"⚠️ 分片 {shard_id} 拉取失败，{delay:.1f}s 后重试 ({attempt + 1}/{BACKFILL_PULL_RETRIES}): {e}")
+                self.stop.wait(delay)
+
+    def _put(self, item) -> bool:
+        while not self.stop.is_set():
+            try:
+                self.log_queue.put(item, block=True, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def run_shard(self, shard_id: int):
+        progress = dict(self.state.shards.get(str(shard_id), {}))
+        if 'end' not in progress:
+            progress['end'] = self._cursor(shard_id, self.state.to_ts)
+        if 'cursor' not in progress:
+            progress['cursor'] = self._cursor(shard_id, self.state.from_ts)
+        with self.state.lock:
+            self.state.shards[str(shard_id)] = progress
+        cursor, end = progress['cursor'], progress['end']
+        tracker = self.trackers[shard_id] = ShardOffsetTracker(shard_id)
+        trace_id_index = -1
+        logger.info(f"📼 分片 {shard_id} 开始回放")
+
+        while cursor != end and not self.stop.is_set():
+            response = self._pull(shard_id, cursor, end)
+            next_cursor = response.get_next_cursor()
+            batch = tracker.open_batch(next_cursor)
+            pulled = queued = 0
+            log_groups = response.get_loggroup_list()
+            received_bytes = log_groups.ByteSize()
+            self._pulled_bytes.inc(size_before_query(response, received_bytes))
+            self._received_bytes.inc(received_bytes)
+            arena = PulledArena(received_bytes)
+            for log_group in log_groups.LogGroups:
+                for log in log_group.Logs:
+                    pulled += 1
+                    contents = log.Contents
+                    trace_id, trace_id_index = find_content(contents, 'trace_id', trace_id_index)
+                    if is_valid_trace_id(trace_id):
+                        batch.add()
+                        nbytes = log.ByteSize()
+                        if not self._put((LogRecordView(contents, nbytes, arena), batch)):
+                            return  # 停止中：本批不封口，进度不会越过它
+                        queued += 1
+                        self._forwarded_bytes.inc(nbytes)
+            tracker.seal(batch)
+            with self._counter_lock:
+                self.pulled += pulled
+                self.queued += queued
+            if next_cursor == cursor:
+                break  # 没有更多数据
+            cursor = next_cursor
+            self.throttle.wait(pulled, self.stop)
+
+    # --- 进度 ---
+
+    def checkpoint(self):
+        """把各分片已确认的游标写入状态文件。"""
+        for shard_id, tracker in list(self.trackers.items()):
+            cursor = tracker.take_commit_cursor()
+            if cursor is not None:
+                with self.state.lock:
+                    self.state.shards[str(shard_id)]['cursor'] = cursor
+                tracker.mark_committed(cursor)
+        self.state.save()
+
+    def in_flight(self) -> int:
+        return sum(tracker.in_flight() for tracker in self.trackers.values())
+
+    def run(self, shard_ids: List[int]) -> bool:
+        """回放所有分片直到完成或收到停止信号，返回是否全部完成。"""
+        pending = [shard_id for shard_id in shard_ids if not self.state.is_done(shard_id)]
+        logger.info(f"📼 开始回放 {len(pending)}/{len(shard_ids)} 个分片 (并行 {self.parallelism}, "
+                    f"限速 {self.throttle.rate:.0f} 条/秒)")
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(self.parallelism, thread_name_prefix="BackfillPull") as executor:
+            futures = {executor.submit(self.run_shard, shard_id): shard_id for shard_id in pending}
+            while futures:
+                done, _ = concurrent.futures.wait(futures, timeout=BACKFILL_PROGRESS_INTERVAL_SECONDS)
+                for future in done:
+                    shard_id = futures.pop(future)
+                    if future.exception() is not None:
+                        logger.error(f"❌ 分片 {shard_id} 回放失败，可重新运行以继续: {future.exception()}")
+                self.checkpoint()
+                self._log_progress(started, shard_ids)
+
+        # 拉取结束后等待已入队的记录全部确认
+        deadline = None
+        while self.in_flight():
+            if self.stop.is_set() and deadline is None:
+                deadline = time.monotonic() + 30
+            if deadline is not None and time.monotonic() > deadline:
+                logger.warning(f"停止时仍有 {self.in_flight()} 条记录未确认，下次运行会重新发送。")
+                break
+            time.sleep(0.5)
+        self.checkpoint()
+        self._log_progress(started, shard_ids)
+        return all(self.state.is_done(shard_id) for shard_id in shard_ids)
+
+    def _log_progress(self, started: float, shard_ids: List[int]):
+        elapsed = max(1e-6, time.monotonic() - started)
+        done = sum(self.state.is_done(shard_id) for shard_id in shard_ids)
+        logger.info(f"📼 回放进度: 分片 {done}/{len(shard_ids)} 完成, 已拉取 {self.pulled} 条 "
+                    f"({self.pulled / elapsed:.0f} 条/秒), 入队 {self.queued} 条, 待确认 {self.in_flight()} 条")
+
+
+def list_shard_ids(client: LogClient) -> List[int]:
+    """包括只读分片：分裂/合并前的历史数据仍保存在只读分片中。"""
+    return sorted(shard['shardID'] for shard in client.list_shards(PROJECT_NAME, LOGSTORE_NAME).get_shards_info())
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="from_time", required=True,
+                        help='起始时间（含），Unix 时间戳或 "2024-05-01 00:00:00+8:00" 这类可读时间')
+    parser.add_argument("--to", dest="to_time", required=True, help="结束时间（不含），格式同 --from")
+    parser.add_argument("--shards", type=int, nargs="+", help="只回放这些分片，默认全部分片")
+    parser.add_argument("--state-file", default=BACKFILL_STATE_FILE, help="进度文件，相同参数重新运行时从断点继续")
+    parser.add_argument("--parallel", type=int, default=BACKFILL_SHARD_PARALLELISM, help="并行拉取的分片数")
+    parser.add_argument("--max-rate", type=float, default=BACKFILL_MAX_RECORDS_PER_SECOND,
+                        help="拉取速率上限（条/秒），0 表示不限速")
+    parser.add_argument("--dedup", action="store_true",
+                        help="启用发送去重（默认关闭：补数通常需要覆盖已发送过的记录）")
+    args = parser.parse_args(argv)
+
+    from_ts, to_ts = parse_timestamp(args.from_time), parse_timestamp(args.to_time)
+    if from_ts >= to_ts:
+        parser.error("--from 必须早于 --to")
+    stop_requested = _install_stop_handler()
+    client = LogClient(ENDPOINT, ACCESS_KEY_ID, ACCESS_KEY_SECRET)
+    shard_ids = args.shards or list_shard_ids(client)
+    state = BackfillState.load(args.state_file, from_ts, to_ts)
+    logger.info(f"🚀 回放 {PROJECT_NAME}/{LOGSTORE_NAME} [{from_ts}, {to_ts}) 分片 {shard_ids}，进度文件 {args.state_file}")
+
+    log_queue = SpillQueue()
+    processor_stop = threading.Event()
+    # 回放进程不读写实时服务的去重状态（需要去重时只使用进程内缓存），也不回放实时服务的死信目录
+    sender = LangfuseSender(max_connections=SENDER_CONCURRENCY,
+                            dedup=DedupCache(state_file='') if args.dedup else None)
+    processor_thread = threading.Thread(target=process_logs_from_queue, args=(log_queue, processor_stop),
+                                        kwargs=dict(sender=sender, replay_dead_letters=False),
+                                        name="LangfuseProcessorThread")
+    processor_thread.start()
+
+    backfill = Backfill(client, state, log_queue, stop_requested, parallelism=args.parallel, max_rate=args.max_rate)
+    if backfill.query:
+        logger.info(f"🔎 服务端过滤下推已启用: {backfill.query}")
+    try:
+        complete = backfill.run(shard_ids)
+    finally:
+        processor_stop.set()
+        processor_thread.join(timeout=30)
+        log_queue.close()
+
+    if complete:
+        logger.info("✅ 回放完成。")
+        return 0
+    logger.warning(f"⚠️ 回放未完成，以相同参数重新运行即可从 {args.state_file} 记录的进度继续。")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+# sls_processor/checkpoint.py
+
+import logging
+import threading
+from collections import deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BatchAck:
+    """
+    一次 process() 调用（一批 LogGroup）的确认句柄。
+    每条放入队列的记录都持有它，发送成功或写入死信后调用 done()。
+    """
+    __slots__ = ('offsets', 'cursor', 'pending', 'sealed')
+
+    def __init__(self, offsets: 'ShardOffsetTracker', cursor: str):
+        self.offsets = offsets
+        self.cursor = cursor
+        self.pending = 0
+        self.sealed = False
+
+    def add(self):
+        with self.offsets.lock:
+            self.pending += 1
+
+    def done(self):
+        self.offsets.ack(self)
+
+    @property
+    def complete(self) -> bool:
+        return self.sealed and self.pending == 0
+
+
+class ShardOffsetTracker:
+    """
+    单个分片的位点跟踪：批次按拉取顺序排队，只有当某批及其之前的所有批次
+    都已确认，检查点才会推进到该批的游标（at-least-once）。
+    """
+
+    def __init__(self, shard_id):
+        self.shard_id = shard_id
+        self.lock = threading.Lock()
+        self._batches = deque()
+        self._acked_cursor: Optional[str] = None
+        self._committed_cursor: Optional[str] = None
+
+    def open_batch(self, cursor: str) -> BatchAck:
+        batch = BatchAck(self, cursor)
+        with self.lock:
+            self._batches.append(batch)
+        return batch
+
+    def seal(self, batch: BatchAck):
+        """批次内的记录已全部入队，之后 pending 归零即视为完成。"""
+        with self.lock:
+            batch.sealed = True
+            self._advance()
+
+    def ack(self, batch: BatchAck):
+        with self.lock:
+            batch.pending -= 1
+            if batch.pending == 0:
+                self._advance()
+
+    def _advance(self):
+        while self._batches and self._batches[0].complete:
+            self._acked_cursor = self._batches.popleft().cursor
+
+    def in_flight(self) -> int:
+        with self.lock:
+            return sum(batch.pending for batch in self._batches)
+
+    def take_commit_cursor(self) -> Optional[str]:
+        """返回尚未提交的、已确认的最高连续游标；没有新进展时返回 None。"""
+        with self.lock:
+            if self._acked_cursor is None or self._acked_cursor == self._committed_cursor:
+                return None
+            return self._acked_cursor
+
+    def mark_committed(self, cursor: str):
+        with self.lock:
+            self._committed_cursor = cursor
+
+
+class CheckpointCommitter:
+    """
+    定时合并提交检查点：每个周期为所有已注册的生产者各提交一次，
+    而不是每次 process() 都发起一次检查点RPC。
+    """
+
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self._producers = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="CheckpointCommitter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join(timeout=self.interval + 1)
+
+    def register(self, producer):
+        with self._lock:
+            self._producers.add(producer)
+
+    def unregister(self, producer):
+        with self._lock:
+            self._producers.discard(producer)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                producers = list(self._producers)
+            for producer in producers:
+                try:
+                    producer.commit_checkpoint()
+                except Exception as e:
+                    logger.error(f"🚨 分片 {producer.shard_id} 定时提交检查点异常: {e}", exc_info=True)
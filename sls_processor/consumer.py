@@ -1,81 +1,195 @@
 # sls_processor/sls_consumer.py
 
 import logging
+import os
 import time
-from queue import Queue
+from queue import Queue, Full
 
 # --- ✨ 核心修正：从正确的子模块导入 ---
 from aliyun.log import LogClient
 from aliyun.log.consumer import ConsumerWorker, ConsumerProcessorBase, LogHubConfig, CursorPosition
 
+from . import metrics
+from .checkpoint import CheckpointCommitter, ShardOffsetTracker
+from .log_utils import RateLimitedLogger, Sampler
+from .profiling import StageTracer, get_stage_tracer
+from .records import LogRecordView, PulledArena, find_content
+
 
 # 日志配置
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+limited_logger = RateLimitedLogger(logger)
+capture_sampler = Sampler()
+
+# 检查点提交周期（秒）和分片关闭时等待在途确认的时间（秒）
+CHECKPOINT_COMMIT_INTERVAL_SECONDS = float(os.getenv('CHECKPOINT_COMMIT_INTERVAL_SECONDS', '5'))
+SHUTDOWN_ACK_TIMEOUT_SECONDS = float(os.getenv('SHUTDOWN_ACK_TIMEOUT_SECONDS', '10'))
+
+TRACE_ID_MIN_LENGTH = 11  # 网关未生成 trace 时为 "-"；服务端下推的 SPL 使用同一阈值
+
+
+def is_valid_trace_id(trace_id) -> bool:
+    """只有带有效 trace_id（非空字符串）的日志才会被转发到 Langfuse。"""
+    return isinstance(trace_id, str) and trace_id != '-' and len(trace_id) >= TRACE_ID_MIN_LENGTH
+
+
+def size_before_query(response, received: int) -> int:
+    """
+    本次拉取在服务端过滤前的原始字节数：启用 SLS_QUERY 时取响应头 x-log-rawdatasize，
+    未启用（或服务端未返回）时与实际收到的字节数 received 相同。
+    """
+    raw = response.get_raw_size_before_query()
+    return raw if raw >= 0 else received
+
 
 class LogQueueProducer(ConsumerProcessorBase):
     """
     一个将SLS日志放入共享队列的消费者处理器。
+    检查点只推进到已被发送端确认（或写入死信）的最高连续批次。
     """
-    def __init__(self, log_queue: Queue):
+    def __init__(self, log_queue: Queue, committer: CheckpointCommitter):
         super(LogQueueProducer, self).__init__()
         self.log_queue = log_queue
+        self.committer = committer
         self.shard_id = None
+        self.offsets = None
+        self.check_point_tracker = None
+        self._shutting_down = False
+        self._trace_id_index = -1  # 上一条日志中 trace_id 的字段下标
+        self.tracer = get_stage_tracer()
+        self._pulled_bytes = metrics.SLS_BYTES.labels('pulled')
+        self._preprocessor = self._preprocess  # SDK 拉取线程中对每个拉取响应调用
         logger.info("✔️ 日志生产者处理器已创建，等待分片分配...")
 
+    def _preprocess(self, response):
+        """取出日志组，同时记录服务端过滤前的拉取字节数（process 只拿得到过滤后的日志组）。"""
+        self._pulled_bytes.inc(size_before_query(response, response.get_raw_size()))
+        return response.get_loggroup_list()
+
     def initialize(self, shard):
         self.shard_id = shard
+        self.offsets = ShardOffsetTracker(shard)
+        self._consumed = metrics.RECORDS_CONSUMED.labels(shard)
+        self._lag = metrics.SHARD_LAG_SECONDS.labels(shard)
+        self._received_bytes = metrics.SLS_BYTES.labels('received')
+        self._forwarded_bytes = metrics.SLS_BYTES.labels('forwarded')
+        metrics.SHARD_IN_FLIGHT.labels(shard).set_function(self.offsets.in_flight)
         logger.info(f"👍 分片 {self.shard_id} 的生产者已启动。")
 
+    def _put(self, item, trace_id: str) -> bool:
+        """阻塞放入队列（反压SLS拉取），仅在分片关闭时放弃；未入队的记录不会被确认。"""
+        while not self._shutting_down:
+            try:
+                self.log_queue.put(item, block=True, timeout=1)
+                return True
+            except Full:
+                limited_logger.warning(f"queue_full:{self.shard_id}",
+                                       f"⏳ 队列已满，分片 {self.shard_id} 等待中: Trace [ {trace_id[:16]}... ]")
+        return False
+
     def process(self, log_groups, check_point_tracker):
         """
-        核心处理方法：将有效的trace日志放入队列，并提交检查点。
+        核心处理方法：将有效的trace日志连同批次确认句柄放入队列。
+        拉取线程只读取 trace_id，放入队列的是 protobuf 上的只读视图，字典在发送端转换时才构建。
+        检查点由 CheckpointCommitter 定时提交。
         """
+        if self.check_point_tracker is None:
+            self.check_point_tracker = check_point_tracker
+            self.committer.register(self)
+
+        pulled_ns = time.monotonic_ns() if self.tracer is not None else 0
+        batch = self.offsets.open_batch(check_point_tracker.get_cursor())
+        received_bytes = log_groups.ByteSize()
+        self._received_bytes.inc(received_bytes)
+        arena = PulledArena(received_bytes)  # 本批视图共同固定的拉取结果，队列按它计量内存
+        put_count = put_bytes = 0
         try:
-            put_count = 0
             for log_group in log_groups.LogGroups:
                 for log in log_group.Logs:
-                    log_contents = {content.Key: content.Value for content in log.Contents}
-                    
-                    trace_id = log_contents.get('trace_id', '')
-                    if trace_id and trace_id != '-' and len(trace_id) > 10:
-                        try:
-                            self.log_queue.put(log_contents, block=True, timeout=1) # 使用带超时的阻塞put更安全
-                            put_count += 1
-                            logger.info(f"📥 捕获日志: Trace [ {trace_id[:16]}... ] 已放入队列")
-                        except Exception as e:
-                            # 如果队列已满，这里可能会抛出异常
-                            logger.error(f"将日志放入队列失败: {e}", exc_info=True)
-            
+                    contents = log.Contents
+                    trace_id, self._trace_id_index = find_content(contents, 'trace_id', self._trace_id_index)
+                    if is_valid_trace_id(trace_id):  # 启用 SLS_QUERY 下推时服务端已过滤，这里作为兜底
+                        batch.add()
+                        nbytes = log.ByteSize()
+                        view = LogRecordView(contents, nbytes, arena)
+                        ack = batch if self.tracer is None else self.tracer.wrap(batch, view, self.shard_id, pulled_ns)
+                        if not self._put((view, ack), trace_id):
+                            return  # 分片正在关闭，本批不封口，检查点不会越过它
+                        if self.tracer is not None:
+                            StageTracer.queued(ack)
+                        put_count += 1
+                        put_bytes += nbytes
+                        if capture_sampler():
+                            logger.info(f"📥 捕获日志 (抽样 1/{capture_sampler.every}): "
+                                        f"Trace [ {trace_id[:16]}... ] 已放入队列")
+        finally:
             if put_count > 0:
+                self._consumed.inc(put_count)
+                self._forwarded_bytes.inc(put_bytes)
                 logger.debug(f"分片 {self.shard_id}: 本批次 {put_count} 条有效日志已放入队列。当前队列大小: {self.log_queue.qsize()}")
-        
-        finally:
-            # --- ✨ 轻量级重试（不阻塞主流程） ---
-            max_retries = 2  # 保持轻量
-            for attempt in range(max_retries + 1):
-                try:
-                    check_point_tracker.save_check_point(True)
-                    logger.info(f"💾 分片 {self.shard_id} 的检查点已成功提交 (尝试 {attempt + 1})")
-                    break
-                except Exception as e:
-                    if attempt == max_retries:
-                        logger.error(f"🚨 分片 {self.shard_id} 检查点最终失败，已记录: {e}")
-                        # 可选：记录到监控系统
-                        self._record_checkpoint_failure(self.shard_id, str(e))
-                    else:
-                        logger.warning(f"⚠️ 分片 {self.shard_id} 检查点重试 {attempt + 1}: {e}")
-                        time.sleep(0.5)  # 很短的延迟
-            
+        self.offsets.seal(batch)
+        if log_groups.LogGroups and log_groups.LogGroups[-1].Logs:
+            self._lag.set(max(0, time.time() - log_groups.LogGroups[-1].Logs[-1].Time))
+
+    def commit_checkpoint(self):
+        """将已确认的最高连续游标提交到SLS（无新进展时不发起RPC）。"""
+        if self.check_point_tracker is None:
+            return
+        cursor = self.offsets.take_commit_cursor()
+        if cursor is None:
+            return
+
+        # --- ✨ 轻量级重试（不阻塞主流程） ---
+        max_retries = 2  # 保持轻量
+        for attempt in range(max_retries + 1):
+            try:
+                started = time.monotonic()
+                self.check_point_tracker.save_check_point(True, cursor=cursor)
+                metrics.CHECKPOINT_COMMIT_SECONDS.observe(time.monotonic() - started)
+                self.offsets.mark_committed(cursor)
+                logger.debug(f"💾 分片 {self.shard_id} 的检查点已成功提交 (尝试 {attempt + 1})")
+                break
+            except Exception as e:
+                if attempt == max_retries:
+                    logger.error(f"🚨 分片 {self.shard_id} 检查点最终失败，已记录: {e}")
+                    self._record_checkpoint_failure(self.shard_id, str(e))
+                else:
+                    logger.warning(f"⚠️ 分片 {self.shard_id} 检查点重试 {attempt + 1}: {e}")
+                    time.sleep(0.5)  # 很短的延迟
+
+    @staticmethod
+    def _record_checkpoint_failure(shard_id, error: str):
+        """检查点重试后仍失败：计入指标，下个周期会再次尝试提交同一游标。"""
+        metrics.CHECKPOINT_FAILURES.labels(shard_id).inc()
+
     def shutdown(self, check_point_tracker):
         logger.info(f"ℹ️ 生产者正在为分片 {self.shard_id} 关闭...")
+        self._shutting_down = True
+        self.committer.unregister(self)
+        if self.check_point_tracker is None:
+            self.check_point_tracker = check_point_tracker
+
+        # 给在途记录一个短暂的确认窗口，再提交最终检查点
+        deadline = time.time() + SHUTDOWN_ACK_TIMEOUT_SECONDS
+        while self.offsets is not None and self.offsets.in_flight() and time.time() < deadline:
+            time.sleep(0.2)
+        if self.offsets is not None:
+            self.commit_checkpoint()
+            if (in_flight := self.offsets.in_flight()):
+                logger.warning(f"分片 {self.shard_id} 关闭时仍有 {in_flight} 条记录未确认，将由新的消费者重新消费。")
+            # 分片可能被分配到其他消费者，不再上报它的仪表盘
+            metrics.SHARD_IN_FLIGHT.remove(self.shard_id)
+            metrics.SHARD_LAG_SECONDS.remove(self.shard_id)
 
 
 def start_sls_consumer_worker(config: LogHubConfig, log_queue: Queue):
     """启动并管理ConsumerWorker。"""
     logger.info("🚀 启动 ConsumerWorker...")
+    committer = CheckpointCommitter(interval=CHECKPOINT_COMMIT_INTERVAL_SECONDS)
+    committer.start()
     # 通过 lambda 传递队列实例给处理器
-    worker = ConsumerWorker(lambda: LogQueueProducer(log_queue), consumer_option=config)
+    worker = ConsumerWorker(lambda: LogQueueProducer(log_queue, committer), consumer_option=config)
     worker.start(join=False)  # 在后台运行
     logger.info("✅ ConsumerWorker 已在后台线程启动。")
-    return worker
\ No newline at end of file
+    return worker
@@ -0,0 +1,409 @@
+# sls_processor/dead_letter.py
+
+"""
+分段追加写的死信存储和自动回放。
+
+- 写入：多个线程的写请求在一个提交窗口内合并，由后台线程一次写入并 fsync（group commit），
+  write() 在数据落盘后才返回 True，调用方据此确认记录。
+- 分段：文件按大小滚动为 dlq-<序号>.jsonl[.gz]，进程启动时总是新开一个分段。
+  活动分段和正在回放的分段持有 flock 排他锁，未被任何进程锁定的分段即为已封存、可回放，
+  因此多个工作进程可以共用同一个目录。
+- 回放：Langfuse 健康检查通过后，按限速把封存分段重新发送，进度记录在 .offset 文件中，
+  整段发送完成后删除。逐条的可重试失败写回活动分段，只有无法回放的记录移入 rejected.jsonl。
+"""
+
+import fcntl
+import glob
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional
+
+from . import jsoncodec, metrics
+from .log_utils import RateLimitedLogger
+from .records import as_dict
+from .resilience import SendResults
+
+logger = logging.getLogger(__name__)
+limited_logger = RateLimitedLogger(logger)
+
+# --- 死信存储与回放配置 ---
+DEAD_LETTER_DIR = os.getenv('DEAD_LETTER_DIR', 'dead_letter')
+DEAD_LETTER_SEGMENT_MAX_MB = float(os.getenv('DEAD_LETTER_SEGMENT_MAX_MB', '64'))
+DEAD_LETTER_COMPRESS = os.getenv('DEAD_LETTER_COMPRESS', 'false').lower() == 'true'
+DEAD_LETTER_FLUSH_INTERVAL_MS = int(os.getenv('DEAD_LETTER_FLUSH_INTERVAL_MS', '50'))
+DEAD_LETTER_REPLAY_ENABLED = os.getenv('DEAD_LETTER_REPLAY_ENABLED', 'true').lower() == 'true'
+DEAD_LETTER_REPLAY_RATE = float(os.getenv('DEAD_LETTER_REPLAY_RATE', '200'))
+DEAD_LETTER_REPLAY_INTERVAL_SECONDS = float(os.getenv('DEAD_LETTER_REPLAY_INTERVAL_SECONDS', '30'))
+
+SEGMENT_PATTERN = re.compile(r'dlq-(\d{10})\.jsonl(\.gz)?$')
+REJECTED_FILE = 'rejected.jsonl'
+
+
+class _CommitGroup:
+    """同一提交窗口内的写请求，共享一次写入和 fsync 的结果。"""
+    __slots__ = ('lines', 'ok')
+
+    def __init__(self):
+        self.lines: List[bytes] = []
+        self.ok: Optional[bool] = None
+
+
+def iter_segment(path: str) -> Iterator[Dict[str, Any]]:
+    """逐行读取分段；崩溃导致的不完整尾部会被忽略。"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        try:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return  # 未写完的最后一行
+                try:
+                    yield jsoncodec.loads(line)
+                except jsoncodec.JSONDecodeError:
+                    logger.warning(f"死信分段 {path} 中有无法解析的行，已跳过")
+        except (EOFError, zlib.error):
+            return  # 压缩流被截断
+
+
+class DeadLetterStore:
+    """分段、批量提交的死信存储，线程安全。"""
+
+    def __init__(self, directory: str = DEAD_LETTER_DIR,
+                 segment_max_bytes: int = int(DEAD_LETTER_SEGMENT_MAX_MB * 1024 * 1024),
+                 compress: bool = DEAD_LETTER_COMPRESS,
+                 flush_interval: float = DEAD_LETTER_FLUSH_INTERVAL_MS / 1000):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.compress = compress
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._pending = _CommitGroup()
+        self._stopping = False
+        self._file_lock = threading.Lock()
+        self._file = None
+        self._raw = None
+        self._last_write = 0.0
+        self._active_seq = max((seq for seq, _ in self._list_segments()), default=0) + 1
+        self._thread = threading.Thread(target=self._run, name="DeadLetterWriter", daemon=True)
+        self._thread.start()
+
+    # --- 写入 ---
+
+    def write(self, log_data: Dict[str, Any]) -> bool:
+        """追加一条记录，落盘后返回 True；写入失败返回 False。"""
+        return self.write_many([log_data])
+
+    def write_many(self, records: List[Mapping[str, Any]]) -> bool:
+        """追加一组记录，它们进入同一个提交组，一次落盘。"""
+        lines = [jsoncodec.dumpb(as_dict(record)) + b"\n" for record in records]
+        with self._cond:
+            if self._stopping:
+                return False
+            group = self._pending
+            group.lines.extend(lines)
+            self._cond.notify_all()
+            while group.ok is None:
+                self._cond.wait()
+            return group.ok
+
+    def close(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout=10)
+        with self._file_lock:
+            self._close_active()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending.lines and not self._stopping:
+                    self._cond.wait()
+                if not self._pending.lines:
+                    return
+            # 提交窗口：让并发的写请求合并到同一次 fsync
+            time.sleep(self.flush_interval)
+            with self._cond:
+                group, self._pending = self._pending, _CommitGroup()
+
+            ok = self._flush(group.lines)
+            with self._cond:
+                group.ok = ok
+                self._cond.notify_all()
+
+    def _flush(self, lines: List[bytes]) -> bool:
+        try:
+            with self._file_lock:
+                if self._file is None:
+                    self._open_active()
+                self._file.write(b"".join(lines))
+                if self.compress:
+                    self._file.flush(zlib.Z_SYNC_FLUSH)
+                else:
+                    self._file.flush()
+                os.fsync(self._file.fileno())
+                self._last_write = time.monotonic()
+                if os.fstat(self._file.fileno()).st_size >= self.segment_max_bytes:
+                    self._rotate()
+            limited_logger.warning('written', f"{len(lines)} 条日志已写入死信队列: {self.directory}")
+            return True
+        except Exception as e:
+            limited_logger.error('write_failed', f"写入死信队列失败 ({len(lines)} 条): {e}")
+            with self._file_lock:
+                self._close_active()
+            return False
+
+    # --- 分段管理 ---
+
+    def _segment_path(self, seq: int) -> str:
+        suffix = '.jsonl.gz' if self.compress else '.jsonl'
+        return os.path.join(self.directory, f"dlq-{seq:010d}{suffix}")
+
+    def _open_active(self):
+        """打开活动分段并加锁；序号已被其他进程占用时顺延到下一个未加锁的序号。"""
+        while True:
+            path = self._segment_path(self._active_seq)
+            raw = open(path, 'ab')
+            try:
+                fcntl.flock(raw.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)  # 标记为活动分段，关闭时自动释放
+            except BlockingIOError:
+                raw.close()
+                self._active_seq += 1
+                continue
+            if os.fstat(raw.fileno()).st_size > 0:
+                raw.close()  # 其他进程已写完并封存的分段，不再追加
+                self._active_seq += 1
+                continue
+            self._raw = raw
+            self._file = gzip.GzipFile(fileobj=raw, mode='ab') if self.compress else raw
+            return
+
+    def _close_active(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+                if self._raw is not self._file:
+                    self._raw.close()  # GzipFile 不会关闭外部传入的文件对象
+            finally:
+                self._file = self._raw = None
+
+    def _rotate(self):
+        self._close_active()
+        self._active_seq += 1
+
+    def seal_if_idle(self, idle_seconds: float):
+        """活动分段有数据且空闲超过 idle_seconds 时封存，使其可被回放。"""
+        with self._file_lock:
+            if self._file is not None and time.monotonic() - self._last_write >= idle_seconds:
+                self._rotate()
+
+    def _list_segments(self):
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, 'dlq-*.jsonl*')):
+            if (match := SEGMENT_PATTERN.search(path)):
+                segments.append((int(match.group(1)), path))
+        return sorted(segments)
+
+    @staticmethod
+    def _is_locked(path: str) -> bool:
+        """分段是否正被某个进程作为活动分段写入。"""
+        try:
+            with open(path, 'rb') as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return True
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                return False
+        except FileNotFoundError:
+            return True
+
+    def sealed_segments(self) -> List[str]:
+        """可回放的分段：不是本进程的活动分段，也没有被其他进程锁定。"""
+        with self._file_lock:
+            active_seq = self._active_seq
+        return [path for seq, path in self._list_segments()
+                if seq < active_seq and not self._is_locked(path)]
+
+    def reject(self, log_data: Mapping[str, Any]):
+        """回放时无法转换、编码或被 Langfuse 明确拒绝（4xx）的记录单独保存，避免阻塞回放。"""
+        with open(os.path.join(self.directory, REJECTED_FILE), 'ab') as f:
+            f.write(jsoncodec.dumpb(as_dict(log_data)) + b"\n")
+
+
+class DeadLetterReplayer:
+    """
+    后台回放线程：定期检查 Langfuse 健康状态，恢复后按 rate_limit (条/秒)
+    把封存分段重新发送，整段成功后删除该分段。
+    """
+
+    def __init__(self, store: DeadLetterStore, sender, convert: Callable[[Dict[str, Any]], Dict[str, Any]],
+                 rate_limit: float = DEAD_LETTER_REPLAY_RATE, batch_size: int = 100,
+                 interval: float = DEAD_LETTER_REPLAY_INTERVAL_SECONDS):
+        self.store = store
+        self.sender = sender
+        self.convert = convert
+        self.rate_limit = rate_limit
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.stats = {'replayed': 0, 'rejected': 0, 'requeued': 0, 'segments_done': 0}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="DeadLetterReplayer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join(timeout=self.interval + 5)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.store.seal_if_idle(self.interval)
+            if not self.store.sealed_segments():
+                continue
+            if not self.sender.health():
+                logger.info("Langfuse 尚未恢复，推迟死信回放")
+                continue
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"死信回放异常: {e}", exc_info=True)
+
+    def drain(self) -> bool:
+        """回放所有封存分段；遇到整批失败（疑似 Langfuse 仍不可用）时停止并返回 False。"""
+        for path in self.store.sealed_segments():
+            if self._stop_event.is_set() or not self._replay_segment(path):
+                return False
+        return True
+
+    def _replay_segment(self, path: str) -> bool:
+        """回放一个分段；分段被其他进程锁定（写入或回放中）时跳过。"""
+        try:
+            lock_file = open(path, 'rb')
+        except FileNotFoundError:
+            return True  # 已被其他进程回放完成
+        with lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            if not os.path.exists(path):
+                return True
+            return self._replay_locked(path)
+
+    def _replay_locked(self, path: str) -> bool:
+        offset_path = path + '.offset'
+        done = 0
+        if os.path.exists(offset_path):
+            with open(offset_path) as f:
+                done = int(f.read().strip() or 0)
+        logger.info(f"♻️ 开始回放死信分段 {os.path.basename(path)} (从第 {done} 条继续)")
+
+        index = 0
+        batch = []
+        for record in iter_segment(path):
+            index += 1
+            if index <= done:
+                continue
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                if not self._send(batch):
+                    return False
+                done = index
+                self._save_offset(offset_path, done)
+                batch = []
+        if batch and not self._send(batch):
+            return False
+
+        os.remove(path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+        self.stats['segments_done'] += 1
+        logger.info(f"✅ 死信分段 {os.path.basename(path)} 回放完成")
+        return True
+
+    def _send_payloads(self, records: List[Dict[str, Any]], payloads: List[Dict[str, Any]],
+                       poison: List[tuple]) -> SendResults:
+        """
+        整批发送。发送本身抛出异常（而不是返回失败）说明有记录无法编码：改为逐条发送，
+        抛出异常的记录加入 poison，对应结果为 None。
+        """
+        try:
+            return SendResults.of(self.sender.send_batch(payloads))
+        except Exception as e:
+            logger.warning(f"死信回放批次发送异常，改为逐条发送: {e!r}")
+        results = SendResults()
+        for index, (record, payload) in enumerate(zip(records, payloads)):
+            try:
+                single = SendResults.of(self.sender.send_batch([payload]))
+            except Exception as e:
+                poison.append((record, e))
+                results.append(None)
+                continue
+            results.append(single[0])
+            results.transport_failed |= single.transport_failed
+            if single.rejected:
+                results.rejected.add(index)
+        return results
+
+    def _send(self, records: List[Dict[str, Any]]) -> bool:
+        """
+        回放一批。Langfuse 整批未接收时返回 False（不推进进度，稍后整批重试）；
+        无法转换、编码或被 4xx 校验错误拒绝的记录移入 rejected 文件，
+        逐条的可重试失败（5xx、429、超时）重新写入死信存储，由之后的回放再次发送。
+        """
+        started = time.monotonic()
+        # 逐条转换：无法转换或编码的记录移入 rejected 文件，不阻塞后续回放
+        poison, kept, payloads = [], [], []
+        for record in records:
+            try:
+                payloads.append(self.convert(record))
+                kept.append(record)
+            except Exception as e:
+                poison.append((record, e))
+        results = self._send_payloads(kept, payloads, poison) if kept else SendResults()
+        if results.transport_failed:
+            logger.warning(f"死信回放批次未被 Langfuse 接收 ({len(records)} 条)，稍后重试")
+            return False
+        replayed, retry = 0, []
+        for index, (record, ok) in enumerate(zip(kept, results)):
+            if ok:
+                replayed += 1
+            elif index in results.rejected:
+                poison.append((record, 'Langfuse 拒绝了该记录'))
+            elif ok is False:
+                retry.append(record)
+        # 可重试的记录先写回死信存储：写入失败时不推进进度，整批留待下次回放
+        if retry and not self.store.write_many(retry):
+            logger.warning(f"死信回放中 {len(retry)} 条可重试的记录无法写回死信存储，稍后重试")
+            return False
+        for record, error in poison:
+            limited_logger.error('replay_poison', f"死信记录无法回放，已移入 {REJECTED_FILE}: "
+                                                  f"Trace [ {str(record.get('trace_id', 'N/A'))[:16]}... ] {error!r}")
+            self.store.reject(record)
+        self.stats['replayed'] += replayed
+        self.stats['rejected'] += len(poison)
+        self.stats['requeued'] += len(retry)
+        metrics.DEAD_LETTER_REPLAYED.labels('success').inc(replayed)
+        metrics.DEAD_LETTER_REPLAYED.labels('rejected').inc(len(poison))
+        metrics.DEAD_LETTER_REPLAYED.labels('requeued').inc(len(retry))
+        # 限速：按 rate_limit 条/秒控制节奏
+        if self.rate_limit > 0:
+            delay = len(records) / self.rate_limit - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        return True
+
+    @staticmethod
+    def _save_offset(path: str, done: int):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(done))
+        os.replace(tmp, path)
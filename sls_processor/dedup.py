@@ -0,0 +1,209 @@
+# sls_processor/dedup.py
+
+"""
+发送前的幂等去重：分片重新分配或重启后，检查点之后已经发送过的记录会被重新消费，
+这里在发送前过滤掉最近已成功发送过的记录，避免 Langfuse 中出现重复的 generation。
+
+- 键为 (trace_id, request_id, start_time)，取自 metadata.original_trace；三者都缺失时不去重。
+- 只在发送成功后记录键，失败和重试的记录不会被误判为重复。
+- 精确 LRU 保存最近 DEDUP_LRU_SIZE 个已送达的键及送达时间，只有 DEDUP_HORIZON_SECONDS 内的命中才跳过；
+  被淘汰的键对应的记录照常发送，发送的 id 由同一个键派生，重复的记录在 Langfuse 中覆盖已有数据。
+- 状态按进程保存（可选 DEDUP_STATE_FILE 定期和退出时落盘，重启后继续生效），只覆盖同一进程
+  （或同一序号的工作进程）重启和分片重新分配回来的情况；跨副本的重复投递依靠确定的 id 覆盖。
+  默认关闭。
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from . import metrics
+from .resilience import SendResults
+
+logger = logging.getLogger(__name__)
+
+# --- 去重配置 ---
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+DEDUP_HORIZON_SECONDS = float(os.getenv('DEDUP_HORIZON_SECONDS', '3600'))
+DEDUP_LRU_SIZE = int(os.getenv('DEDUP_LRU_SIZE', '100000'))
+DEDUP_STATE_FILE = os.getenv('DEDUP_STATE_FILE', '')
+DEDUP_SAVE_INTERVAL_SECONDS = float(os.getenv('DEDUP_SAVE_INTERVAL_SECONDS', '60'))
+
+_MAGIC = b'SLSDEDUP2\n'
+
+
+def dedup_key(data: Dict[str, Any]) -> Optional[bytes]:
+    """转换结果的去重键（16 字节摘要）；没有 trace_id 或 request_id/start_time 都缺失时返回 None。"""
+    original = data.get('metadata', {}).get('original_trace', {})
+    trace_id = original.get('sls_trace_id')
+    request_id = original.get('request_id') or ''
+    start_time = original.get('start_time') or data.get('start_time') or ''
+    if not trace_id or not (request_id or start_time):
+        return None  # 仅凭 trace_id 无法区分同一 trace 的 fallback 调用
+    return hashlib.blake2b(f"{trace_id}\x00{request_id}\x00{start_time}".encode('utf-8'), digest_size=16).digest()
+
+
+class DedupCache:
+    """最近已送达记录的精确 LRU，线程安全。"""
+
+    def __init__(self, horizon: float = DEDUP_HORIZON_SECONDS, lru_size: int = DEDUP_LRU_SIZE,
+                 state_file: str = DEDUP_STATE_FILE, save_interval: float = DEDUP_SAVE_INTERVAL_SECONDS):
+        self.horizon = horizon
+        self.lru_size = lru_size
+        self.state_file = state_file
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._lru: 'collections.OrderedDict[bytes, float]' = collections.OrderedDict()
+        self._dirty = False
+        self._stop_event = threading.Event()
+        self._saver: Optional[threading.Thread] = None
+        self._hits = metrics.DEDUP_LOOKUPS.labels('hit')
+        self._misses = metrics.DEDUP_LOOKUPS.labels('miss')
+        if state_file:
+            self._load()
+            self._saver = threading.Thread(target=self._save_loop, name="DedupStateSaver", daemon=True)
+            self._saver.start()
+
+    # --- 查找与记录 ---
+
+    def seen(self, digest: bytes) -> bool:
+        """是否在 horizon 内已送达过。"""
+        now = time.time()
+        with self._lock:
+            added = self._lru.get(digest)
+            if added is not None and now - added < self.horizon:
+                self._hits.inc()
+                return True
+        self._misses.inc()
+        return False
+
+    def add(self, digest: bytes):
+        now = time.time()
+        with self._lock:
+            self._lru[digest] = now
+            self._lru.move_to_end(digest)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+            self._dirty = True
+
+    # --- 包装发送函数 ---
+
+    def _partition(self, payloads: List[Dict[str, Any]]) -> Tuple[List[Optional[bytes]], List[int]]:
+        keys = [dedup_key(data) for data in payloads]
+        fresh = [index for index, key in enumerate(keys) if key is None or not self.seen(key)]
+        return keys, fresh
+
+    def _complete(self, keys: List[Optional[bytes]], fresh: List[int], sent: List[bool]) -> SendResults:
+        sent = SendResults.of(sent)
+        # 重复的记录视为已送达；失败类别按下标映射回 payloads
+        results = SendResults([True] * len(keys), transport_failed=sent.transport_failed,
+                              rejected=(fresh[index] for index in sent.rejected))
+        for index, ok in zip(fresh, sent):
+            results[index] = ok
+            if ok and keys[index] is not None:
+                self.add(keys[index])
+        return results
+
+    def send(self, payloads: List[Dict[str, Any]], send: Callable[[List[Dict[str, Any]]], List[bool]]) -> SendResults:
+        """过滤掉已送达过的记录后调用 send，返回与 payloads 一一对应的结果。"""
+        keys, fresh = self._partition(payloads)
+        sent = send([payloads[index] for index in fresh]) if fresh else []
+        return self._complete(keys, fresh, sent)
+
+    async def send_async(self, payloads: List[Dict[str, Any]],
+                         send: Callable[[List[Dict[str, Any]]], Awaitable[List[bool]]]) -> SendResults:
+        keys, fresh = self._partition(payloads)
+        sent = await send([payloads[index] for index in fresh]) if fresh else []
+        return self._complete(keys, fresh, sent)
+
+    # --- 持久化 ---
+
+    def save(self):
+        """原子写入状态文件：魔数、JSON 头、LRU 中的 (摘要, 时间)。"""
+        with self._lock:
+            if not self._dirty:
+                return
+            header = json.dumps({'horizon': self.horizon, 'lru': len(self._lru)}).encode('utf-8')
+            parts = [_MAGIC, struct.pack('<I', len(header)), header]
+            parts.extend(digest + struct.pack('<d', added) for digest, added in self._lru.items())
+            self._dirty = False
+        tmp_path = f"{self.state_file}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(parts))
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            logger.error(f"❌ 去重状态保存失败 ({self.state_file}): {e}")
+
+    def _load(self):
+        try:
+            with open(self.state_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error(f"❌ 去重状态读取失败 ({self.state_file}): {e}")
+            return
+        try:
+            if not data.startswith(_MAGIC):
+                raise ValueError("文件格式不符")
+            offset = len(_MAGIC)
+            (header_len,) = struct.unpack_from('<I', data, offset)
+            offset += 4
+            header = json.loads(data[offset:offset + header_len])
+            offset += header_len
+            now = time.time()
+            for _ in range(header['lru']):
+                digest = data[offset:offset + 16]
+                (added,) = struct.unpack_from('<d', data, offset + 16)
+                offset += 24
+                if now - added < self.horizon:
+                    self._lru[digest] = added
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+            logger.info(f"♻️ 已恢复去重状态: {self.state_file} (LRU {len(self._lru)} 条)")
+        except (ValueError, KeyError, struct.error) as e:
+            logger.warning(f"⚠️ 去重状态文件无法解析，已忽略 ({self.state_file}): {e}")
+
+    def _save_loop(self):
+        while not self._stop_event.wait(self.save_interval):
+            self.save()
+
+    def close(self):
+        self._stop_event.set()
+        if self.state_file:
+            self.save()
+
+
+_cache: Optional[DedupCache] = None
+_cache_lock = threading.Lock()
+_worker_index: Optional[int] = None
+
+
+def set_worker_index(index: int):
+    """多进程时每个工作进程使用各自的状态文件（<DEDUP_STATE_FILE>.<序号>）。"""
+    global _worker_index
+    _worker_index = index
+
+
+def get_dedup_cache() -> Optional[DedupCache]:
+    """进程内共享的去重缓存；DEDUP_ENABLED=false 时返回 None。"""
+    global _cache
+    if not DEDUP_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            state_file = DEDUP_STATE_FILE
+            if state_file and _worker_index is not None:
+                state_file = f"{state_file}.{_worker_index}"
+            _cache = DedupCache(state_file=state_file)
+            logger.info(f"🧷 发送去重已启用: 时间范围 {DEDUP_HORIZON_SECONDS:.0f}s, LRU {DEDUP_LRU_SIZE} 条"
+                        f"{f', 状态文件 {state_file}' if state_file else ''}")
+        return _cache
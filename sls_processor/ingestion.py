@@ -0,0 +1,335 @@
+# sls_processor/ingestion.py
+
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from . import jsoncodec, metrics
+from .dedup import dedup_key
+from .log_utils import RateLimitedLogger
+from .payload import get_payload_shaper
+from .resilience import SendResults, is_permanent_status
+
+logger = logging.getLogger(__name__)
+limited_logger = RateLimitedLogger(logger)
+
+_EPOCH = datetime.fromtimestamp(0, timezone.utc)
+
+INGESTION_PATH = "/api/public/ingestion"
+HEALTH_PATH = "/api/public/health"
+
+# --- 发送协议配置 ---
+EXPORT_PROTOCOL = os.getenv('EXPORT_PROTOCOL', 'ingestion').lower()  # ingestion / otlp
+EXPORT_PROTOCOLS = ('ingestion', 'otlp')
+
+
+def _utc_iso(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def _utc_now_iso() -> str:
+    return _utc_iso(datetime.now(timezone.utc))
+
+
+def _trace_id(data: Dict[str, Any]) -> Optional[str]:
+    return data.get('metadata', {}).get('original_trace', {}).get('sls_trace_id')
+
+
+def _uuid(key: Optional[bytes], kind: str) -> str:
+    """由 16 字节去重键派生确定的 UUID (uuid5)：同一条记录重发（重试、超时后重发、死信回放）时 id 不变，
+    Langfuse 按 id 覆盖而不是新增；没有去重键的记录退回随机 UUID。"""
+    if key is None:
+        return str(uuid.uuid4())
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f"sls-langfuse.{kind}.{key.hex()}"))
+
+
+def _parse_start_time(value: Any) -> Optional[datetime]:
+    """解析网关日志的 start_time (ISO 8601)；无时区时按 UTC 处理，无法解析时返回 None。"""
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _generation_timing(data: Dict[str, Any]) -> Dict[str, str]:
+    """由 start_time 和 performance.total_duration_ms 得到 generation 的 startTime/endTime。"""
+    start = _parse_start_time(data.get('start_time'))
+    if start is None:
+        return {}
+    timing = {"startTime": _utc_iso(start)}
+    duration = (data.get('metadata') or {}).get('performance', {}).get('total_duration_ms')
+    if isinstance(duration, int) and duration >= 0:
+        try:
+            timing["endTime"] = _utc_iso(start + timedelta(milliseconds=duration))
+        except OverflowError:
+            pass  # 超出日期范围的异常耗时不写 endTime
+    return timing
+
+
+def _trace_body(data: Dict[str, Any], trace_id: Optional[str]) -> Dict[str, Any]:
+    return {
+        "id": trace_id,
+        "name": data.get('trace_name', 'AI Request'),
+        "input": data.get('trace_input'),
+        "output": data.get('trace_output'),
+        "userId": data.get('user_id'),
+        "sessionId": data.get('session_id'),
+        "tags": data.get('tags', []),
+        "metadata": data.get('metadata', {}),
+    }
+
+
+def _generation_body(data: Dict[str, Any], trace_id: Optional[str], key: Optional[bytes]) -> Dict[str, Any]:
+    generation_body = {
+        "id": _uuid(key, 'generation'),
+        "traceId": trace_id,
+        "name": data.get('generation_name', 'AI Generation'),
+        "input": data.get('generation_input'),
+        "output": data.get('generation_output'),
+        "model": data.get('model'),
+        "level": data.get('level', 'DEFAULT'),
+        "statusMessage": data.get('status_message', ''),
+        "metadata": data.get('generation_metadata', data.get('metadata', {})),
+        **_generation_timing(data),
+    }
+    if (usage := data.get('usage_details')):
+        generation_body["usage"] = {**usage, "unit": "TOKENS"}
+    return generation_body
+
+
+def build_trace_events(group: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    把同一 trace_id 的若干条转换结果合并为一个 trace-create 加 N 个 generation-create。
+    按 start_time 排序（无法解析的排在最后）：trace 的名称、输入、用户等取自最早一条，
+    输出取自最晚一条，tags 取并集。返回 (trace 事件, 与 group 顺序一一对应的 generation 事件)。
+    """
+    timestamp = _utc_now_iso()
+    starts = [_parse_start_time(data.get('start_time')) for data in group]
+    order = sorted(range(len(group)), key=lambda i: (starts[i] is None, starts[i] or _EPOCH, i))
+    first, last = group[order[0]], group[order[-1]]
+    trace_id = _trace_id(first)
+
+    trace_body = _trace_body(first, trace_id)
+    if len(group) > 1:
+        if last.get('trace_output') is not None:
+            trace_body["output"] = last.get('trace_output')
+        tags = list(trace_body["tags"])
+        for data in group:
+            tags.extend(tag for tag in data.get('tags', []) if tag not in tags)
+        trace_body["tags"] = tags
+        trace_body["metadata"] = {**(trace_body["metadata"] or {}), "aggregation": {"generations": len(group)}}
+    if starts[order[0]] is not None:
+        trace_body["timestamp"] = _utc_iso(starts[order[0]])
+
+    keys = [dedup_key(data) for data in group]
+    # trace 事件 id 取决于组内全部记录：原样重发的组 id 不变，组成不同的组（如聚合后）id 不同
+    group_key = None if None in keys else hashlib.blake2b(b"".join(sorted(keys)), digest_size=16).digest()
+    trace_event = {"id": _uuid(group_key, 'trace-event'), "timestamp": timestamp, "type": "trace-create",
+                   "body": trace_body}
+    generations = [
+        {"id": _uuid(key, 'generation-event'), "timestamp": timestamp, "type": "generation-create",
+         "body": _generation_body(data, trace_id, key)}
+        for data, key in zip(group, keys)
+    ]
+    return trace_event, generations
+
+
+def build_ingestion_events(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    将 convert_to_langfuse_format 的结果转换为 Langfuse 批量接口的事件列表：
+    一个 trace-create 加一个 generation-create，字段与 SDK 路径保持一致。
+    载荷去重后 generation_metadata 为 None，generation 不再携带 metadata。
+    """
+    trace_event, generations = build_trace_events([data])
+    return [trace_event] + generations
+
+
+def encode_batch(payloads: List[Dict[str, Any]]):
+    """
+    组装一次批量请求：返回 (请求体bytes, 事件id到所属记录下标列表的映射, 初始结果列表)。
+    缺少 sls_trace_id 的记录直接标记为失败（重试也不会成功，计入 rejected），不进入请求体；请求体为 None 表示无需发送。
+    启用了载荷整形时，记录在这里被原地截断/去重（幂等，重试时不会重复处理）。
+    同一批次中 trace_id 相同的记录合并为一个 trace-create，该事件被拒绝时这些记录都算失败。
+    """
+    shaper = get_payload_shaper()
+    groups: Dict[str, List[int]] = {}
+    results = SendResults([True] * len(payloads))
+    for index, data in enumerate(payloads):
+        trace_id = _trace_id(data)
+        if not trace_id:
+            limited_logger.warning('missing_trace_id', "在日志中未找到有效的sls_trace_id，已跳过发送。")
+            results[index] = False
+            results.rejected.add(index)
+            continue
+        if shaper.enabled:
+            shaper.shape(data)
+        groups.setdefault(trace_id, []).append(index)
+
+    events = []
+    owners: Dict[str, List[int]] = {}
+    for indexes in groups.values():
+        trace_event, generations = build_trace_events([payloads[index] for index in indexes])
+        owners[trace_event["id"]] = indexes
+        events.append(trace_event)
+        for index, event in zip(indexes, generations):
+            owners.setdefault(event["id"], []).append(index)  # 同一批次中的重复记录共用一个 id
+            events.append(event)
+        if len(indexes) > 1:
+            metrics.TRACE_UPSERTS_MERGED.inc(len(indexes) - 1)
+    body = jsoncodec.dumpb({"batch": events}) if events else None
+    if body is not None:
+        metrics.EXPORT_BYTES.labels('ingestion').inc(len(body))
+    return body, owners, results
+
+
+def apply_response(response: httpx.Response, owners: Dict[str, List[int]], results: SendResults) -> SendResults:
+    """
+    根据批量接口的响应 (207 successes/errors) 更新逐条结果：4xx 校验错误的记录计入 rejected，5xx、429 可重试；
+    非 2xx 响应，或 207 中的记录全部因可重试错误失败时，标记整批未送达 (transport_failed)。
+    """
+    if response.status_code not in (200, 201, 207):
+        limited_logger.error('http_status', f"批量发送到Langfuse失败 ({len(results)} 条): "
+                                            f"HTTP {response.status_code} {response.text[:200]}")
+        return SendResults.failed(len(results))
+
+    try:
+        errors = jsoncodec.loads(response.content).get('errors', [])
+    except ValueError:
+        errors = []
+    for error in errors:
+        rejected = [index for index in owners.get(error.get('id'), ()) if results[index]]
+        for index in rejected:
+            results[index] = False
+        if is_permanent_status(error.get('status')):
+            results.rejected.update(owners.get(error.get('id'), ()))
+        if rejected:
+            limited_logger.warning('rejected', f"Langfuse拒绝了事件 {error.get('id')}: "
+                                               f"{error.get('status')} {error.get('message', '')}")
+    # 207 中发送的记录全部因 5xx、429 等可重试错误失败：与非 2xx 响应一样视为整批未送达
+    sent = {index for indexes in owners.values() for index in indexes}
+    if sent and not any(results[index] for index in sent) and not (sent & results.rejected):
+        results.transport_failed = True
+    return results
+
+
+def _client_options(host: Optional[str], public_key: Optional[str], secret_key: Optional[str],
+                    max_connections: int, timeout: Optional[float]):
+    host = (host or os.environ.get('LANGFUSE_HOST', 'http://localhost:3000')).rstrip('/')
+    options = dict(
+        auth=(public_key or os.environ.get('LANGFUSE_PUBLIC_KEY', ''),
+              secret_key or os.environ.get('LANGFUSE_SECRET_KEY', '')),
+        timeout=timeout or float(os.environ.get('LANGFUSE_SDK_TIMEOUT', '30')),
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=max_connections),
+        headers={"Content-Type": "application/json"},
+    )
+    return host, options
+
+
+class LangfuseIngestionClient:
+    """
+    基于 Langfuse 批量摄取接口 (/api/public/ingestion) 的HTTP客户端。
+    使用连接池和 keep-alive，线程安全，可被多个发送线程共享。
+    """
+
+    def __init__(self, host: Optional[str] = None, public_key: Optional[str] = None,
+                 secret_key: Optional[str] = None, max_connections: int = 10,
+                 timeout: Optional[float] = None):
+        self.host, options = _client_options(host, public_key, secret_key, max_connections, timeout)
+        self.url = f"{self.host}{INGESTION_PATH}"
+        self.client = httpx.Client(**options)
+
+    def send_batch(self, payloads: List[Dict[str, Any]]) -> SendResults:
+        """
+        一次请求发送多条记录，返回与 payloads 对齐的成功标记列表。
+        某条记录的 trace 和 generation 事件都被接受才算成功。
+        """
+        if not payloads:
+            return SendResults()
+        body, owners, results = encode_batch(payloads)
+        if body is None:
+            return results
+        try:
+            response = self.client.post(self.url, content=body)
+        except httpx.HTTPError as e:
+            limited_logger.error('transport', f"批量发送到Langfuse失败 ({len(payloads)} 条): {e}")
+            return SendResults.failed(len(payloads))
+        return apply_response(response, owners, results)
+
+    def send_events(self, events: List[Dict[str, Any]]) -> bool:
+        """直接发送已组装好的摄取事件（如汇总统计的 event-create），全部被接受时返回 True。"""
+        try:
+            response = self.client.post(self.url, content=jsoncodec.dumpb({"batch": events}))
+        except httpx.HTTPError as e:
+            limited_logger.error('transport_events', f"发送事件到Langfuse失败 ({len(events)} 个): {e}")
+            return False
+        owners = {event["id"]: [0] for event in events}
+        return apply_response(response, owners, SendResults([True]))[0]
+
+    def health(self) -> bool:
+        """Langfuse 健康检查接口是否返回 200。"""
+        try:
+            return self.client.get(f"{self.host}{HEALTH_PATH}", timeout=5).status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncLangfuseIngestionClient:
+    """LangfuseIngestionClient 的 asyncio 版本，连接池上限由 max_connections 控制。"""
+
+    def __init__(self, host: Optional[str] = None, public_key: Optional[str] = None,
+                 secret_key: Optional[str] = None, max_connections: int = 32,
+                 timeout: Optional[float] = None):
+        self.host, options = _client_options(host, public_key, secret_key, max_connections, timeout)
+        self.url = f"{self.host}{INGESTION_PATH}"
+        self.client = httpx.AsyncClient(**options)
+
+    async def send_batch(self, payloads: List[Dict[str, Any]]) -> SendResults:
+        if not payloads:
+            return SendResults()
+        body, owners, results = encode_batch(payloads)
+        if body is None:
+            return results
+        try:
+            response = await self.client.post(self.url, content=body)
+        except httpx.HTTPError as e:
+            limited_logger.error('transport', f"批量发送到Langfuse失败 ({len(payloads)} 条): {e}")
+            return SendResults.failed(len(payloads))
+        return apply_response(response, owners, results)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def build_exporter(max_connections: int = 10, protocol: str = EXPORT_PROTOCOL):
+    """
+    按 EXPORT_PROTOCOL 创建发送客户端：ingestion 为 Langfuse 批量摄取接口 (JSON)，otlp 为 OTLP/HTTP (protobuf)。
+    两者接口相同：send_batch(payloads) 返回逐条成功标记 (SendResults)，health()，close()。
+    """
+    if protocol == 'ingestion':
+        return LangfuseIngestionClient(max_connections=max_connections)
+    if protocol == 'otlp':
+        from .otlp import OtlpExporter
+        return OtlpExporter(max_connections=max_connections)
+    raise ValueError(f"无效的 EXPORT_PROTOCOL={protocol!r}，可选值: {', '.join(EXPORT_PROTOCOLS)}")
+
+
+def build_async_exporter(max_connections: int = 32, protocol: str = EXPORT_PROTOCOL):
+    """build_exporter 的 asyncio 版本（send_batch、close 为协程）。"""
+    if protocol == 'ingestion':
+        return AsyncLangfuseIngestionClient(max_connections=max_connections)
+    if protocol == 'otlp':
+        from .otlp import AsyncOtlpExporter
+        return AsyncOtlpExporter(max_connections=max_connections)
+    raise ValueError(f"无效的 EXPORT_PROTOCOL={protocol!r}，可选值: {', '.join(EXPORT_PROTOCOLS)}")
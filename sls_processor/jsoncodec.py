@@ -0,0 +1,76 @@
+# sls_processor/jsoncodec.py
+
+"""
+统一的JSON编解码入口：安装了 orjson 时使用 orjson，否则退回标准库 json。
+可通过 JSON_CODEC=auto|orjson|stdlib 指定。
+
+- loads(data)  接受 str 或 bytes（bytes-in）
+- dumpb(obj)   返回 UTF-8 bytes（bytes-out），可直接作为HTTP请求体或写入二进制文件
+- dumps(obj)   返回 str
+
+orjson 不能编码超出 64 位的整数（如 1e23 这样的 token 数经 to_int 转换后），这类对象退回标准库编码。
+"""
+
+import json
+import logging
+import os
+from typing import Any, Callable, Union
+
+logger = logging.getLogger(__name__)
+
+JSONDecodeError = json.JSONDecodeError  # orjson.JSONDecodeError 是它的子类
+
+
+class StdlibCodec:
+    name = 'stdlib'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str)
+        self.loads: Callable[[Union[str, bytes]], Any] = json.loads
+
+    def dumps(self, obj: Any) -> str:
+        return self._encoder.encode(obj)
+
+    def dumpb(self, obj: Any) -> bytes:
+        return self._encoder.encode(obj).encode('utf-8')
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._fallback = StdlibCodec()
+        self.loads: Callable[[Union[str, bytes]], Any] = orjson.loads
+        # 非字符串键（如 int）按 str 输出，与标准库行为一致
+        self._option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj: Any) -> str:
+        return self.dumpb(obj).decode('utf-8')
+
+    def dumpb(self, obj: Any) -> bytes:
+        try:
+            return self._orjson.dumps(obj, default=str, option=self._option)
+        except self._orjson.JSONEncodeError:
+            return self._fallback.dumpb(obj)
+
+
+def get_codec(name: str = 'auto'):
+    """按名称返回编解码器；auto 时优先 orjson。"""
+    if name == 'stdlib':
+        return StdlibCodec()
+    try:
+        return OrjsonCodec()
+    except ImportError:
+        if name == 'orjson':
+            raise
+        return StdlibCodec()
+
+
+codec = get_codec(os.getenv('JSON_CODEC', 'auto').lower())
+logger.debug(f"JSON编解码器: {codec.name}")
+
+loads = codec.loads
+dumps = codec.dumps
+dumpb = codec.dumpb
@@ -0,0 +1,164 @@
+# sls_processor/log_utils.py
+
+"""
+热路径日志控制：
+
+- Sampler：逐条事件按 1/N 抽样输出，代替每条记录一行 INFO。
+- RateLimitedLogger：同一类告警/错误在窗口期内只输出一次，被抑制的条数附在下一次输出中。
+- LogSummaryReporter：按分片周期性输出汇总（入队速率、延迟、发送结果），数据取自 metrics。
+- setup_async_logging：日志经 QueueHandler 入队，由 QueueListener 在后台线程格式化并写出，
+  流水线线程不会阻塞在 stdout 上；队列满时丢弃并计数，而不是阻塞。
+"""
+
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from . import metrics
+
+# --- 日志控制配置 ---
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '1000'))
+LOG_RATE_LIMIT_SECONDS = float(os.getenv('LOG_RATE_LIMIT_SECONDS', '10'))
+LOG_SUMMARY_INTERVAL_SECONDS = float(os.getenv('LOG_SUMMARY_INTERVAL_SECONDS', '60'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+
+class Sampler:
+    """每 every 次调用返回一次 True；every 为 0 时始终返回 False。"""
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        self.every = max(0, every)
+        self._count = itertools.count()  # next() 在 GIL 下是原子的
+
+    def __call__(self) -> bool:
+        return self.every > 0 and next(self._count) % self.every == 0
+
+
+class RateLimitedLogger:
+    """按 key 限流的日志：窗口期内相同 key 的日志只输出第一条，其余计数。"""
+
+    def __init__(self, logger: logging.Logger, interval: float = LOG_RATE_LIMIT_SECONDS):
+        self.logger = logger
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._windows: Dict[str, list] = {}  # key -> [窗口开始时间, 被抑制条数]
+
+    def log(self, level: int, key: str, message: str, exc_info=None):
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None and now - window[0] < self.interval:
+                window[1] += 1
+                return
+            suppressed = window[1] if window is not None else 0
+            self._windows[key] = [now, 0]
+        if suppressed:
+            message = f"{message} (此前 {self.interval:.0f}s 内另有 {suppressed} 条同类日志被抑制)"
+        self.logger.log(level, message, exc_info=exc_info)
+
+    def warning(self, key: str, message: str):
+        self.log(logging.WARNING, key, message)
+
+    def error(self, key: str, message: str, exc_info=None):
+        self.log(logging.ERROR, key, message, exc_info=exc_info)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃日志并计数，保证调用线程永不阻塞。"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_async_logging(handler: logging.Handler, root: Optional[logging.Logger] = None,
+                        queue_size: int = LOG_QUEUE_SIZE) -> logging.handlers.QueueListener:
+    """把 handler 挂到后台 QueueListener 上，根日志器只保留一个非阻塞的 QueueHandler。"""
+    root = root or logging.getLogger()
+    queue_handler = _DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    root.addHandler(queue_handler)
+    listener.start()
+
+    def _stop():
+        listener.stop()  # 输出队列中剩余的日志
+        if queue_handler.dropped:
+            handler.handle(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"日志队列曾满，共丢弃 {queue_handler.dropped} 条日志"}))
+
+    atexit.register(_stop)
+    return listener
+
+
+class LogSummaryReporter:
+    """周期性输出分片和发送链路的汇总日志，代替逐条记录的 INFO 日志。"""
+
+    def __init__(self, interval: float = LOG_SUMMARY_INTERVAL_SECONDS, logger: Optional[logging.Logger] = None):
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._last: Dict[Tuple[str, ...], float] = {}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="LogSummary", daemon=True)
+
+    def start(self):
+        if self.interval > 0:
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _delta(self, name: str, key: Tuple[str, ...], value: float) -> float:
+        previous = self._last.get((name,) + key, 0)
+        self._last[(name,) + key] = value
+        return value - previous
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        lags = metrics.SHARD_LAG_SECONDS.values()
+        in_flight = metrics.SHARD_IN_FLIGHT.values()
+        for key, consumed in sorted(metrics.RECORDS_CONSUMED.values().items()):
+            delta = self._delta('consumed', key, consumed)
+            if key not in lags:
+                continue  # 分片已不再由本实例消费
+            self.logger.info(f"📊 分片 {key[0]}: 最近 {self.interval:.0f}s 入队 {delta:.0f} 条 "
+                             f"({delta / self.interval:.1f} 条/s), 延迟 {lags[key]:.1f}s, "
+                             f"在途 {in_flight.get(key, 0):.0f} 条")
+
+        sls_bytes = metrics.SLS_BYTES.values()
+        pulled = self._delta('sls_bytes', ('pulled',), sls_bytes.get(('pulled',), 0))
+        if pulled > 0:
+            received = self._delta('sls_bytes', ('received',), sls_bytes.get(('received',), 0))
+            forwarded = self._delta('sls_bytes', ('forwarded',), sls_bytes.get(('forwarded',), 0))
+            self.logger.info(f"📊 SLS: 最近 {self.interval:.0f}s 拉取 {pulled / 1e6:.1f}MB (服务端过滤前), "
+                             f"收到 {received / 1e6:.1f}MB ({received / pulled:.0%}), "
+                             f"放入队列 {forwarded / 1e6:.1f}MB ({forwarded / pulled:.0%})")
+
+        sent = metrics.RECORDS_SENT.values()
+        dead_letter = sum(metrics.DEAD_LETTER_RECORDS.values().values())
+        queue_bytes = metrics.QUEUE_BYTES.values()
+        high_water = metrics.QUEUE_BYTES_HIGH_WATER.values()
+        self.logger.info(
+            f"📊 发送: 成功 {self._delta('sent', ('success',), sent.get(('success',), 0)):.0f} 条, "
+            f"失败 {self._delta('sent', ('failed',), sent.get(('failed',), 0)):.0f} 条, "
+            f"重试 {self._delta('retries', (), metrics.RETRIES.values().get((), 0)):.0f} 条, "
+            f"死信 {self._delta('dead_letter', (), dead_letter):.0f} 条 | "
+            f"队列深度 {metrics.QUEUE_DEPTH.values().get((), 0):.0f} "
+            f"(内存 {queue_bytes.get(('memory',), 0) / 1e6:.1f}MB, 溢写 {queue_bytes.get(('spill',), 0) / 1e6:.1f}MB, "
+            f"高水位 {high_water.get(('memory',), 0) / 1e6:.1f}MB/{high_water.get(('spill',), 0) / 1e6:.1f}MB), "
+            f"并发上限 {metrics.CONCURRENCY_LIMIT.values().get((), 0):.0f}")
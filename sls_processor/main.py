@@ -1,10 +1,12 @@
 # sls_processor/main.py
     
 import logging
+import multiprocessing
 import os
+import signal
+import socket
 import threading
 import time
-from queue import Queue
 
 # --- ✨ 新增: 加载环境变量 和 JSON日志格式化器 ---
 from dotenv import load_dotenv
@@ -42,13 +44,21 @@ else:
     )
 
 logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
+# 格式化和 stdout 写入放到后台 QueueListener 线程，流水线线程只做非阻塞入队
+from .log_utils import LogSummaryReporter, setup_async_logging
+setup_async_logging(logHandler, logger)
 # --- JSON日志配置结束 ---
 
 from aliyun.log import LogClient
 from aliyun.log.consumer import CursorPosition, LogHubConfig
-from .consumer import start_sls_consumer_worker
+from .dedup import set_worker_index
+from .ingestion import EXPORT_PROTOCOL
+from .metrics import METRICS_PORT, start_metrics_server
 from .processor import process_logs_from_queue
+from .profiling import install_profiling
+from .pushdown import build_consumer_query
+from .sources import INPUT_SOURCE, Source, build_source
+from .spill_queue import SpillQueue
 
 # 阿里云 SLS 配置
 ENDPOINT = os.getenv("ALIYUN_ENDPOINT")
@@ -57,7 +67,23 @@ ACCESS_KEY_SECRET = os.getenv("ALIYUN_ACCESS_KEY_SECRET")
 PROJECT_NAME = os.getenv("ALIYUN_PROJECT_NAME")
 LOGSTORE_NAME = os.getenv("ALIYUN_LOGSTORE_NAME")
 CONSUMER_GROUP_NAME = os.getenv("ALIYUN_CONSUMER_GROUP_NAME")
-CONSUMER_NAME_PREFIX = 'realtime-processor'
+CONSUMER_NAME_PREFIX = os.getenv("CONSUMER_NAME_PREFIX", 'realtime-processor')
+# 显式指定时作为消费者名称的基础部分，否则使用 前缀-主机名
+CONSUMER_NAME = os.getenv("CONSUMER_NAME")
+
+# ConsumerWorker 调优 (与 SDK 默认值一致)
+SLS_HEARTBEAT_INTERVAL_SECONDS = int(os.getenv("SLS_HEARTBEAT_INTERVAL_SECONDS", '20'))
+SLS_DATA_FETCH_INTERVAL_SECONDS = float(os.getenv("SLS_DATA_FETCH_INTERVAL_SECONDS", '2'))
+SLS_MAX_FETCH_LOG_GROUP_SIZE = int(os.getenv("SLS_MAX_FETCH_LOG_GROUP_SIZE", '1000'))
+SLS_WORKER_POOL_SIZE = int(os.getenv("SLS_WORKER_POOL_SIZE", '2'))
+
+# 每个容器启动的工作进程数，每个进程是消费组中一个独立的消费者
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", '1'))
+WORKER_RESTART_DELAY_SECONDS = float(os.getenv("WORKER_RESTART_DELAY_SECONDS", '5'))
+WORKER_SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT_SECONDS", '90'))
+
+# 运行时模式: thread (默认，线程 + 发送线程池) 或 asyncio (事件循环 + 异步HTTP连接池)
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'thread').lower()
 
 
 def ensure_consumer_group(client, project, logstore, group_name):
@@ -72,35 +98,58 @@ def ensure_consumer_group(client, project, logstore, group_name):
             logger.error(f"创建消费组 '{group_name}' 失败: {e}")
             raise
 
-def main():
-    logger.info("🚀 应用启动...")
 
-    # 1. 创建用于线程间通信的共享队列
-    log_queue = Queue(maxsize=10000)  # 设置最大容量以防止内存无限增长
+def build_consumer_name(index: int) -> str:
+    """
+    同一主机上的第 index 个工作进程的消费者名称。主机名加序号在进程重启后保持不变，
+    SLS 在心跳超时前会把原来的分片继续分配给它；不同副本的名称互不相同，分片可以分散到各副本。
+    """
+    base = CONSUMER_NAME or f"{CONSUMER_NAME_PREFIX}-{os.environ.get('HOSTNAME') or socket.gethostname()}"
+    return f"{base}-{index}"
 
-    # 2. 创建用于通知子线程停止的事件
-    stop_event = threading.Event()
 
-    # 3. 准备SLS消费者配置
-    # --- ✨ 修复：使用固定的消费者名称 ---
-    consumer_name = f"{CONSUMER_NAME_PREFIX}-stable"  # 固定名称
-    # 或者基于容器ID或主机名：
-    # consumer_name = f"{CONSUMER_NAME_PREFIX}-{os.environ.get('HOSTNAME', 'default')}"
-    logger.info(f"本次消费者名称: {consumer_name}")
-    
-    client = LogClient(ENDPOINT, ACCESS_KEY_ID, ACCESS_KEY_SECRET)
-    ensure_consumer_group(client, PROJECT_NAME, LOGSTORE_NAME, CONSUMER_GROUP_NAME)
-    
-    config = LogHubConfig(
+def build_config(consumer_name: str) -> LogHubConfig:
+    return LogHubConfig(
         ENDPOINT, ACCESS_KEY_ID, ACCESS_KEY_SECRET,
         PROJECT_NAME, LOGSTORE_NAME, CONSUMER_GROUP_NAME,
-        consumer_name, cursor_position=CursorPosition.END_CURSOR
+        consumer_name, cursor_position=CursorPosition.END_CURSOR,
+        heartbeat_interval=SLS_HEARTBEAT_INTERVAL_SECONDS,
+        data_fetch_interval=SLS_DATA_FETCH_INTERVAL_SECONDS,
+        max_fetch_log_group_size=SLS_MAX_FETCH_LOG_GROUP_SIZE,
+        worker_pool_size=SLS_WORKER_POOL_SIZE,
+        query=build_consumer_query(),
     )
 
-    # 4. 在后台线程中启动SLS消费者 (生产者)
-    sls_worker = start_sls_consumer_worker(config, log_queue)
-    
-    # 5. 在另一个后台线程中启动Langfuse处理器 (消费者)
+
+def _install_stop_handler() -> threading.Event:
+    """
+    SIGINT (Ctrl+C) 和 docker stop / 启动器发送的 SIGTERM 只设置停止标志，
+    不在任意位置抛出异常，因此启动或停机过程中收到信号也不会被打断。
+    """
+    stop_requested = threading.Event()
+
+    def handler(signum, frame):
+        stop_requested.set()
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+    return stop_requested
+
+
+def run_threaded(input_source: Source):
+    """线程模式：输入源（SLS消费者线程或文件读取线程） → 队列 → 发送线程池，直到收到中断信号或文件读完。"""
+    stop_requested = _install_stop_handler()
+
+    # 1. 创建用于线程间通信的共享队列
+    log_queue = SpillQueue()  # 按条数和字节数限制内存占用，超出部分溢写到本地磁盘
+
+    # 2. 创建用于通知子线程停止的事件
+    stop_event = threading.Event()
+
+    # 3. 在后台线程中启动输入源 (生产者)
+    input_source.start(log_queue)
+
+    # 4. 在另一个后台线程中启动Langfuse处理器 (消费者)
     processor_thread = threading.Thread(
         target=process_logs_from_queue,
         args=(log_queue, stop_event),
@@ -108,20 +157,22 @@ def main():
     )
     processor_thread.start()
 
-    # 6. 主线程保持运行，并等待用户中断 (Ctrl+C)
+    # 5. 主线程保持运行，并等待中断 (Ctrl+C / SIGTERM)
     try:
-        while True:
-            time.sleep(1)
+        while not stop_requested.wait(1):
             if not processor_thread.is_alive():
                 logger.warning("Langfuse处理线程似乎已停止，正在退出应用...")
                 break
-    except KeyboardInterrupt:
-        logger.info("🛑 收到用户中断信号 (Ctrl+C)，开始关闭...")
+            if input_source.finished():
+                logger.info("📄 输入已全部读取，发送完毕后退出...")
+                break
+        else:
+            logger.info("🛑 收到中断信号，开始关闭...")
     finally:
         # --- 优雅停机流程 ---
-        logger.info("1/3 - 正在停止SLS消费者 (不再接收新日志)...")
-        sls_worker.shutdown()
-        
+        logger.info(f"1/3 - 正在停止输入源 {input_source.name} (不再接收新日志)...")
+        input_source.shutdown()
+
         logger.info("2/3 - 等待日志队列处理完毕...")
         while not log_queue.empty():
             logger.info(f"  ... 仍在处理，队列剩余: {log_queue.qsize()} 条")
@@ -136,7 +187,101 @@ def main():
         if processor_thread.is_alive():
             logger.warning("Langfuse处理器在超时后仍未退出。")
 
+        log_queue.close()
         logger.info("✅ 应用已成功关闭。")
 
+
+def run_worker(index: int):
+    """单个工作进程：独立的输入源（ConsumerWorker 或分到的文件）、队列和发送端。"""
+    consumer_name = build_consumer_name(index)
+    logger.info(f"🚀 工作进程 {index} 启动... (运行时模式: {PIPELINE_MODE}, 消费者名称: {consumer_name})")
+    # 多进程时每个工作进程使用 METRICS_PORT + 序号
+    start_metrics_server(port=METRICS_PORT + index if METRICS_PORT > 0 else 0)
+    install_profiling()
+    LogSummaryReporter().start()
+
+    input_source = build_source(build_config(consumer_name), index, WORKER_PROCESSES)
+    if WORKER_PROCESSES > 1:
+        set_worker_index(index)  # 各工作进程使用独立的去重状态文件
+    if PIPELINE_MODE == 'asyncio':
+        # asyncio 模式：发送端运行在事件循环中，输入源线程直接写入线程安全的队列
+        from .async_pipeline import run_async_pipeline
+        run_async_pipeline(input_source)
+    else:
+        run_threaded(input_source)
+
+
+def _worker_entry(index: int):
+    """子进程入口（spawn 方式启动，模块级的日志和环境变量配置会在子进程中重新执行）。"""
+    run_worker(index)
+
+
+def run_launcher(processes: int):
+    """
+    启动并守护 processes 个工作进程：意外退出的进程在延迟后以相同序号（即相同消费者名称）重启；
+    文件输入时正常退出的进程表示已读完分到的文件，不再重启，全部完成后启动器退出。
+    收到 SIGINT/SIGTERM 时向所有子进程发送 SIGTERM，等待它们提交检查点后退出。
+    """
+    ctx = multiprocessing.get_context('spawn')
+    stopping = threading.Event()
+
+    def request_stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def spawn(index: int):
+        process = ctx.Process(target=_worker_entry, args=(index,), name=f"sls-worker-{index}")
+        process.start()
+        logger.info(f"👷 工作进程 {index} 已启动 (pid {process.pid})")
+        return process
+
+    workers = {index: spawn(index) for index in range(processes)}
+    restart_at = {}
+    while workers and not stopping.wait(1):
+        for index, process in list(workers.items()):
+            if process.is_alive():
+                continue
+            if INPUT_SOURCE == 'file' and process.exitcode == 0:
+                logger.info(f"✅ 工作进程 {index} 已处理完分到的文件")
+                del workers[index]
+            elif index not in restart_at:
+                logger.warning(f"工作进程 {index} 已退出 (exit code {process.exitcode})，"
+                               f"{WORKER_RESTART_DELAY_SECONDS:.0f}s 后重启")
+                restart_at[index] = time.monotonic() + WORKER_RESTART_DELAY_SECONDS
+            elif time.monotonic() >= restart_at[index]:
+                del restart_at[index]
+                workers[index] = spawn(index)
+
+    logger.info(f"🛑 收到停止信号，正在关闭 {processes} 个工作进程...")
+    for process in workers.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT_SECONDS
+    for index, process in workers.items():
+        process.join(timeout=max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            logger.warning(f"工作进程 {index} 在超时后仍未退出，强制结束。")
+            process.kill()
+    logger.info("✅ 所有工作进程已关闭。")
+
+
+def main():
+    logger.info(f"🚀 应用启动... (工作进程数: {WORKER_PROCESSES})")
+
+    if INPUT_SOURCE == 'sls':
+        client = LogClient(ENDPOINT, ACCESS_KEY_ID, ACCESS_KEY_SECRET)
+        ensure_consumer_group(client, PROJECT_NAME, LOGSTORE_NAME, CONSUMER_GROUP_NAME)
+        if (query := build_consumer_query()):
+            logger.info(f"🔎 服务端过滤下推已启用: {query}")
+    if EXPORT_PROTOCOL != 'ingestion':
+        logger.info(f"📡 发送协议: {EXPORT_PROTOCOL}")
+
+    if WORKER_PROCESSES > 1:
+        run_launcher(WORKER_PROCESSES)
+    else:
+        run_worker(0)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,175 @@
+# sls_processor/mapping.py
+
+"""
+声明式字段映射：把 "源字段 → 目标路径 + 类型转换 + 空值丢弃" 的规则在启动时
+编译成一个单遍提取函数。每个源字段只读取、只转换一次，结果同时供 metadata
+和 convert_to_langfuse_format 的核心字段使用。
+
+标记了 "intern": true 的低基数字符串字段（method、route_name 等）经有界驻留池去重：
+相同的值返回同一个 str 对象，重试队列、汇总等处长时间持有的转换结果不再各自保存一份副本。
+"""
+
+import functools
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def bounded_interner(maxsize: int) -> Callable[[str], str]:
+    """有界驻留池：返回最近见过的相等字符串对象（LRU 淘汰，超出 maxsize 时最久未用的值被丢弃）。"""
+    @functools.lru_cache(maxsize=maxsize)
+    def intern(value: str) -> str:
+        return value
+    return intern
+
+
+def to_int(value: Any) -> Optional[int]:
+    """安全转换为整数：整数直接返回，字符串先试 int()，失败再走 float()。"""
+    if type(value) is int:
+        return value
+    if value is None or value == '' or value == '-':
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        try:
+            return int(float(value))
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+
+def to_float(value: Any) -> Optional[float]:
+    if value is None or value == '' or value == '-':
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+COERCERS = {
+    'str': None,  # 原样保留
+    'int': to_int,
+    'float': to_float,
+}
+
+# metadata 映射规则，顺序即输出顺序。from: log (SLS日志字段) / ai (ai_log 字段)
+DEFAULT_METADATA_MAPPING: List[Dict[str, Any]] = [
+    # 环境信息
+    {"source": "_namespace_", "from": "log", "target": "environment", "intern": True},
+    # 性能指标
+    {"source": "duration", "from": "log", "type": "int", "target": "performance.total_duration_ms"},
+    {"source": "llm_service_duration", "from": "ai", "type": "int", "target": "performance.llm_service_duration_ms"},
+    {"source": "upstream_service_time", "from": "log", "type": "int", "target": "performance.upstream_service_time_ms"},
+    {"source": "response_tx_duration", "from": "log", "type": "int", "target": "performance.response_tx_duration_ms"},
+    # 请求信息
+    {"source": "method", "from": "log", "target": "request.method", "intern": True},
+    {"source": "path", "from": "log", "target": "request.path"},
+    {"source": "original_path", "from": "log", "target": "request.original_path"},
+    {"source": "response_code", "from": "log", "type": "int", "target": "request.response_code"},
+    {"source": "response_code_details", "from": "log", "target": "request.response_code_details", "intern": True},
+    {"source": "user_agent", "from": "log", "target": "request.user_agent"},
+    {"source": "protocol", "from": "log", "target": "request.protocol", "intern": True},
+    {"source": "authority", "from": "log", "target": "request.authority", "intern": True},
+    # 基础设施信息
+    {"source": "_container_ip_", "from": "log", "target": "infrastructure.container_ip"},
+    {"source": "_namespace_", "from": "log", "target": "infrastructure.namespace", "intern": True},
+    {"source": "cluster_id", "from": "log", "target": "infrastructure.cluster_id", "intern": True},
+    {"source": "route_name", "from": "log", "target": "infrastructure.route_name", "intern": True},
+    {"source": "upstream_host", "from": "log", "target": "infrastructure.upstream_host"},
+    # 对话上下文
+    {"source": "api", "from": "ai", "target": "chat_context.api_full_name", "intern": True},
+    {"source": "chat_round", "from": "ai", "target": "chat_context.chat_round"},
+    {"source": "response_type", "from": "ai", "target": "chat_context.response_type", "intern": True},
+    {"source": "fallback_from", "from": "ai", "target": "chat_context.fallback_from", "intern": True},
+    # 网络传输
+    {"source": "bytes_sent", "from": "log", "type": "int", "target": "network.bytes_sent"},
+    {"source": "bytes_received", "from": "log", "type": "int", "target": "network.bytes_received"},
+    {"source": "downstream_remote_address", "from": "log", "target": "network.downstream_remote_address"},
+    {"source": "upstream_local_address", "from": "log", "target": "network.upstream_local_address"},
+    # 原始追踪信息
+    {"source": "trace_id", "from": "log", "target": "original_trace.sls_trace_id"},
+    {"source": "request_id", "from": "log", "target": "original_trace.request_id"},
+    {"source": "_time_", "from": "log", "target": "original_trace.log_time"},
+    {"source": "start_time", "from": "log", "target": "original_trace.start_time"},
+]
+
+
+def load_mapping_spec(path: Optional[str] = None) -> List[Dict[str, Any]]:
+    """读取 FIELD_MAPPING_FILE（JSON 列表）覆盖默认映射；未配置时返回默认映射。"""
+    path = path or os.getenv('FIELD_MAPPING_FILE')
+    if not path:
+        return DEFAULT_METADATA_MAPPING
+    with open(path, encoding='utf-8') as f:
+        spec = json.load(f)
+    logger.info(f"已加载自定义字段映射: {path} ({len(spec)} 条规则)")
+    return spec
+
+
+def compile_mapping(spec: List[Dict[str, Any]], fields: List[Tuple[str, str, str]] = (),
+                    interned: List[Tuple[str, str]] = (), intern: Optional[Callable[[str], str]] = None) -> Callable:
+    """
+    编译映射规则，返回 extract(log_get, ai_get) -> (values, metadata)。
+
+    fields 为调用方额外需要的 (from, source, type) 源字段，只读取不进 metadata；
+    values 以 "log.<key>" / "ai.<key>" 为键，只包含 fields 中的字段（缺失为 None）。
+    同一源字段在规则中出现多次时只读取一次，但类型必须一致。
+    给出 intern 时，interned 中的 (from, source) 和标记了 intern 的 str 字段的值经它去重。
+    """
+    sources = {}  # (from, source) -> type
+    for origin, source, type_ in [*fields, *((r.get('from', 'log'), r['source'], r.get('type', 'str')) for r in spec)]:
+        if origin not in ('log', 'ai'):
+            raise ValueError(f"字段映射 {source}: from 只能是 log 或 ai，而不是 {origin!r}")
+        if type_ not in COERCERS:
+            raise ValueError(f"字段映射 {source}: 不支持的类型 {type_!r}")
+        if sources.setdefault((origin, source), type_) != type_:
+            raise ValueError(f"字段映射 {origin}.{source} 的类型冲突: {sources[(origin, source)]} / {type_}")
+    interned = {*interned, *((r.get('from', 'log'), r['source']) for r in spec if r.get('intern'))} if intern else set()
+
+    names = {key: f"v{i}" for i, key in enumerate(sources)}
+    lines = ["def extract(log_get, ai_get):"]
+    for (origin, source), type_ in sources.items():
+        var = names[(origin, source)]
+        lines.append(f"    {var} = {origin}_get({source!r})")
+        if type_ == 'int':
+            # 快速路径：SLS 字段多为纯数字字符串，直接 int()，其余情况交给 to_int
+            lines.append(f"    {var} = int({var}) if {var}.__class__ is str and {var}.isdecimal() else int_({var})")
+        elif COERCERS[type_]:
+            lines.append(f"    {var} = {type_}_({var})")
+        elif (origin, source) in interned:
+            # ai_log 中的值可能是数字或嵌套对象，只驻留字符串
+            lines.append(f"    if {var}.__class__ is str: {var} = intern_({var})")
+
+    groups = {}  # 一级目标 -> [(二级目标或 None, 变量名, drop_if_empty)]
+    for rule in spec:
+        head, _, tail = rule['target'].partition('.')
+        groups.setdefault(head, []).append(
+            (tail or None, names[(rule.get('from', 'log'), rule['source'])], rule.get('drop_if_empty', True)))
+
+    lines.append("    metadata = {}")
+    for head, entries in groups.items():
+        if any(tail is None for tail, _, _ in entries) and len(entries) > 1:
+            raise ValueError(f"字段映射目标 {head!r} 不能同时作为值和嵌套对象")
+        if entries[0][0] is None:
+            _, var, drop = entries[0]
+            lines.append(f"    if {var}: metadata[{head!r}] = {var}" if drop else f"    metadata[{head!r}] = {var}")
+            continue
+        lines.append("    sub = {}")
+        for tail, var, drop in entries:
+            lines.append(f"    if {var}: sub[{tail!r}] = {var}" if drop else f"    sub[{tail!r}] = {var}")
+        lines.append("    if sub:")
+        lines.append(f"        metadata[{head!r}] = sub")
+
+    values = ", ".join(f"{f'{origin}.{source}'!r}: {names[(origin, source)]}" for origin, source, _ in fields)
+    lines.append(f"    return {{{values}}}, metadata")
+
+    source_code = "\n".join(lines)
+    namespace = {f"{name}_": fn for name, fn in COERCERS.items() if fn}
+    namespace["intern_"] = intern
+    exec(compile(source_code, "<field-mapping>", "exec"), namespace)
+    extract = namespace["extract"]
+    extract.__source__ = source_code
+    return extract
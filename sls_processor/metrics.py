@@ -0,0 +1,361 @@
+# sls_processor/metrics.py
+
+"""
+轻量的 Prometheus 指标，以文本格式 (text/plain; version=0.0.4) 在本地 HTTP 端口暴露。
+
+- 计数器和直方图按线程分片：每个线程只写自己的计数单元，热路径上不加锁、不分配对象，
+  抓取时再把各线程的单元求和。
+- 仪表盘 (Gauge) 可以直接 set，也可以绑定一个函数，在抓取时取值（队列深度、熔断状态等）。
+"""
+
+import bisect
+import ipaddress
+import logging
+import os
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- 指标端点配置 (METRICS_PORT=0 表示不启动) ---
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _ThreadCells:
+    """每个线程一个定长计数单元（list），写入只触及本线程的单元。"""
+    __slots__ = ('_local', '_cells', '_size')
+
+    def __init__(self, size: int):
+        self._local = threading.local()
+        self._cells: List[list] = []
+        self._size = size
+
+    def cell(self) -> list:
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * self._size
+            self._cells.append(cell)  # list.append 在 GIL 下是原子的
+            return cell
+
+    def totals(self) -> list:
+        totals = [0] * self._size
+        for cell in list(self._cells):
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class _CounterChild:
+    __slots__ = ('_cells',)
+
+    def __init__(self):
+        self._cells = _ThreadCells(1)
+
+    def inc(self, amount: float = 1):
+        self._cells.cell()[0] += amount
+
+    def value(self) -> float:
+        return self._cells.totals()[0]
+
+
+class _GaugeChild:
+    __slots__ = ('_value', '_function')
+
+    def __init__(self):
+        self._value = 0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """抓取时调用 function 取值。"""
+        self._function = function
+
+    def value(self) -> float:
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception:
+                return float('nan')
+        return self._value
+
+
+class _HistogramChild:
+    __slots__ = ('_bounds', '_cells')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._bounds = bounds
+        # 单元布局：[各桶计数..., +Inf 桶计数, 观测值之和]
+        self._cells = _ThreadCells(len(bounds) + 2)
+
+    def observe(self, value: float):
+        cell = self._cells.cell()
+        cell[bisect.bisect_left(self._bounds, value)] += 1
+        cell[-1] += value
+
+    def totals(self) -> list:
+        return self._cells.totals()
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional['Registry'] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+        (registry or REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values) -> object:
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        """各标签组合的当前值（计数器和仪表盘），供汇总日志使用。"""
+        return {key: child.value() for key, child in list(self._children.items())}
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(value) for value in values), None)
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        for key, child in list(self._children.items()):
+            lines.extend(self._samples(key, child))
+        return lines
+
+    def _samples(self, key, child) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value())}']
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default.set_function(function)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Optional['Registry'] = None):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _samples(self, key, child) -> List[str]:
+        totals = child.totals()
+        lines, cumulative = [], 0
+        for bound, count in zip(self.bounds + (float('inf'),), totals):
+            cumulative += count
+            le = f'le="{_format_value(bound)}"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(totals[-1])}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+REGISTRY = Registry()
+
+# --- SLS 消费 ---
+RECORDS_CONSUMED = Counter('sls_langfuse_records_consumed_total', '从SLS拉取并放入队列的记录数', ['shard'])
+SHARD_LAG_SECONDS = Gauge('sls_langfuse_shard_lag_seconds', '分片最近一批日志的时间与当前时间之差（秒）', ['shard'])
+SLS_BYTES = Counter('sls_langfuse_sls_bytes_total', 'SLS 日志字节数：pulled=服务端过滤前的, received=实际收到的, forwarded=放入队列的', ['stage'])
+SHARD_IN_FLIGHT = Gauge('sls_langfuse_shard_in_flight_records', '分片已入队但尚未确认的记录数', ['shard'])
+CHECKPOINT_COMMIT_SECONDS = Histogram('sls_langfuse_checkpoint_commit_seconds', '检查点提交耗时（秒）')
+CHECKPOINT_FAILURES = Counter('sls_langfuse_checkpoint_failures_total', '重试后仍失败的检查点提交次数', ['shard'])
+
+# --- 队列与转换 ---
+QUEUE_DEPTH = Gauge('sls_langfuse_queue_depth', '消费端与发送端之间队列中的记录数')
+QUEUE_BYTES = Gauge('sls_langfuse_queue_bytes', '队列中记录的字节数：memory=内存, spill=溢写文件', ['area'])
+QUEUE_BYTES_HIGH_WATER = Gauge('sls_langfuse_queue_bytes_high_water', '进程启动以来队列字节数的最高值', ['area'])
+QUEUE_SPILLED_RECORDS = Counter('sls_langfuse_queue_spilled_records_total', '因内存超限溢写到本地文件的记录数')
+TRANSFORM_SECONDS = Histogram('sls_langfuse_transform_seconds', '每批记录转换为Langfuse格式的耗时（秒）')
+BATCH_SIZE = Histogram('sls_langfuse_batch_size', '每个发送批次的记录数', buckets=BATCH_SIZE_BUCKETS)
+TRANSFORM_CACHE = Gauge('sls_langfuse_transform_cache', '转换缓存：hits/misses 为累计查找次数，size 为当前条目数', ['cache', 'stat'])
+PAYLOAD_BYTES_SAVED = Histogram('sls_langfuse_payload_bytes_saved', '载荷整形（截断、去重）为每条被整形的记录节省的字节数',
+                                buckets=BYTES_BUCKETS)
+PAYLOAD_TRUNCATED = Counter('sls_langfuse_payload_truncated_total', '被截断的正文字段数', ['field'])
+
+# --- trace 聚合 ---
+TRACE_AGGREGATION_BUFFERED = Gauge('sls_langfuse_trace_aggregation_buffered_records', '聚合窗口中缓冲的记录数')
+TRACE_UPSERTS_MERGED = Counter('sls_langfuse_trace_upserts_merged_total', '同一 trace 的记录合并发送后省去的 trace-create 数')
+
+# --- 公平调度 ---
+SCHEDULER_BACKLOG = Gauge('sls_langfuse_scheduler_backlog_records', '公平调度中各键等待发送的记录数', ['key'])
+SCHEDULER_OLDEST_SECONDS = Gauge('sls_langfuse_scheduler_oldest_seconds', '公平调度中各键最早一条记录已等待的时间（秒）', ['key'])
+SCHEDULER_DISPATCHED = Counter('sls_langfuse_scheduler_dispatched_total', '公平调度交给发送端的记录数', ['key', 'priority'])
+
+# --- 窗口汇总 ---
+ROLLUP_RECORDS = Counter('sls_langfuse_rollup_records_total', '窗口汇总的记录数：observed=已统计, late=迟到, dropped=积压时丢弃', ['result'])
+ROLLUP_EMITTED = Counter('sls_langfuse_rollup_emitted_total', '输出的汇总记录数（按 sink），failed 为输出失败的次数', ['sink'])
+
+# --- 发送去重 ---
+DEDUP_LOOKUPS = Counter('sls_langfuse_dedup_lookups_total', '发送去重的查找结果（hit/miss）', ['result'])
+
+# --- 发送 ---
+SEND_SECONDS = Histogram('sls_langfuse_send_seconds', '每批发送到Langfuse的耗时（秒）')
+EXPORT_BYTES = Counter('sls_langfuse_export_bytes_total', '发送请求体字节数（压缩后），按发送协议', ['protocol'])
+RECORDS_SENT = Counter('sls_langfuse_records_sent_total', '发送结果按记录计数', ['result'])
+RETRIES = Counter('sls_langfuse_retries_total', '重试发送的记录数')
+DEAD_LETTER_RECORDS = Counter('sls_langfuse_dead_letter_records_total', '写入死信存储的记录数', ['reason'])
+DEAD_LETTER_REPLAYED = Counter('sls_langfuse_dead_letter_replayed_total', '从死信存储回放的记录数', ['result'])
+STAGE_SECONDS = Histogram('sls_langfuse_stage_seconds', '阶段计时：抽样记录在相邻阶段之间的耗时（秒），total 为拉取到确认', ['stage'])
+CIRCUIT_STATE = Gauge('sls_langfuse_circuit_state', '熔断器状态：0=关闭 1=半开 2=打开')
+CONCURRENCY_LIMIT = Gauge('sls_langfuse_concurrency_limit', '自适应并发的当前上限')
+
+_SENT_SUCCESS = RECORDS_SENT.labels('success')
+_SENT_FAILED = RECORDS_SENT.labels('failed')
+
+
+def record_send(latency: float, succeeded: int, failed: int):
+    """一个批次发送完成后调用：延迟和结果计数。"""
+    SEND_SECONDS.observe(latency)
+    if succeeded:
+        _SENT_SUCCESS.inc(succeeded)
+    if failed:
+        _SENT_FAILED.inc(failed)
+
+
+def watch_resilience(breaker, limiter):
+    """把熔断器和并发限制器的状态绑定为抓取时取值的仪表盘。"""
+    from .resilience import HALF_OPEN, OPEN
+    CIRCUIT_STATE.set_function(lambda: {OPEN: 2, HALF_OPEN: 1}.get(breaker.state, 0))
+    CONCURRENCY_LIMIT.set_function(lambda: limiter.limit)
+
+
+# 指标端点上的附加路由：路径 -> handler(查询参数) -> (Content-Type, 响应体)
+_debug_routes: Dict[str, Callable[[Dict[str, str]], Tuple[str, bytes]]] = {}
+
+
+def register_debug_route(path: str, handler: Callable[[Dict[str, str]], Tuple[str, bytes]]):
+    """注册调试端点；只响应来自本机回环地址的请求，其他来源返回 404。"""
+    _debug_routes[path] = handler
+
+
+def _is_loopback(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host.split('%', 1)[0])
+    except ValueError:
+        return False
+    if getattr(address, 'ipv4_mapped', None) is not None:
+        address = address.ipv4_mapped
+    return address.is_loopback
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path in _debug_routes and _is_loopback(self.client_address[0]):
+            try:
+                content_type, body = _debug_routes[path](dict(urllib.parse.parse_qsl(query)))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+        elif path in ('/metrics', '/'):
+            content_type, body = CONTENT_TYPE, REGISTRY.render()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """在后台线程启动 /metrics 端点；port 为 0 时不启动。"""
+    if port <= 0:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.error(f"❌ 指标端点启动失败 ({host}:{port}): {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    logger.info(f"📈 指标端点已启动: http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,356 @@
+# sls_processor/otlp.py
+
+"""
+OTLP/HTTP 导出：把转换结果直接编码为 OpenTelemetry span (protobuf，默认 gzip 压缩)，
+发送到 Langfuse 的 OTLP 接口 (/api/public/otel/v1/traces) 或任意 OTLP collector。
+
+与摄取接口的对应关系：同一批次中 trace_id 相同的记录合并为一个根 span（名称、输入、用户等取自最早一条，
+输出取自最晚一条，tags 取并集），每条记录是其下的一个 generation span。属性同时写 GenAI 语义约定
+(gen_ai.*) 和 Langfuse 的 langfuse.* 属性，collector 和 Langfuse 都能识别。
+
+- trace_id 为 32 位十六进制时直接作为 OTLP trace id（Langfuse 中的 trace id 与摄取接口相同），否则取其摘要。
+- span id 由 trace_id/request_id/start_time 派生，重试和重复投递覆盖同一个 span，不会产生重复的 generation。
+- OTLP 没有逐条结果：HTTP 200 时整批成功（partial_success 中被拒绝的 span 按规范不重试，只记录日志），
+  其他状态整批失败。
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import (
+    ExportTraceServiceRequest, ExportTraceServiceResponse,
+)
+from opentelemetry.proto.trace.v1.trace_pb2 import Span, Status
+
+from . import jsoncodec, metrics
+from .dedup import dedup_key
+from .ingestion import HEALTH_PATH, _parse_start_time, _trace_id
+from .log_utils import RateLimitedLogger
+from .payload import get_payload_shaper
+from .resilience import SendResults
+
+logger = logging.getLogger(__name__)
+limited_logger = RateLimitedLogger(logger)
+
+# --- OTLP 导出配置 ---
+OTLP_ENDPOINT = os.getenv('OTLP_ENDPOINT', '')  # 为空时使用 LANGFUSE_HOST 的 OTLP 接口
+OTLP_HEADERS = os.getenv('OTLP_HEADERS', '')  # k=v,k2=v2，值可 URL 编码
+OTLP_COMPRESSION = os.getenv('OTLP_COMPRESSION', 'gzip').lower()  # gzip / none
+OTLP_GZIP_LEVEL = int(os.getenv('OTLP_GZIP_LEVEL', '1'))  # 1 的压缩率接近 6，CPU 约为一半
+OTLP_SERVICE_NAME = os.getenv('OTLP_SERVICE_NAME', 'sls-to-langfuse')
+
+LANGFUSE_OTLP_PATH = "/api/public/otel/v1/traces"
+CONTENT_TYPE = "application/x-protobuf"
+SCOPE_NAME = "sls_processor"
+
+
+def parse_headers(spec: str) -> Dict[str, str]:
+    """解析 OTEL_EXPORTER_OTLP_HEADERS 格式的 "k=v,k2=v2"。"""
+    headers = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        key, sep, value = part.partition('=')
+        if not sep or not key.strip():
+            raise ValueError(f"无效的 OTLP_HEADERS 项 {part!r}，格式应为 键=值")
+        headers[key.strip()] = urllib.parse.unquote(value.strip())
+    return headers
+
+
+def otlp_trace_id(trace_id: str) -> bytes:
+    """32 位十六进制的 trace_id 原样转为 16 字节，其他格式取摘要。"""
+    if len(trace_id) == 32:
+        try:
+            return bytes.fromhex(trace_id)
+        except ValueError:
+            pass
+    return hashlib.blake2b(trace_id.encode('utf-8'), digest_size=16).digest()
+
+
+def _root_span_id(trace_id: str) -> bytes:
+    return hashlib.blake2b(trace_id.encode('utf-8'), digest_size=8, person=b'root').digest()
+
+
+def _generation_span_id(data: Dict[str, Any]) -> bytes:
+    key = dedup_key(data)
+    return key[:8] if key is not None else os.urandom(8)
+
+
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+_UINT64_MAX = 2 ** 64 - 1
+
+
+def _set(attributes, key: str, value: Any):
+    """按值的类型写入一个属性；None 和空字符串不写，dict 等写为 JSON 字符串。"""
+    if value is None or value == '':
+        return
+    attribute = attributes.add()
+    attribute.key = key
+    kind = type(value)
+    if kind is str:
+        attribute.value.string_value = value
+    elif kind is int:
+        if _INT64_MIN <= value <= _INT64_MAX:
+            attribute.value.int_value = value
+        else:
+            attribute.value.string_value = str(value)  # int_value 是 int64
+    elif kind is bool:
+        attribute.value.bool_value = value
+    elif kind is float:
+        attribute.value.double_value = value
+    elif kind is list and all(type(item) is str for item in value):
+        values = attribute.value.array_value.values
+        for item in value:
+            values.add().string_value = item
+    else:
+        attribute.value.string_value = jsoncodec.dumps(value)
+
+
+def _timing(data: Dict[str, Any]) -> Tuple[Optional[int], int]:
+    """由 start_time 和 performance.total_duration_ms 得到 (开始, 结束) 纳秒；没有开始时间时为 (None, 0)。"""
+    start = _parse_start_time(data.get('start_time'))
+    if start is None:
+        return None, 0
+    start_ns = int(start.timestamp() * 1_000_000) * 1000
+    duration = (data.get('metadata') or {}).get('performance', {}).get('total_duration_ms')
+    if isinstance(duration, int) and 0 <= duration and start_ns + duration * 1_000_000 <= _UINT64_MAX:
+        return start_ns, start_ns + duration * 1_000_000
+    return start_ns, start_ns
+
+
+def _add_generation(spans, data: Dict[str, Any], trace_id: bytes, parent_id: bytes, timing: Tuple[int, int]):
+    span = spans.add()
+    span.trace_id = trace_id
+    span.span_id = _generation_span_id(data)
+    span.parent_span_id = parent_id
+    span.name = data.get('generation_name', 'AI Generation')
+    span.kind = Span.SPAN_KIND_CLIENT
+    span.start_time_unix_nano, span.end_time_unix_nano = timing
+
+    attributes = span.attributes
+    model = data.get('model')
+    usage = data.get('usage_details') or {}
+    _set(attributes, 'langfuse.observation.type', 'generation')
+    _set(attributes, 'gen_ai.operation.name', 'chat')
+    _set(attributes, 'gen_ai.request.model', model)  # Langfuse 据此识别模型和用量，不再重复写 langfuse.* 属性
+    _set(attributes, 'gen_ai.usage.input_tokens', usage.get('input'))
+    _set(attributes, 'gen_ai.usage.output_tokens', usage.get('output'))
+    if usage.keys() - {'input', 'output'}:
+        _set(attributes, 'langfuse.observation.usage_details', usage)
+    _set(attributes, 'langfuse.observation.input', data.get('generation_input'))
+    _set(attributes, 'langfuse.observation.output', data.get('generation_output'))
+    level = data.get('level', 'DEFAULT')
+    _set(attributes, 'langfuse.observation.level', level)
+    _set(attributes, 'langfuse.observation.status_message', data.get('status_message'))
+    _set(attributes, 'langfuse.observation.metadata', data.get('generation_metadata', data.get('metadata')))
+    if level == 'ERROR':
+        span.status.code = Status.STATUS_CODE_ERROR
+        span.status.message = data.get('status_message', '')
+
+
+def _add_trace(spans, group: List[Dict[str, Any]], trace_id: str, now_ns: int):
+    """一个 trace 的根 span 和各条记录的 generation span，合并规则与 build_trace_events 一致。"""
+    timings = [_timing(data) for data in group]
+    order = sorted(range(len(group)), key=lambda i: (timings[i][0] is None, timings[i][0] or 0, i))
+    first, last = group[order[0]], group[order[-1]]
+    timings = [(start, end) if start is not None else (now_ns, now_ns) for start, end in timings]
+
+    root = spans.add()
+    root.trace_id = otlp_id = otlp_trace_id(trace_id)
+    root.span_id = root_id = _root_span_id(trace_id)
+    root.name = first.get('trace_name', 'AI Request')
+    root.kind = Span.SPAN_KIND_SERVER
+    root.start_time_unix_nano = min(start for start, _ in timings)
+    root.end_time_unix_nano = max(end for _, end in timings)
+
+    output = first.get('trace_output')
+    tags = first.get('tags', [])
+    metadata = first.get('metadata', {})
+    if len(group) > 1:
+        if last.get('trace_output') is not None:
+            output = last.get('trace_output')
+        tags = list(tags)
+        for data in group:
+            tags.extend(tag for tag in data.get('tags', []) if tag not in tags)
+        metadata = {**(metadata or {}), "aggregation": {"generations": len(group)}}
+    attributes = root.attributes
+    _set(attributes, 'langfuse.trace.name', root.name)
+    _set(attributes, 'langfuse.trace.input', first.get('trace_input'))
+    _set(attributes, 'langfuse.trace.output', output)
+    _set(attributes, 'langfuse.user.id', first.get('user_id'))
+    _set(attributes, 'langfuse.session.id', first.get('session_id'))
+    if tags:
+        _set(attributes, 'langfuse.trace.tags', tags)
+    _set(attributes, 'langfuse.trace.metadata', metadata)
+
+    for data, timing in zip(group, timings):
+        _add_generation(spans, data, otlp_id, root_id, timing)
+
+
+def encode_request(payloads: List[Dict[str, Any]]) -> Tuple[Optional[bytes], SendResults, int]:
+    """
+    组装一次 OTLP 导出请求：返回 (未压缩的请求体, 初始结果列表, span 数)。
+    缺少 sls_trace_id 的记录标记为失败；请求体为 None 表示无需发送。载荷整形与摄取接口相同。
+    """
+    shaper = get_payload_shaper()
+    groups: Dict[str, List[int]] = {}
+    results = SendResults([True] * len(payloads))
+    for index, data in enumerate(payloads):
+        trace_id = _trace_id(data)
+        if not trace_id:
+            limited_logger.warning('missing_trace_id', "在日志中未找到有效的sls_trace_id，已跳过发送。")
+            results[index] = False
+            results.rejected.add(index)
+            continue
+        if shaper.enabled:
+            shaper.shape(data)
+        groups.setdefault(trace_id, []).append(index)
+    if not groups:
+        return None, results, 0
+
+    request = ExportTraceServiceRequest()
+    resource_spans = request.resource_spans.add()
+    _set(resource_spans.resource.attributes, 'service.name', OTLP_SERVICE_NAME)
+    scope_spans = resource_spans.scope_spans.add()
+    scope_spans.scope.name = SCOPE_NAME
+    spans = scope_spans.spans
+    now_ns = time.time_ns()
+    for trace_id, indexes in groups.items():
+        _add_trace(spans, [payloads[index] for index in indexes], trace_id, now_ns)
+        if len(indexes) > 1:
+            metrics.TRACE_UPSERTS_MERGED.inc(len(indexes) - 1)
+    return request.SerializeToString(), results, len(spans)
+
+
+def encode_body(payloads: List[Dict[str, Any]], compression: str = OTLP_COMPRESSION):
+    """encode_request 并按 compression 压缩，返回 (请求体, 初始结果列表, span 数)。"""
+    body, results, spans = encode_request(payloads)
+    if body is None:
+        return None, results, spans
+    if compression == 'gzip':
+        body = gzip.compress(body, compresslevel=OTLP_GZIP_LEVEL)
+    metrics.EXPORT_BYTES.labels('otlp').inc(len(body))
+    return body, results, spans
+
+
+def _rejected_spans(response: httpx.Response) -> Tuple[int, str]:
+    """读取响应中的 partial_success；接收端可能返回 protobuf 或 JSON，无法解析时视为全部接受。"""
+    if not response.content:
+        return 0, ''
+    try:
+        if 'json' in response.headers.get('content-type', ''):
+            partial = jsoncodec.loads(response.content).get('partialSuccess') or {}
+            return int(partial.get('rejectedSpans', 0)), partial.get('errorMessage', '')
+        partial = ExportTraceServiceResponse.FromString(response.content).partial_success
+        return partial.rejected_spans, partial.error_message
+    except Exception:
+        return 0, ''
+
+
+def apply_response(response: httpx.Response, results: SendResults, spans: int) -> SendResults:
+    if response.status_code != 200:
+        limited_logger.error('otlp_status', f"OTLP 导出失败 ({len(results)} 条): "
+                                            f"HTTP {response.status_code} {response.text[:200]}")
+        return SendResults.failed(len(results))
+    rejected, message = _rejected_spans(response)
+    if rejected:
+        limited_logger.warning('otlp_rejected', f"OTLP 接收端拒绝了 {rejected}/{spans} 个 span: {message}")
+    return results
+
+
+def _exporter_options(endpoint: Optional[str], public_key: Optional[str], secret_key: Optional[str],
+                      max_connections: int, timeout: Optional[float], compression: str):
+    """返回 (导出地址, 健康检查地址, httpx 客户端参数)；自定义 endpoint 时不带 Langfuse 凭证，也没有健康检查。"""
+    endpoint = endpoint if endpoint is not None else OTLP_ENDPOINT
+    if compression not in ('gzip', 'none'):
+        raise ValueError(f"无效的 OTLP_COMPRESSION={compression!r}，可选值: gzip, none")
+    headers = {"Content-Type": CONTENT_TYPE, **parse_headers(OTLP_HEADERS)}
+    if compression == 'gzip':
+        headers["Content-Encoding"] = "gzip"
+    options = dict(
+        timeout=timeout or float(os.environ.get('LANGFUSE_SDK_TIMEOUT', '30')),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        headers=headers,
+    )
+    if endpoint:
+        return endpoint, None, options
+    host = os.environ.get('LANGFUSE_HOST', 'http://localhost:3000').rstrip('/')
+    options['auth'] = (public_key or os.environ.get('LANGFUSE_PUBLIC_KEY', ''),
+                       secret_key or os.environ.get('LANGFUSE_SECRET_KEY', ''))
+    return f"{host}{LANGFUSE_OTLP_PATH}", f"{host}{HEALTH_PATH}", options
+
+
+class OtlpExporter:
+    """
+    OTLP/HTTP (protobuf) 发送客户端，接口与 LangfuseIngestionClient 相同：
+    send_batch 返回与 payloads 对齐的成功标记，线程安全，可被多个发送线程共享。
+    """
+
+    def __init__(self, endpoint: Optional[str] = None, public_key: Optional[str] = None,
+                 secret_key: Optional[str] = None, max_connections: int = 10,
+                 timeout: Optional[float] = None, compression: str = OTLP_COMPRESSION):
+        self.url, self.health_url, options = _exporter_options(
+            endpoint, public_key, secret_key, max_connections, timeout, compression)
+        self.host = self.url
+        self.compression = compression
+        self.client = httpx.Client(**options)
+
+    def send_batch(self, payloads: List[Dict[str, Any]]) -> SendResults:
+        if not payloads:
+            return SendResults()
+        body, results, spans = encode_body(payloads, self.compression)
+        if body is None:
+            return results
+        try:
+            response = self.client.post(self.url, content=body)
+        except httpx.HTTPError as e:
+            limited_logger.error('otlp_transport', f"OTLP 导出失败 ({len(payloads)} 条): {e}")
+            return SendResults.failed(len(payloads))
+        return apply_response(response, results, spans)
+
+    def health(self) -> bool:
+        """导出到 Langfuse 时检查其健康接口；自定义 collector 没有统一的健康接口，视为健康。"""
+        if self.health_url is None:
+            return True
+        try:
+            return self.client.get(self.health_url, timeout=5).status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncOtlpExporter:
+    """OtlpExporter 的 asyncio 版本。"""
+
+    def __init__(self, endpoint: Optional[str] = None, public_key: Optional[str] = None,
+                 secret_key: Optional[str] = None, max_connections: int = 32,
+                 timeout: Optional[float] = None, compression: str = OTLP_COMPRESSION):
+        self.url, self.health_url, options = _exporter_options(
+            endpoint, public_key, secret_key, max_connections, timeout, compression)
+        self.host = self.url
+        self.compression = compression
+        self.client = httpx.AsyncClient(**options)
+
+    async def send_batch(self, payloads: List[Dict[str, Any]]) -> SendResults:
+        if not payloads:
+            return SendResults()
+        body, results, spans = encode_body(payloads, self.compression)
+        if body is None:
+            return results
+        try:
+            response = await self.client.post(self.url, content=body)
+        except httpx.HTTPError as e:
+            limited_logger.error('otlp_transport', f"OTLP 导出失败 ({len(payloads)} 条): {e}")
+            return SendResults.failed(len(payloads))
+        return apply_response(response, results, spans)
+
+    async def close(self):
+        await self.client.aclose()
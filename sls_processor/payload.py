@@ -0,0 +1,182 @@
+# sls_processor/payload.py
+
+"""
+发送前的载荷整形：控制每条记录发往 Langfuse 的字节数。
+
+- 截断：question/answer 和 metadata 中的长字符串超过上限时保留头部和尾部，中间替换为标记。
+- 转存：配置了 PAYLOAD_OFFLOAD_DIR 时，被截断的原文按内容哈希写入本地目录（可挂载对象存储），
+  截断标记和 metadata.payload_offload 中记录引用，原文不丢失。
+- 去重：convert_to_langfuse_format 把 question/answer 同时放在 trace 和 generation 上、
+  metadata 也发送两次；PAYLOAD_DEDUP=trace|generation 时正文只保留在指定的一方，
+  metadata 只保留在 trace 上（trace 级筛选依赖它）。
+
+整形在组装批量请求时原地进行，且是幂等的：重试时再次整形不会重复截断，也不会重复计入节省的字节数。
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from . import jsoncodec, metrics
+
+logger = logging.getLogger(__name__)
+
+# --- 载荷整形配置 (上限按字符数，0 表示不限制) ---
+PAYLOAD_MAX_INPUT_CHARS = int(os.getenv('PAYLOAD_MAX_INPUT_CHARS', '0'))
+PAYLOAD_MAX_OUTPUT_CHARS = int(os.getenv('PAYLOAD_MAX_OUTPUT_CHARS', '0'))
+PAYLOAD_MAX_METADATA_VALUE_CHARS = int(os.getenv('PAYLOAD_MAX_METADATA_VALUE_CHARS', '0'))
+PAYLOAD_TRUNCATE_HEAD_RATIO = float(os.getenv('PAYLOAD_TRUNCATE_HEAD_RATIO', '0.7'))
+PAYLOAD_DEDUP = os.getenv('PAYLOAD_DEDUP', 'off').lower()  # off / trace / generation
+PAYLOAD_OFFLOAD_DIR = os.getenv('PAYLOAD_OFFLOAD_DIR', '')
+
+DEDUP_MODES = ('off', 'trace', 'generation')
+MIN_TRUNCATE_CHARS = 256  # 上限至少要放得下截断标记
+
+
+def _utf8_len(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+def truncate_text(text: str, limit: int, head_ratio: float = PAYLOAD_TRUNCATE_HEAD_RATIO,
+                  ref: Optional[str] = None) -> str:
+    """
+    超过 limit 个字符时保留头部和尾部（按 head_ratio 分配），中间插入截断标记；
+    结果（含标记）不超过 limit，因此对已截断的文本再次调用不会改变它。
+    """
+    if limit <= 0 or len(text) <= limit:
+        return text
+    keep = limit
+    while True:
+        marker = f"\n…[已截断 {len(text) - keep} 字符{f', 原文 {ref}' if ref else ''}]…\n"
+        if keep + len(marker) <= limit or keep == 0:
+            break
+        keep = max(0, limit - len(marker))
+    head = int(keep * head_ratio)
+    tail = keep - head
+    return text[:head] + marker + (text[-tail:] if tail else '')
+
+
+class ContentStore:
+    """按 sha256 寻址的原文存储：<dir>/<前两位>/<哈希>.txt，相同内容只写一次。"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, text: str) -> str:
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.directory, digest[:2], f"{digest}.txt")
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)  # 原子落盘，并发写入同一内容也安全
+        return f"sha256:{digest}"
+
+
+class PayloadShaper:
+    """按配置截断、转存和去重一条 convert_to_langfuse_format 的结果。"""
+
+    def __init__(self, max_input_chars: int = PAYLOAD_MAX_INPUT_CHARS,
+                 max_output_chars: int = PAYLOAD_MAX_OUTPUT_CHARS,
+                 max_metadata_value_chars: int = PAYLOAD_MAX_METADATA_VALUE_CHARS,
+                 head_ratio: float = PAYLOAD_TRUNCATE_HEAD_RATIO, dedup: str = PAYLOAD_DEDUP,
+                 store: Optional[ContentStore] = None):
+        if dedup not in DEDUP_MODES:
+            logger.warning(f"⚠️ 无效的 PAYLOAD_DEDUP={dedup!r}，可选值: {', '.join(DEDUP_MODES)}，已按 off 处理")
+            dedup = 'off'
+        self.limits = {'input': self._clamp(max_input_chars), 'output': self._clamp(max_output_chars)}
+        self.max_metadata_value_chars = self._clamp(max_metadata_value_chars)
+        self.head_ratio = min(1.0, max(0.0, head_ratio))
+        self.dedup = dedup
+        self.store = store
+        self.enabled = bool(max_input_chars > 0 or max_output_chars > 0 or max_metadata_value_chars > 0
+                            or dedup != 'off')
+
+    @staticmethod
+    def _clamp(limit: int) -> int:
+        return max(limit, MIN_TRUNCATE_CHARS) if limit > 0 else 0
+
+    def _truncate_body(self, data: Dict[str, Any], kind: str) -> int:
+        limit = self.limits[kind]
+        saved = 0
+        shortened: Dict[int, str] = {}  # trace 和 generation 通常引用同一个字符串，只处理一次
+        for key in (f'trace_{kind}', f'generation_{kind}'):
+            text = data.get(key)
+            if not isinstance(text, str) or len(text) <= limit:
+                continue
+            short = shortened.get(id(text))
+            if short is None:
+                ref = self.store.put(text) if self.store is not None else None
+                short = shortened[id(text)] = truncate_text(text, limit, self.head_ratio, ref)
+                metrics.PAYLOAD_TRUNCATED.labels(kind).inc()
+                if ref is not None:
+                    offload = {**data.get('metadata', {}).get('payload_offload', {}), kind: ref}
+                    data['metadata'] = {**data.get('metadata', {}), 'payload_offload': offload}
+            saved += _utf8_len(text) - _utf8_len(short)
+            data[key] = short
+        return saved
+
+    def _truncate_metadata(self, value: Any) -> Tuple[Any, int]:
+        """递归截断 metadata 中的长字符串；有改动时返回新对象，不修改共享的原对象。"""
+        limit = self.max_metadata_value_chars
+        if isinstance(value, str):
+            if len(value) <= limit:
+                return value, 0
+            short = truncate_text(value, limit, self.head_ratio)
+            return short, _utf8_len(value) - _utf8_len(short)
+        if isinstance(value, dict):
+            saved, changed = 0, None
+            for key, item in value.items():
+                new_item, item_saved = self._truncate_metadata(item)
+                if item_saved:
+                    if changed is None:
+                        changed = dict(value)
+                    changed[key] = new_item
+                    saved += item_saved
+            return (changed if changed is not None else value), saved
+        return value, 0
+
+    def _dedup(self, data: Dict[str, Any]) -> int:
+        keep, drop = ('trace', 'generation') if self.dedup == 'trace' else ('generation', 'trace')
+        saved = 0
+        for kind in ('input', 'output'):
+            value = data.get(f'{drop}_{kind}')
+            if value and value == data.get(f'{keep}_{kind}'):
+                saved += _utf8_len(value) if isinstance(value, str) else len(jsoncodec.dumpb(value))
+                data[f'{drop}_{kind}'] = None
+        if data.get('metadata') and 'generation_metadata' not in data:
+            saved += len(jsoncodec.dumpb(data['metadata']))
+            data['generation_metadata'] = None
+        return saved
+
+    def shape(self, data: Dict[str, Any]) -> int:
+        """原地整形一条记录，返回节省的字节数（UTF-8）。"""
+        saved = 0
+        for kind, limit in self.limits.items():
+            if limit > 0:
+                saved += self._truncate_body(data, kind)
+        if self.max_metadata_value_chars > 0 and data.get('metadata'):
+            data['metadata'], metadata_saved = self._truncate_metadata(data['metadata'])
+            saved += metadata_saved
+        if self.dedup != 'off':
+            saved += self._dedup(data)
+        if saved:
+            metrics.PAYLOAD_BYTES_SAVED.observe(saved)
+        return saved
+
+
+_shaper: Optional[PayloadShaper] = None
+
+
+def get_payload_shaper() -> PayloadShaper:
+    """进程内共享的整形器，按环境变量配置。"""
+    global _shaper
+    if _shaper is None:
+        store = ContentStore(PAYLOAD_OFFLOAD_DIR) if PAYLOAD_OFFLOAD_DIR else None
+        _shaper = PayloadShaper(store=store)
+    return _shaper
@@ -1,11 +1,149 @@
 # sls_processor/processor.py
 
-import json
+import functools
 import logging
-import time
 import os
-from typing import Dict, Any, Optional
-from queue import Queue, Empty
+import threading
+from typing import Dict, Any, List, Mapping, Optional, Tuple
+
+from . import jsoncodec, metrics
+from .aggregator import maybe_aggregate
+from .dead_letter import DEAD_LETTER_REPLAY_ENABLED, DeadLetterReplayer, DeadLetterStore
+from .dedup import DedupCache, get_dedup_cache
+from .ingestion import build_exporter
+from .mapping import bounded_interner, compile_mapping, load_mapping_spec, to_int
+from .records import as_dict
+from .resilience import AdaptiveConcurrency, CircuitBreaker, SendResults
+from .rollups import close_rollups, get_rollup_aggregator
+from .scheduler import maybe_schedule
+from .sender_pool import SenderPool
+from .spill_queue import SpillQueue
+
+# --- 批量发送配置 ---
+SENDER_CONCURRENCY = int(os.getenv('LANGFUSE_SENDER_CONCURRENCY', '4'))
+BATCH_SIZE = int(os.getenv('LANGFUSE_BATCH_SIZE', '100'))
+BATCH_MAX_WAIT_MS = int(os.getenv('LANGFUSE_BATCH_MAX_WAIT_MS', '500'))
+MAX_RETRIES = int(os.getenv('LANGFUSE_MAX_RETRIES', '3'))
+RETRY_DELAY_SECONDS = float(os.getenv('LANGFUSE_RETRY_DELAY_SECONDS', '5'))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv('LANGFUSE_RETRY_MAX_DELAY_SECONDS', '60'))
+
+# --- 多进程转换配置 (0 表示在发送线程内直接转换) ---
+TRANSFORM_WORKERS = int(os.getenv('TRANSFORM_WORKERS', '0'))
+TRANSFORM_CHUNK_SIZE = int(os.getenv('TRANSFORM_CHUNK_SIZE', '25'))
+
+# --- 转换缓存配置 (0 表示关闭) ---
+# 驻留以每条记录约 1.5-2µs 的转换 CPU 换取长时间持有的转换结果更少的内存，默认关闭
+TRANSFORM_INTERN_CACHE_SIZE = int(os.getenv('TRANSFORM_INTERN_CACHE_SIZE', '0'))
+TRANSFORM_DERIVED_CACHE_SIZE = int(os.getenv('TRANSFORM_DERIVED_CACHE_SIZE', '4096'))
+
+# convert_to_langfuse_format 自身用到的源字段 (from, source, type)，与 metadata 映射共享读取
+CORE_FIELDS = [
+    ('log', 'question', 'str'), ('log', 'answer', 'str'), ('log', 'response_code', 'int'),
+    ('log', 'response_code_details', 'str'), ('log', '_namespace_', 'str'),
+    ('log', 'consumer', 'str'), ('log', 'start_time', 'str'),
+    ('ai', 'api', 'str'), ('ai', 'model', 'str'), ('ai', 'response_type', 'str'),
+    ('ai', 'chat_round', 'str'), ('ai', 'chat_id', 'str'), ('ai', 'consumer', 'str'),
+    ('ai', 'input_token', 'int'), ('ai', 'output_token', 'int'), ('ai', 'total_token', 'int'),
+]
+
+# 不在 metadata 映射中、但同样是低基数的核心字段，与映射中标记了 intern 的字段共用驻留池
+INTERNED_CORE_FIELDS = [('ai', 'model'), ('ai', 'consumer'), ('log', 'consumer')]
+
+# 启动时编译一次字段映射（可通过 FIELD_MAPPING_FILE 增删 metadata 字段）
+_mapping_spec = load_mapping_spec()
+_intern = bounded_interner(TRANSFORM_INTERN_CACHE_SIZE) if TRANSFORM_INTERN_CACHE_SIZE > 0 else None
+_extract_fields = compile_mapping(_mapping_spec, CORE_FIELDS, INTERNED_CORE_FIELDS, _intern)
+
+
+def required_log_fields() -> List[str]:
+    """转换实际读取的 SLS 日志字段（按首次出现的顺序），用于服务端字段裁剪。"""
+    fields = ['trace_id', 'ai_log']  # trace_id 用于过滤和聚合，ai_log 承载所有 ai 字段
+    for origin, source, _ in [*CORE_FIELDS, *((r.get('from', 'log'), r['source'], None) for r in _mapping_spec)]:
+        if origin == 'log' and source not in fields:
+            fields.append(source)
+    return fields
+
+
+def _derive_labels(api: Optional[str], model: Optional[str], response_type: Optional[str],
+                   namespace: Optional[str], response_code: Optional[int], response_details: Optional[str],
+                   chat_round: Optional[str]) -> Tuple[str, str, str, str, Tuple[str, ...]]:
+    """由低基数字段派生 (trace_name, generation_name, level, status_message, tags)；结果不可变，可在记录间共享。"""
+    api_prefix = api.split('@')[0] if api else ''
+
+    # 🚀 性能优化：预构建tags（避免filter和list操作）
+    tags = []
+    if api_prefix:
+        tags.append(api_prefix)
+    if response_type:
+        tags.append(response_type)
+    if namespace:
+        tags.append(namespace)
+    if model:
+        tags.append(f"model:{model}")
+
+    # 状态标签
+    if response_code:
+        if 200 <= response_code < 300:
+            tags.append("status:success")
+        elif 400 <= response_code < 500:
+            tags.append("status:client_error")
+        elif response_code >= 500:
+            tags.append("status:server_error")
+        else:
+            tags.append("status:other")
+    else:
+        tags.append("status:unknown")
+
+    # 🚀 性能优化：直接确定level（避免重复判断）
+    if response_code is None:
+        level = "DEFAULT"
+    elif 200 <= response_code < 300:
+        level = "DEFAULT"
+    elif 400 <= response_code < 500:
+        level = "WARNING"
+    elif response_code >= 500:
+        level = "ERROR"
+    else:
+        level = "DEBUG"
+
+    # 🚀 性能优化：预构建状态消息
+    status_parts = []
+    if response_code:
+        status_parts.append(f"HTTP {response_code}")
+    if response_details:
+        status_parts.append(response_details)
+    if response_type:
+        status_parts.append(f"AI: {response_type}")
+    status_message = " | ".join(status_parts) if status_parts else "Unknown"
+
+    # 🚀 性能优化：预构建generation名称
+    api_name = api if api is not None else 'AI Generation'
+    if chat_round:
+        generation_name = f"{api_name} - Round {chat_round}"
+    elif model:
+        generation_name = f"{api_name} ({model})"
+    else:
+        generation_name = api_name
+
+    trace_name = api if api is not None else 'AI Request'
+    return trace_name, generation_name, level, status_message, tuple(tags)
+
+
+# 相同的 (api, model, 响应类型, 命名空间, 状态码, 状态详情, 轮次) 组合直接返回缓存的派生值
+_derived_labels = (functools.lru_cache(maxsize=TRANSFORM_DERIVED_CACHE_SIZE)(_derive_labels)
+                   if TRANSFORM_DERIVED_CACHE_SIZE > 0 else _derive_labels)
+
+
+def watch_transform_caches():
+    """转换缓存的命中情况 (TransformPool 子进程中的缓存不计入)。"""
+    for name, cached in (('derived', _derived_labels), ('intern', _intern)):
+        if cached is None or not hasattr(cached, 'cache_info'):
+            continue
+        info = cached.cache_info
+        metrics.TRANSFORM_CACHE.labels(name, 'hits').set_function(lambda info=info: info().hits)
+        metrics.TRANSFORM_CACHE.labels(name, 'misses').set_function(lambda info=info: info().misses)
+        metrics.TRANSFORM_CACHE.labels(name, 'size').set_function(lambda info=info: info().currsize)
+
 
 # --- LangfuseDataProcessor 和 LangfuseSender 类的代码 ---
 class LangfuseDataProcessor:
@@ -15,209 +153,55 @@ class LangfuseDataProcessor:
     def parse_ai_log(ai_log_str: str) -> Dict[str, Any]:
         """解析ai_log JSON字符串"""
         try:
-            return json.loads(ai_log_str) if ai_log_str and ai_log_str.strip() and ai_log_str != '{}' else {}
-        except json.JSONDecodeError:
+            ai_log = jsoncodec.loads(ai_log_str) if ai_log_str and ai_log_str != '{}' and not ai_log_str.isspace() else {}
+        except jsoncodec.JSONDecodeError:
             return {}
+        return ai_log if isinstance(ai_log, dict) else {}  # null、数组、字符串、数字都视为没有 ai 字段
     
     @staticmethod
     def safe_int(value: Any) -> Optional[int]:
         """安全转换为整数"""
-        if value is None or value == '' or value == '-':
-            return None
-        try:
-            return int(float(value))
-        except (ValueError, TypeError):
-            return None
-    
-    @staticmethod
-    def build_performance_metadata(ai_log: Dict, log_contents: Dict) -> Dict[str, Any]:
-        """构建性能metadata - 预过滤"""
-        data = {}
-        if (duration := LangfuseDataProcessor.safe_int(log_contents.get('duration'))):
-            data["total_duration_ms"] = duration
-        if (llm_duration := LangfuseDataProcessor.safe_int(ai_log.get('llm_service_duration'))):
-            data["llm_service_duration_ms"] = llm_duration
-        if (upstream := LangfuseDataProcessor.safe_int(log_contents.get('upstream_service_time'))):
-            data["upstream_service_time_ms"] = upstream
-        if (response_tx := LangfuseDataProcessor.safe_int(log_contents.get('response_tx_duration'))):
-            data["response_tx_duration_ms"] = response_tx
-        return data
-    
-    @staticmethod
-    def build_request_metadata(log_contents: Dict) -> Dict[str, Any]:
-        """构建请求metadata - 预过滤"""
-        data = {}
-        if (method := log_contents.get('method')):
-            data["method"] = method
-        if (path := log_contents.get('path')):
-            data["path"] = path
-        if (original_path := log_contents.get('original_path')):
-            data["original_path"] = original_path
-        if (response_code := LangfuseDataProcessor.safe_int(log_contents.get('response_code'))):
-            data["response_code"] = response_code
-        if (response_details := log_contents.get('response_code_details')):
-            data["response_code_details"] = response_details
-        if (user_agent := log_contents.get('user_agent')):
-            data["user_agent"] = user_agent
-        if (protocol := log_contents.get('protocol')):
-            data["protocol"] = protocol
-        if (authority := log_contents.get('authority')):
-            data["authority"] = authority
-        return data
-    
-    @staticmethod
-    def build_infrastructure_metadata(log_contents: Dict) -> Dict[str, Any]:
-        """构建基础设施metadata - 预过滤"""
-        data = {}
-        if (container_ip := log_contents.get('_container_ip_')):
-            data["container_ip"] = container_ip
-        if (namespace := log_contents.get('_namespace_')):
-            data["namespace"] = namespace
-        if (cluster_id := log_contents.get('cluster_id')):
-            data["cluster_id"] = cluster_id
-        if (route_name := log_contents.get('route_name')):
-            data["route_name"] = route_name
-        if (upstream_host := log_contents.get('upstream_host')):
-            data["upstream_host"] = upstream_host
-        return data
-    
+        return to_int(value)
+
     @staticmethod
-    def convert_to_langfuse_format(log_contents: Dict[str, Any]) -> Dict[str, Any]:
-        """将SLS日志转换为Langfuse格式 - 高性能版"""
+    def convert_to_langfuse_format(log_contents: Mapping[str, Any]) -> Dict[str, Any]:
+        """将SLS日志（dict 或 LogRecordView）转换为Langfuse格式 - 编译后的单遍字段提取"""
+        log_contents = as_dict(log_contents)  # 队列中的视图在这里物化
         ai_log = LangfuseDataProcessor.parse_ai_log(log_contents.get('ai_log', '{}'))
-        
+
+        # 🚀 性能优化：每个源字段只读取、转换一次，metadata 同时构建完成
+        v, metadata = _extract_fields(log_contents.get, ai_log.get)
+        api = v['ai.api']
+        model = v['ai.model']
+        response_type = v['ai.response_type']
+        namespace = v['log._namespace_']
+        response_code = v['log.response_code']
+        response_details = v['log.response_code_details']
+        chat_round = v['ai.chat_round']
+
         # 核心字段提取
-        trace_input = log_contents.get('question', '')
-        trace_output = log_contents.get('answer', '') if log_contents.get('answer') != '-' else ''
-        api_prefix = ai_log.get('api', '').split('@')[0] if ai_log.get('api') else ''
-        response_code = LangfuseDataProcessor.safe_int(log_contents.get('response_code'))
-        
+        trace_input = v['log.question']
+        if trace_input is None:
+            trace_input = ''
+        trace_output = v['log.answer']
+        if trace_output is None or trace_output == '-':
+            trace_output = ''
         # 🚀 性能优化：预构建usage_details（避免重复检查）
-        usage_details = None
-        if ai_log.get('input_token') or ai_log.get('output_token') or ai_log.get('total_token'):
-            usage_details = {}
-            if (input_tokens := LangfuseDataProcessor.safe_int(ai_log.get('input_token'))):
-                usage_details['input'] = input_tokens
-            if (output_tokens := LangfuseDataProcessor.safe_int(ai_log.get('output_token'))):
-                usage_details['output'] = output_tokens
-            if (total_tokens := LangfuseDataProcessor.safe_int(ai_log.get('total_token'))):
-                usage_details['total'] = total_tokens
-        
-        # 🚀 性能优化：预构建tags（避免filter和list操作）
-        tags = []
-        if api_prefix:
-            tags.append(api_prefix)
-        if ai_log.get('response_type'):
-            tags.append(ai_log.get('response_type'))
-        if log_contents.get('_namespace_'):
-            tags.append(log_contents.get('_namespace_'))
-        if ai_log.get('model'):
-            tags.append(f"model:{ai_log.get('model')}")
-        
-        # 状态标签
-        if response_code:
-            if 200 <= response_code < 300:
-                tags.append("status:success")
-            elif 400 <= response_code < 500:
-                tags.append("status:client_error")
-            elif response_code >= 500:
-                tags.append("status:server_error")
-            else:
-                tags.append("status:other")
-        else:
-            tags.append("status:unknown")
-        
-        # 🚀 性能优化：直接确定level（避免重复判断）
-        if response_code is None:
-            level = "DEFAULT"
-        elif 200 <= response_code < 300:
-            level = "DEFAULT"
-        elif 400 <= response_code < 500:
-            level = "WARNING"
-        elif response_code >= 500:
-            level = "ERROR"
-        else:
-            level = "DEBUG"
-        
-        # 🚀 性能优化：预构建状态消息
-        status_parts = []
-        if response_code:
-            status_parts.append(f"HTTP {response_code}")
-        if log_contents.get('response_code_details'):
-            status_parts.append(log_contents.get('response_code_details'))
-        if ai_log.get('response_type'):
-            status_parts.append(f"AI: {ai_log.get('response_type')}")
-        status_message = " | ".join(status_parts) if status_parts else "Unknown"
-        
-        # 🚀 性能优化：预构建generation名称
-        if ai_log.get('chat_round'):
-            generation_name = f"{ai_log.get('api', 'AI Generation')} - Round {ai_log.get('chat_round')}"
-        elif ai_log.get('model'):
-            generation_name = f"{ai_log.get('api', 'AI Generation')} ({ai_log.get('model')})"
-        else:
-            generation_name = ai_log.get('api', 'AI Generation')
-        
-        # 🚀 性能优化：分别构建metadata子组（避免嵌套clean_dict）
-        metadata = {}
-        
-        # 环境信息
-        if log_contents.get('_namespace_'):
-            metadata["environment"] = log_contents.get('_namespace_', 'default')
-        
-        # 性能指标
-        if (performance := LangfuseDataProcessor.build_performance_metadata(ai_log, log_contents)):
-            metadata["performance"] = performance
-        
-        # 请求信息
-        if (request := LangfuseDataProcessor.build_request_metadata(log_contents)):
-            metadata["request"] = request
-        
-        # 基础设施信息
-        if (infrastructure := LangfuseDataProcessor.build_infrastructure_metadata(log_contents)):
-            metadata["infrastructure"] = infrastructure
-        
-        # 对话上下文
-        chat_context = {}
-        if ai_log.get('api'):
-            chat_context["api_full_name"] = ai_log.get('api')
-        if ai_log.get('chat_round'):
-            chat_context["chat_round"] = ai_log.get('chat_round')
-        if ai_log.get('response_type'):
-            chat_context["response_type"] = ai_log.get('response_type')
-        if ai_log.get('fallback_from'):
-            chat_context["fallback_from"] = ai_log.get('fallback_from')
-        if chat_context:
-            metadata["chat_context"] = chat_context
-        
-        # 网络传输
-        network = {}
-        if (bytes_sent := LangfuseDataProcessor.safe_int(log_contents.get('bytes_sent'))):
-            network["bytes_sent"] = bytes_sent
-        if (bytes_received := LangfuseDataProcessor.safe_int(log_contents.get('bytes_received'))):
-            network["bytes_received"] = bytes_received
-        if log_contents.get('downstream_remote_address'):
-            network["downstream_remote_address"] = log_contents.get('downstream_remote_address')
-        if log_contents.get('upstream_local_address'):
-            network["upstream_local_address"] = log_contents.get('upstream_local_address')
-        if network:
-            metadata["network"] = network
-        
-        # 原始追踪信息
-        original_trace = {}
-        if log_contents.get('trace_id'):
-            original_trace["sls_trace_id"] = log_contents.get('trace_id')
-        if log_contents.get('request_id'):
-            original_trace["request_id"] = log_contents.get('request_id')
-        if log_contents.get('_time_'):
-            original_trace["log_time"] = log_contents.get('_time_')
-        if log_contents.get('start_time'):
-            original_trace["start_time"] = log_contents.get('start_time')
-        if original_trace:
-            metadata["original_trace"] = original_trace
-        
+        usage_details = {}
+        if (input_tokens := v['ai.input_token']):
+            usage_details['input'] = input_tokens
+        if (output_tokens := v['ai.output_token']):
+            usage_details['output'] = output_tokens
+        if (total_tokens := v['ai.total_token']):
+            usage_details['total'] = total_tokens
+
+        # 名称、标签、级别和状态消息只取决于少数低基数字段，相同组合共享同一份结果
+        trace_name, generation_name, level, status_message, tags = _derived_labels(
+            api, model, response_type, namespace, response_code, response_details, chat_round)
+
         # 🚀 性能优化：直接构建结果（避免clean_data递归调用）
         result = {
-            "trace_name": ai_log.get('api', 'AI Request'),
+            "trace_name": trace_name,
             "trace_input": trace_input,
             "trace_output": trace_output,
             "generation_name": generation_name,
@@ -225,203 +209,145 @@ class LangfuseDataProcessor:
             "generation_output": trace_output,
             "level": level,
             "status_message": status_message,
-            "tags": tags
+            "tags": list(tags)  # 下游可能修改 tags，缓存中的是元组
         }
-        
+
         # 添加可选字段
-        if ai_log.get('consumer') or log_contents.get('consumer'):
-            result["user_id"] = ai_log.get('consumer', log_contents.get('consumer', ''))
-        if ai_log.get('chat_id'):
-            result["session_id"] = ai_log.get('chat_id')
-        if ai_log.get('model'):
-            result["model"] = ai_log.get('model')
+        ai_consumer = v['ai.consumer']
+        log_consumer = v['log.consumer']
+        if ai_consumer or log_consumer:
+            result["user_id"] = ai_consumer if ai_consumer is not None else (log_consumer or '')
+        if (chat_id := v['ai.chat_id']):
+            result["session_id"] = chat_id
+        if model:
+            result["model"] = model
         if usage_details:
             result["usage_details"] = usage_details
-        if log_contents.get('start_time'):
-            result["start_time"] = log_contents.get('start_time')
+        if (start_time := v['log.start_time']):
+            result["start_time"] = start_time
         if metadata:
             result["metadata"] = metadata
-        
+
         return result
 
 class LangfuseSender:
     """Langfuse数据发送器"""
     
-    def __init__(self):
+    def __init__(self, max_connections: int = SENDER_CONCURRENCY, dedup: Optional[DedupCache] = None):
         try:
-            # --- ✨ 核心修正：直接初始化客户端，让它自动读取环境变量 ---
-            from langfuse import get_client
-            self.langfuse = get_client()
-            
-            # 从 os.environ 读取 HOST 用于打印，确保信息来源一致
-            host = os.environ.get('LANGFUSE_HOST', 'N/A')
-            logger.info(f"✅ Langfuse客户端初始化成功，将连接到: {host}")
+            # 发送客户端（批量摄取接口或 OTLP，由 EXPORT_PROTOCOL 选择）的连接池，连接数与发送并发一致
+            self.exporter = build_exporter(max_connections=max_connections)
+            logger.info(f"✅ Langfuse发送客户端初始化成功，将连接到: {self.exporter.host}")
+            # 熔断器和自适应并发：Langfuse 变慢或不可用时收缩并发，并把记录直接转入死信存储
+            self.breaker = CircuitBreaker()
+            self.limiter = AdaptiveConcurrency(max_limit=max_connections)
+            # 发送去重（None 表示不去重）：重新分配分片或重启后重复投递的记录不再发送
+            self.dedup = dedup
 
         except Exception as e:
-            logger.error(f"❌ Langfuse客户端初始化失败: {e}", exc_info=True)
+            logger.error(f"❌ Langfuse发送客户端初始化失败: {e}", exc_info=True)
             raise
 
-    def send_trace_with_generation(self, data: Dict[str, Any]) -> bool:
-        """
-        发送trace和generation。
-        """
-        # 1. 从转换后的数据中获取原始的SLS Trace ID
-        sls_trace_id = data.get('metadata', {}).get('original_trace', {}).get('sls_trace_id')
+    def send_batch(self, payloads: List[Dict[str, Any]]) -> SendResults:
+        """通过批量摄取接口或 OTLP 一次发送多条记录，返回逐条的成功标记（最近已送达的重复记录直接视为成功）。"""
+        if self.dedup is None:
+            return self.exporter.send_batch(payloads)
+        return self.dedup.send(payloads, self.exporter.send_batch)
 
-        # 2. 检查ID是否存在
-        if not sls_trace_id:
-            logger.warning(f"在日志中未找到有效的sls_trace_id，已跳过发送。")
-            return False
-
-        try:
-            # 3. ✨【关键优化】✨ 直接将 sls_trace_id 作为 id 参数传入。
-            # 因为我们已确认其格式天然兼容，无需再调用 create_trace_id。
-            trace = self.langfuse.trace(
-                id=sls_trace_id,  # 直接使用，不再转换
-                name=data.get('trace_name', 'AI Request'),
-                # ... 其他参数保持不变 ...
-                input=data.get('trace_input'),
-                output=data.get('trace_output'),
-                user_id=data.get('user_id'),
-                session_id=data.get('session_id'),
-                tags=data.get('tags', []),
-                metadata=data.get('metadata', {})
-            )
-            
-            # 4. 在该Trace下追加一个Generation
-            trace.generation(
-                name=data.get('generation_name', 'AI Generation'),
-                # ... 其他参数保持不变 ...
-                input=data.get('generation_input'),
-                output=data.get('generation_output'),
-                model=data.get('model'),
-                level=data.get('level', 'DEFAULT'),
-                status_message=data.get('status_message', ''),
-                metadata=data.get('metadata', {}),
-                usage=data.get('usage_details')
-            )
-            
-            return True
-        except Exception as e:
-            logger.error(f"发送到Langfuse失败 (Trace ID: {sls_trace_id}): {e}", exc_info=True)
-            return False
-
-    # def send_trace_with_generation(self, data: Dict[str, Any]) -> bool:
-    #     """发送trace和generation(旧版本）"""
-    #     try:
-    #         with self.langfuse.start_as_current_span(
-    #             name=data.get('trace_name', 'AI Request'),
-    #             input=data.get('trace_input')
-    #         ) as root_span:
-                
-    #             root_span.update_trace(
-    #                 input=data.get('trace_input'),
-    #                 output=data.get('trace_output'),
-    #                 user_id=data.get('user_id'),
-    #                 session_id=data.get('session_id'),
-    #                 tags=data.get('tags', []),
-    #                 metadata=data.get('metadata', {})
-    #             )
-                
-    #             root_span.update(output=data.get('trace_output'), metadata=data.get('metadata', {}))
-                
-    #             with self.langfuse.start_as_current_observation(
-    #                 as_type='generation',
-    #                 name=data.get('generation_name', 'AI Generation'),
-    #                 input=data.get('generation_input'),
-    #                 model=data.get('model')
-    #             ) as generation:
-                    
-    #                 update_params = {
-    #                     'output': data.get('generation_output'),
-    #                     'level': data.get('level', 'DEFAULT'),
-    #                     'status_message': data.get('status_message', ''),
-    #                     'metadata': data.get('metadata', {})
-    #                 }
-                    
-    #                 if data.get('usage_details'):
-    #                     update_params['usage_details'] = data.get('usage_details')
-                    
-    #                 generation.update(**update_params)
-            
-    #         return True
-    #     except Exception as e:
-    #         logger.error(f"发送到Langfuse失败: {e}")
-    #         return False
-    
-    def flush(self) -> bool:
-        try:
-            self.langfuse.flush()
-            return True
-        except Exception as e:
-            logger.error(f"Langfuse刷新失败: {e}")
-            return False
+    def health(self) -> bool:
+        return self.exporter.health()
 
 
 # --- 新增的处理器主循环 ---
 logger = logging.getLogger(__name__)
 
-def write_to_dead_letter_queue(log_data: Dict[str, Any]):
-    """将处理失败的日志写入本地文件，以便后续排查。"""
-    try:
-        with open(DEAD_LETTER_QUEUE_FILE, "a") as f:
-            f.write(json.dumps(log_data) + "\n")
-        logger.warning(f"日志已写入死信队列: {DEAD_LETTER_QUEUE_FILE}")
-    except Exception as e:
-        logger.error(f"写入死信队列失败: {e}")
+_dead_letter_store: Optional[DeadLetterStore] = None
+_dead_letter_lock = threading.Lock()
+
+
+def get_dead_letter_store() -> DeadLetterStore:
+    """进程内共享的死信存储，首次使用时创建。"""
+    global _dead_letter_store
+    with _dead_letter_lock:
+        if _dead_letter_store is None:
+            _dead_letter_store = DeadLetterStore()
+        return _dead_letter_store
+
+
+def write_to_dead_letter_queue(records: List[Dict[str, Any]]) -> bool:
+    """将处理失败的一组日志写入本地死信分段，一次落盘后返回 True，以便后续回放。"""
+    return get_dead_letter_store().write_many(records)
+
 
-def process_logs_from_queue(log_queue: Queue, stop_event):
+def start_dead_letter_replayer(sender, enabled: bool = DEAD_LETTER_REPLAY_ENABLED) -> Optional[DeadLetterReplayer]:
+    """按配置启动死信后台回放，Langfuse 恢复后自动把死信重新发送。"""
+    if not enabled:
+        return None
+    replayer = DeadLetterReplayer(get_dead_letter_store(), sender,
+                                  LangfuseDataProcessor.convert_to_langfuse_format,
+                                  batch_size=BATCH_SIZE)
+    replayer.start()
+    return replayer
+
+def process_logs_from_queue(log_queue: SpillQueue, stop_event, sender: Optional[LangfuseSender] = None,
+                            replay_dead_letters: bool = DEAD_LETTER_REPLAY_ENABLED):
     """
-    从队列中获取日志，处理并发送到Langfuse，增加了重试和死信队列逻辑。
+    从队列中按批获取日志，由发送线程池并发发送到Langfuse；
+    失败记录在带外以指数退避重试，最终失败或熔断期间的记录写入死信队列。
+    sender 默认使用进程内共享的去重缓存；replay_dead_letters 为 True 时同时启动死信后台回放。
     """
-    sender = LangfuseSender()
-    stats = {'processed': 0, 'success': 0, 'error': 0, 'skipped': 0, 'retries': 0, 'dead_letter': 0}
-    start_time = time.time()
-    
-    # --- 新增：重试参数配置 ---
-    MAX_RETRIES = 3
-    RETRY_DELAY_SECONDS = 5
+    if sender is None:
+        sender = LangfuseSender(max_connections=SENDER_CONCURRENCY, dedup=get_dedup_cache())
 
-    logger.info("🚀 Langfuse处理器已启动 (增强版：带重试和死信队列)...")
+    transform_pool = None
+    if TRANSFORM_WORKERS > 0:
+        from .transform_pool import TransformPool
+        transform_pool = TransformPool(TRANSFORM_WORKERS, TRANSFORM_CHUNK_SIZE)
 
-    while not stop_event.is_set():
-        try:
-            log_data = log_queue.get(timeout=1.0)
-        except Empty:
-            continue # 队列为空，正常，继续循环
-        
-        stats['processed'] += 1
-        trace_id = log_data.get('trace_id', 'N/A')
-
-        langfuse_data = LangfuseDataProcessor.convert_to_langfuse_format(log_data)
-        
-        # --- 新增：带重试的发送逻辑 ---
-        sent_successfully = False
-        for attempt in range(MAX_RETRIES):
-            if sender.send_trace_with_generation(langfuse_data):
-                stats['success'] += 1
-                sent_successfully = True
-                logger.info(f"✅ 发送成功: Trace [ {trace_id[:16]}... ] | API [ {langfuse_data.get('trace_name', 'N/A')} ]")
-                break # 成功则跳出重试循环
-            else:
-                stats['retries'] += 1
-                logger.warning(f"❌ 发送失败 (尝试 {attempt + 1}/{MAX_RETRIES}): Trace [ {trace_id[:16]}... ]")
-                if attempt < MAX_RETRIES - 1:
-                    # 如果不是最后一次尝试，则等待一段时间再重试
-                    time.sleep(RETRY_DELAY_SECONDS)
-        
-        # --- 新增：处理最终失败的情况 ---
-        if not sent_successfully:
-            stats['error'] += 1
-            stats['dead_letter'] += 1
-            logger.error(f"🚨 发送最终失败，已放弃: Trace [ {trace_id[:16]}... ]")
-            write_to_dead_letter_queue(log_data)
-
-        # --- 修改定期统计日志的频率和内容 ---
-        if stats['processed'] % 50 == 0:
-            # ... (统计日志打印部分保持不变) ...
-            pass
-
-    logger.info("ℹ️ 收到停止信号，正在刷新Langfuse SDK...")
-    sender.flush()
-    logger.info("✅ Langfuse处理器已成功关闭。")
\ No newline at end of file
+    # 配置了调度键时按租户公平调度；配置了聚合窗口时，发送端从聚合器取数，同一 trace 的记录进入同一批次
+    scheduled = maybe_schedule(log_queue)
+    source = maybe_aggregate(scheduled)
+    pool = SenderPool(
+        source, sender,
+        convert=LangfuseDataProcessor.convert_to_langfuse_format,
+        dead_letter=write_to_dead_letter_queue,
+        concurrency=SENDER_CONCURRENCY,
+        batch_size=BATCH_SIZE,
+        batch_max_wait=BATCH_MAX_WAIT_MS / 1000,
+        max_retries=MAX_RETRIES,
+        retry_delay=RETRY_DELAY_SECONDS,
+        max_retry_delay=RETRY_MAX_DELAY_SECONDS,
+        breaker=sender.breaker,
+        limiter=sender.limiter,
+        transform_batch=transform_pool.transform if transform_pool else None,
+        rollups=get_rollup_aggregator(),
+    )
+
+    source.watch()
+    metrics.watch_resilience(sender.breaker, sender.limiter)
+    watch_transform_caches()
+
+    logger.info("🚀 Langfuse处理器已启动 (批量版：自适应并发、熔断、带外重试和死信队列)...")
+    pool.start()
+    replayer = start_dead_letter_replayer(sender, enabled=replay_dead_letters)
+
+    while not stop_event.wait(1):
+        pool.supervise()  # 发送或重试线程意外退出时重启，避免记录停留在未确认状态
+
+    logger.info("ℹ️ 收到停止信号，正在等待发送线程池退出...")
+    if scheduled is not log_queue:
+        scheduled.close()  # 忽略限速，交出调度缓冲中的记录
+    if source is not scheduled:
+        source.close()  # 立即释放聚合窗口中的记录
+    pool.stop(timeout=25)
+    if replayer is not None:
+        replayer.stop()
+    get_dead_letter_store().close()
+    if transform_pool is not None:
+        transform_pool.shutdown()
+    logger.info(f"📊 处理统计: {pool.stats}")
+    sender.exporter.close()
+    if sender.dedup is not None:
+        sender.dedup.close()
+    close_rollups()
+    logger.info("✅ Langfuse处理器已成功关闭。")
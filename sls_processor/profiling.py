@@ -0,0 +1,264 @@
+# sls_processor/profiling.py
+
+"""
+性能诊断：逐条记录的阶段计时和采样 profiler，默认关闭。
+
+阶段计时 (STAGE_TRACING_ENABLED)：消费端把记录放入队列时用 TracedAck 包装确认句柄，
+之后在各阶段边界记下 time.monotonic_ns()：
+
+    pulled       LogQueueProducer.process 收到本次拉取的 LogGroup
+    queued       queue.put 返回（包含队列满时的阻塞时间）
+    dequeued     发送端取出记录所在的批次
+    transformed  整批转换为 Langfuse 格式
+    sent         第一次发送返回
+    acked        确认（成功、去重跳过或写入死信；重试的记录包含重试时间）
+
+相邻阶段之差计入 sls_langfuse_stage_seconds{stage} 直方图，最慢的 STAGE_TRACING_SLOWEST 条记录连同
+各阶段耗时保存在内存中，可通过 /debug/slowest 查看（调试端点只响应本机请求）。关闭时消费端和发送端各只多一次 None 判断。
+
+采样 profiler (PROFILING_ENABLED)：后台线程按 PROFILER_INTERVAL_MS 采集所有线程的调用栈，
+输出 flamegraph.pl / speedscope 可直接读取的折叠栈格式（"线程;函数;...;函数 次数"）。
+- kill -USR2 <pid> 开始采样，再发一次停止并写入 PROFILER_OUTPUT_DIR。
+- GET /debug/profile?seconds=30（指标端点）采样指定时间后直接返回结果。
+采样的是墙上时间：等待锁、队列和网络的线程同样会出现在结果中。
+"""
+
+import collections
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from . import metrics
+from .records import peek_field
+
+logger = logging.getLogger(__name__)
+
+# --- 性能诊断配置 ---
+STAGE_TRACING_ENABLED = os.getenv('STAGE_TRACING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+STAGE_TRACING_SAMPLE_EVERY = int(os.getenv('STAGE_TRACING_SAMPLE_EVERY', '1'))
+STAGE_TRACING_SLOWEST = int(os.getenv('STAGE_TRACING_SLOWEST', '50'))
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+PROFILER_INTERVAL_MS = float(os.getenv('PROFILER_INTERVAL_MS', '10'))
+PROFILER_MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', '300'))
+PROFILER_OUTPUT_DIR = os.getenv('PROFILER_OUTPUT_DIR', 'profiles')
+
+STAGES = ('pulled', 'queued', 'dequeued', 'transformed', 'sent', 'acked')
+PULLED, QUEUED, DEQUEUED, TRANSFORMED, SENT, ACKED = range(len(STAGES))
+SPANS = ('queue_put', 'queue_wait', 'transform', 'send', 'ack')  # 相邻阶段之间
+
+
+# --- 阶段计时 ---
+
+class TracedAck:
+    """包装批次确认句柄，随记录经过各阶段时记下时间戳；确认时交给 StageTracer 汇总。"""
+    __slots__ = ('ack', 'tracer', 'trace_id', 'shard', 'stamps')
+
+    def __init__(self, ack, tracer: 'StageTracer', trace_id: Optional[str], shard, pulled_ns: int):
+        self.ack = ack
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.shard = shard
+        self.stamps = [pulled_ns, 0, 0, 0, 0, 0]
+
+    def done(self):
+        self.stamps[ACKED] = time.monotonic_ns()
+        if self.ack is not None:
+            self.ack.done()
+        self.tracer.finish(self)
+
+
+class StageTracer:
+    def __init__(self, sample_every: int = STAGE_TRACING_SAMPLE_EVERY, slowest: int = STAGE_TRACING_SLOWEST):
+        self.sample_every = max(1, sample_every)
+        self.capacity = max(1, slowest)
+        self._counter = itertools.count()
+        self._slowest: List[tuple] = []  # 最小堆：(总耗时ns, 序号, 记录)
+        self._lock = threading.Lock()
+        self._histograms = [metrics.STAGE_SECONDS.labels(span) for span in SPANS]
+        self._total = metrics.STAGE_SECONDS.labels('total')
+
+    def wrap(self, ack, record, shard, pulled_ns: int):
+        """按采样间隔返回 TracedAck 或原句柄；put 返回后由调用方调用 queued()。"""
+        if next(self._counter) % self.sample_every:
+            return ack
+        return TracedAck(ack, self, peek_field(record, 'trace_id'), shard, pulled_ns)
+
+    @staticmethod
+    def queued(ack):
+        if type(ack) is TracedAck:
+            ack.stamps[QUEUED] = time.monotonic_ns()
+
+    @staticmethod
+    def mark(items, stage: int):
+        """为一批队列元素记下阶段时间戳（已记录过的不覆盖，重试不会改写 sent）。"""
+        now = time.monotonic_ns()
+        for item in items:
+            ack = item[1]
+            if type(ack) is TracedAck and not ack.stamps[stage]:
+                ack.stamps[stage] = now
+
+    def finish(self, traced: TracedAck):
+        stamps = traced.stamps
+        spans = {}
+        previous = stamps[PULLED]
+        for index, name in enumerate(SPANS, start=1):
+            if stamps[index]:  # 缺失的阶段（如熔断时直接转入死信）计入下一阶段
+                spans[name] = (stamps[index] - previous) / 1e6
+                previous = stamps[index]
+            else:
+                spans[name] = 0.0
+        total = stamps[ACKED] - stamps[PULLED]
+        for histogram, name in zip(self._histograms, SPANS):
+            histogram.observe(spans[name] / 1000)
+        self._total.observe(total / 1e9)
+        with self._lock:
+            if len(self._slowest) >= self.capacity and total <= self._slowest[0][0]:
+                return
+            entry = {'trace_id': traced.trace_id, 'shard': traced.shard, 'total_ms': total / 1e6,
+                     'finished_at': time.time(), 'stages_ms': spans}
+            item = (total, id(traced), entry)
+            if len(self._slowest) < self.capacity:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heapreplace(self._slowest, item)
+
+    def slowest(self, reset: bool = False) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = [entry for _, _, entry in sorted(self._slowest, key=lambda item: -item[0])]
+            if reset:
+                self._slowest.clear()
+        return entries
+
+
+_tracer: Optional[StageTracer] = StageTracer() if STAGE_TRACING_ENABLED else None
+
+
+def get_stage_tracer() -> Optional[StageTracer]:
+    """STAGE_TRACING_ENABLED=false 时返回 None。"""
+    return _tracer
+
+
+# --- 采样 profiler ---
+
+_THREAD_SUFFIX = re.compile(r'[-_]\d+$')
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """按固定间隔采集所有线程的调用栈，累计为折叠栈计数。"""
+
+    def __init__(self, interval: float = PROFILER_INTERVAL_MS / 1000, max_seconds: float = PROFILER_MAX_SECONDS):
+        self.interval = max(0.001, interval)
+        self.max_seconds = max_seconds
+        self.stacks: Dict[str, int] = collections.Counter()
+        self.samples = 0
+        self.started = 0.0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: _THREAD_SUFFIX.sub('', thread.name) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, f"thread-{ident}"))
+            self.stacks[';'.join(reversed(labels))] += 1
+        self.samples += 1
+
+    def run(self, seconds: float):
+        """在当前线程中采样 seconds 秒（或直到 stop）。"""
+        self.started = time.monotonic()
+        deadline = self.started + min(seconds, self.max_seconds)
+        while not self._stop_event.wait(self.interval) and time.monotonic() < deadline:
+            self._sample()
+
+    def start(self, on_finish=None):
+        def target():
+            self.run(self.max_seconds)
+            if on_finish is not None:
+                on_finish(self)
+        self._thread = threading.Thread(target=target, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def folded(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def write(self, directory: str = PROFILER_OUTPUT_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.folded())
+        return path
+
+
+_signal_profiler: Optional[SamplingProfiler] = None
+
+
+def _write_profile(profiler: SamplingProfiler):
+    try:
+        path = profiler.write()
+        logger.info(f"🔥 采样结束: {profiler.samples} 次采样, {time.monotonic() - profiler.started:.0f}s, 已写入 {path}")
+    except OSError as e:
+        logger.error(f"❌ profile 写入失败: {e}")
+
+
+def toggle_profiler(signum=None, frame=None):
+    """开始或停止由信号控制的采样；停止后在采样线程中写文件，不阻塞信号处理。"""
+    global _signal_profiler
+    if _signal_profiler is not None and _signal_profiler.running:
+        _signal_profiler.stop()
+        return
+    _signal_profiler = SamplingProfiler()
+    _signal_profiler.start(on_finish=_write_profile)
+    logger.info(f"🔥 开始采样 (间隔 {_signal_profiler.interval * 1000:.0f}ms, 最长 {_signal_profiler.max_seconds:.0f}s)，"
+                f"再次发送 SIGUSR2 停止")
+
+
+# --- 调试端点 ---
+
+def _profile_route(query: Dict[str, str]):
+    profiler = SamplingProfiler()
+    profiler.run(float(query.get('seconds', '10')))
+    return 'text/plain; charset=utf-8', profiler.folded().encode('utf-8')
+
+
+def _slowest_route(query: Dict[str, str]):
+    entries = _tracer.slowest(reset=query.get('reset') in ('1', 'true')) if _tracer is not None else []
+    return 'application/json', json.dumps(entries, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def install_profiling():
+    """在工作进程的主线程中调用：注册 SIGUSR2 和 /debug 端点（PROFILING_ENABLED 时）。"""
+    if STAGE_TRACING_ENABLED:
+        metrics.register_debug_route('/debug/slowest', _slowest_route)
+        logger.info(f"⏱️ 阶段计时已启用: 每 {STAGE_TRACING_SAMPLE_EVERY} 条采样 1 条，保留最慢的 {STAGE_TRACING_SLOWEST} 条")
+    if not PROFILING_ENABLED:
+        return
+    metrics.register_debug_route('/debug/profile', _profile_route)
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, toggle_profiler)
+    logger.info(f"🔥 采样 profiler 已就绪: kill -USR2 {os.getpid()} 开始/停止，或 GET /debug/profile?seconds=N")
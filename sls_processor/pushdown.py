@@ -0,0 +1,48 @@
+# sls_processor/pushdown.py
+
+"""
+服务端过滤下推：把 trace_id 过滤和字段裁剪写成 SPL，随 LogHubConfig / pull_logs 交给 SLS 执行，
+没有有效 trace_id 的日志和转换用不到的字段不再下载。
+
+SLS_QUERY 为空时不下推（默认，SPL 消费可能单独计费）；auto 按过滤规则和转换实际读取的字段生成；
+其他值作为自定义 SPL 原样使用。客户端的 is_valid_trace_id 过滤始终保留，下推只是减少传输量。
+"""
+
+import os
+from typing import List, Optional
+
+from .consumer import TRACE_ID_MIN_LENGTH
+from .processor import required_log_fields
+
+# --- 过滤下推配置 ---
+SLS_QUERY = os.getenv('SLS_QUERY', '').strip()  # 空 / auto / 自定义 SPL
+SLS_QUERY_PROJECT = os.getenv('SLS_QUERY_PROJECT', 'true').lower() in ('1', 'true', 'yes')
+SLS_QUERY_EXTRA_FIELDS = os.getenv('SLS_QUERY_EXTRA_FIELDS', '')
+
+
+def _quote(field: str) -> str:
+    """SPL 中字段名用双引号，内部的双引号写两次。"""
+    return '"' + field.replace('"', '""') + '"'
+
+
+def generate_query(fields: Optional[List[str]] = None, project: bool = True) -> str:
+    """生成 SPL：只保留 trace_id 长度达标的日志，并（可选）只返回 fields 中的字段。"""
+    spl = f"* | where length({_quote('trace_id')}) >= {TRACE_ID_MIN_LENGTH}"
+    if project:
+        fields = fields if fields is not None else required_log_fields()
+        spl += " | project " + ", ".join(_quote(field) for field in fields)
+    return spl
+
+
+def build_consumer_query(setting: str = SLS_QUERY) -> Optional[str]:
+    """按 SLS_QUERY 返回消费使用的 SPL；未启用时返回 None。"""
+    if not setting:
+        return None
+    if setting.lower() != 'auto':
+        return setting
+    fields = required_log_fields()
+    for field in (f.strip() for f in SLS_QUERY_EXTRA_FIELDS.split(',')):
+        if field and field not in fields:
+            fields.append(field)
+    return generate_query(fields, project=SLS_QUERY_PROJECT)
+
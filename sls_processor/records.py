@@ -0,0 +1,107 @@
+# sls_processor/records.py
+
+"""
+SLS 日志记录在队列中的紧凑表示。
+
+拉取线程只读取 trace_id 做过滤，不为每条日志构建字典；放入队列的是直接引用
+protobuf Contents 的 LogRecordView，第一次按字段访问时（发送线程中的转换阶段）
+才一次性物化为 dict。
+
+视图引用的是整个拉取结果中的一部分，只要还有一条视图未物化，整个 LogGroupList（包括被
+trace_id 过滤掉的日志）都留在内存中；因此同一次拉取的视图共享一个 PulledArena，队列按拉取大小计量。
+"""
+
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+
+def find_content(contents, key: str, hint: int = -1) -> Tuple[Optional[str], int]:
+    """
+    在 protobuf Contents 中查找 key，返回 (值, 下标)；不存在时返回 (None, -1)。
+    同一日志库的字段顺序通常固定，传入上一条日志的下标作为 hint 时大多只需比较一次。
+    """
+    if 0 <= hint < len(contents):
+        content = contents[hint]
+        if content.Key == key:
+            return content.Value, hint
+    for index, content in enumerate(contents):
+        if content.Key == key:
+            return content.Value, index
+    return None, -1
+
+
+class PulledArena:
+    """一次拉取的 LogGroupList 的序列化大小，以及其中有多少条视图正在队列内存中（由队列在持锁时维护）。"""
+    __slots__ = ('nbytes', 'queued')
+
+    def __init__(self, nbytes: int):
+        self.nbytes = nbytes
+        self.queued = 0
+
+
+class LogRecordView(Mapping):
+    """
+    只读的日志记录视图：持有 protobuf Contents 的引用，首次访问字段时物化为 dict 并缓存，
+    之后释放对 protobuf 的引用。对下游来说它就是一个 Mapping。
+    """
+    __slots__ = ('_contents', '_dict', 'nbytes', 'arena')
+
+    def __init__(self, contents, nbytes: int = 0, arena: Optional[PulledArena] = None):
+        self._contents = contents
+        self._dict: Optional[Dict[str, Any]] = None
+        self.nbytes = nbytes  # protobuf 序列化大小，供队列按字节计量
+        self.arena = arena  # 所属的拉取结果；为 None 时只按自身大小计量
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self._dict is None:
+            self._dict = {content.Key: content.Value for content in self._contents}
+            self._contents = None
+        return self._dict
+
+    def peek(self, key: str) -> Optional[str]:
+        """读取单个字段；尚未物化时直接在 protobuf 上查找，不构建 dict。"""
+        if self._dict is None:
+            return find_content(self._contents, key)[0]
+        return self._dict.get(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.to_dict().get(key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.to_dict()[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.to_dict()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.to_dict())
+
+    def __len__(self) -> int:
+        return len(self.to_dict())
+
+    def __repr__(self) -> str:
+        return f"LogRecordView({self.to_dict()!r})"
+
+
+def record_size(record: Mapping) -> int:
+    """记录的近似字节数：视图取拉取时记下的 protobuf 大小，dict 按键值的字符长度估算。"""
+    if type(record) is LogRecordView and record.nbytes:
+        return record.nbytes
+    return sum(len(key) + len(str(value)) for key, value in record.items())
+
+
+def pinned_arena(record: Mapping) -> Optional[PulledArena]:
+    """尚未物化的视图所固定在内存中的拉取结果；dict 和已物化的视图返回 None。"""
+    if type(record) is LogRecordView and record._dict is None:
+        return record.arena
+    return None
+
+
+def peek_field(record: Mapping, key: str) -> Any:
+    """读取单个字段而不物化视图。"""
+    return record.peek(key) if type(record) is LogRecordView else record.get(key)
+
+
+def as_dict(record: Mapping) -> Dict[str, Any]:
+    """序列化前取得记录的 dict 形式（dict 原样返回）。"""
+    return record if type(record) is dict else record.to_dict()
@@ -0,0 +1,61 @@
+# sls_processor/replay.py
+
+"""
+手动回放死信分段到 Langfuse。
+
+用法:
+    python -m sls_processor.replay                    # 回放所有已封存分段
+    python -m sls_processor.replay --rate 500 --dir /data/dead_letter
+
+正在运行的服务持有其活动分段的文件锁，这些分段会被自动跳过。
+"""
+
+import argparse
+import logging
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger("sls_processor.replay")
+
+from .dead_letter import DEAD_LETTER_DIR, DEAD_LETTER_REPLAY_RATE, DeadLetterReplayer, DeadLetterStore
+from .ingestion import build_exporter
+from .processor import BATCH_SIZE, LangfuseDataProcessor
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=DEAD_LETTER_DIR, help="死信分段目录")
+    parser.add_argument("--rate", type=float, default=DEAD_LETTER_REPLAY_RATE, help="回放限速 (条/秒, 0 表示不限速)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    store = DeadLetterStore(directory=args.dir)
+    segments = store.sealed_segments()
+    if not segments:
+        logger.info(f"目录 {args.dir} 中没有需要回放的死信分段。")
+        store.close()
+        return 0
+
+    client = build_exporter(max_connections=2)
+    try:
+        if not client.health():
+            logger.error(f"Langfuse 健康检查失败 ({client.host})，放弃回放。")
+            return 1
+        replayer = DeadLetterReplayer(store, client, LangfuseDataProcessor.convert_to_langfuse_format,
+                                      rate_limit=args.rate, batch_size=args.batch_size)
+        logger.info(f"♻️ 准备回放 {len(segments)} 个死信分段...")
+        completed = replayer.drain()
+        logger.info(f"📊 回放统计: {replayer.stats}")
+        return 0 if completed else 1
+    finally:
+        client.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
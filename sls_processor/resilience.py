@@ -0,0 +1,182 @@
+# sls_processor/resilience.py
+
+"""
+发送链路的自我保护：熔断器、AIMD 自适应并发和带抖动的指数退避。
+
+- 熔断器：连续 N 个批次整批失败后打开，打开期间记录直接转入死信存储，
+  冷却结束后进入半开状态，放行少量探测批次，成功则关闭，失败则重新打开。
+- 自适应并发：批次成功且延迟低于目标时加性增加并发上限，失败或超时时乘性减小。
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# --- 熔断与自适应并发配置 ---
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv('CIRCUIT_HALF_OPEN_PROBES', '1'))
+ADAPTIVE_CONCURRENCY_MIN = int(os.getenv('ADAPTIVE_CONCURRENCY_MIN', '1'))
+ADAPTIVE_LATENCY_TARGET_MS = float(os.getenv('ADAPTIVE_LATENCY_TARGET_MS', '2000'))
+ADAPTIVE_BACKOFF_RATIO = float(os.getenv('ADAPTIVE_BACKOFF_RATIO', '0.5'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """第 attempt 次重试的等待时间：指数增长、上限 cap，在 [d/2, d] 内随机抖动避免重试同步。"""
+    delay = min(cap, base * (2 ** max(0, attempt - 1)))
+    return random.uniform(delay / 2, delay)
+
+
+def is_permanent_status(status) -> bool:
+    """逐条错误的状态码是否表示重试也不会成功：4xx 校验错误是，408/429 和 5xx 不是。"""
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return False
+    return 400 <= status < 500 and status not in (408, 429)
+
+
+class SendResults(list):
+    """
+    send_batch 的返回值：与 payloads 对齐的逐条成功标记，另外区分失败的原因。
+    - transport_failed：整批没有送达（连接错误、超时、非 2xx 响应，或记录全部因 5xx/429 失败），
+      Langfuse 可能不可用，熔断器和自适应并发只看这一项；
+    - rejected：被明确拒绝、重试也不会成功的记录下标（缺少 trace_id、4xx 校验错误）。
+    其余失败的记录（207 响应中的 5xx、429 等）可以重试。
+    """
+
+    def __init__(self, results: Iterable = (), transport_failed: bool = False, rejected: Iterable[int] = ()):
+        super().__init__(results)
+        self.transport_failed = transport_failed
+        self.rejected = set(rejected)
+
+    @classmethod
+    def failed(cls, count: int) -> 'SendResults':
+        return cls([False] * count, transport_failed=True)
+
+    @classmethod
+    def of(cls, results: Optional[Iterable]) -> 'SendResults':
+        """包装普通的结果列表（如测试替身的返回值）：全部失败视为整批未送达。"""
+        if isinstance(results, cls):
+            return results
+        results = list(results or ())
+        return cls(results, transport_failed=bool(results) and not any(results))
+
+
+class CircuitBreaker:
+    """批次级熔断器，线程安全。整批失败（连接错误、超时、5xx）才计为失败，逐条校验错误不影响熔断。"""
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 open_seconds: float = CIRCUIT_OPEN_SECONDS,
+                 half_open_probes: int = CIRCUIT_HALF_OPEN_PROBES):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow(self) -> bool:
+        """是否允许发送；打开状态冷却结束后转为半开，只放行有限的探测批次。"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._state = HALF_OPEN
+                self._probes = 0
+                logger.info("🟡 熔断器进入半开状态，开始探测 Langfuse")
+            if self._probes >= self.half_open_probes:
+                return False
+            self._probes += 1
+            return True
+
+    def record(self, ok: bool):
+        with self._lock:
+            if ok:
+                if self._state != CLOSED:
+                    logger.info("🟢 熔断器已关闭，Langfuse 恢复正常")
+                self._state = CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                logger.warning(f"🔴 熔断器已打开：连续 {self._failures} 个批次发送失败，"
+                               f"{self.open_seconds:.0f}s 内记录将直接写入死信存储")
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD 并发限制器：每个成功且延迟达标的批次使上限增加 1/limit（约每轮增加 1），
+    失败或超过延迟目标时上限乘以 backoff_ratio；每个延迟周期内最多收缩一次，
+    避免同一波失败把上限一次压到最低。
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = ADAPTIVE_CONCURRENCY_MIN,
+                 latency_target: float = ADAPTIVE_LATENCY_TARGET_MS / 1000,
+                 backoff_ratio: float = ADAPTIVE_BACKOFF_RATIO):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self._limit = float(self.max_limit)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self._in_flight < int(self._limit):
+                self._in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout: float = None) -> bool:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._in_flight < int(self._limit), timeout=timeout):
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self, latency: float, ok: bool):
+        """归还并发槽位，并根据本次批次的延迟和结果调整上限。"""
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if ok and latency <= self.latency_target:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            elif now - self._last_decrease >= latency:
+                previous = int(self._limit)
+                self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+                self._last_decrease = now
+                if int(self._limit) != previous:
+                    logger.warning(f"⬇️ 发送并发上限调整为 {int(self._limit)} "
+                                   f"({'失败' if not ok else f'延迟 {latency * 1000:.0f}ms'})")
+            self._cond.notify_all()
@@ -0,0 +1,425 @@
+# sls_processor/rollups.py
+
+"""
+流式窗口汇总：按 model / consumer / route 统计延迟分位数、token 用量和错误率，
+周期性地把紧凑的汇总记录写到 Langfuse（event）、本地 JSON Lines 文件或日志，
+不必再对 Langfuse 中的逐条记录做聚合查询。
+
+- 输入是 convert_to_langfuse_format 已经提取好的字段：发送端转换完一批后只把列表引用放入待处理队列，
+  字段读取和聚合都在后台线程中进行，不增加逐条记录的延迟；后台积压过多时丢弃整批观测（计入指标）。
+- 按事件时间（start_time）划分滚动窗口 ROLLUP_WINDOW_SECONDS；观测到的最大事件时间越过窗口结束
+  ROLLUP_ALLOWED_LATENESS_SECONDS 后输出，窗口打开时间过长时也会输出（流量中断时不会一直挂起）。
+  之后到达的记录计为迟到，不再统计。
+- ROLLUP_SLIDING_WINDOWS > 1 时，每个滚动窗口关闭后再输出一条合并最近 N 个窗口的滑动汇总。
+- 延迟分位数使用可合并的对数分桶草图（相对误差 ROLLUP_RELATIVE_ACCURACY），计数和 token 直接累加。
+- 每个维度每个窗口最多 ROLLUP_MAX_KEYS 个键，超出的键合并为 _other。
+
+多进程或多副本时每个进程只汇总自己处理的记录，汇总记录带有 emitter 字段，需要在下游按窗口相加。
+"""
+
+import collections
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import jsoncodec, metrics
+from .ingestion import LangfuseIngestionClient, _parse_start_time, _utc_iso, _utc_now_iso
+
+logger = logging.getLogger(__name__)
+
+# --- 窗口汇总配置 ---
+ROLLUP_ENABLED = os.getenv('ROLLUP_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+ROLLUP_WINDOW_SECONDS = float(os.getenv('ROLLUP_WINDOW_SECONDS', '60'))
+ROLLUP_SLIDING_WINDOWS = int(os.getenv('ROLLUP_SLIDING_WINDOWS', '0'))
+ROLLUP_ALLOWED_LATENESS_SECONDS = float(os.getenv('ROLLUP_ALLOWED_LATENESS_SECONDS', '30'))
+ROLLUP_DIMENSIONS = os.getenv('ROLLUP_DIMENSIONS', 'model,consumer,route')
+ROLLUP_MAX_KEYS = int(os.getenv('ROLLUP_MAX_KEYS', '500'))
+ROLLUP_RELATIVE_ACCURACY = float(os.getenv('ROLLUP_RELATIVE_ACCURACY', '0.01'))
+ROLLUP_SINKS = os.getenv('ROLLUP_SINKS', 'langfuse')  # langfuse / file / log，逗号分隔
+ROLLUP_FILE = os.getenv('ROLLUP_FILE', 'rollups.jsonl')
+ROLLUP_MAX_PENDING_BATCHES = int(os.getenv('ROLLUP_MAX_PENDING_BATCHES', '1000'))
+
+OTHER_KEY = '_other'
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _metadata(data: Dict[str, Any], section: str) -> Dict[str, Any]:
+    return (data.get('metadata') or {}).get(section) or {}
+
+
+# 维度名 -> 从转换结果中取键的函数
+DIMENSIONS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    'model': lambda data: data.get('model'),
+    'consumer': lambda data: data.get('user_id'),
+    'route': lambda data: _metadata(data, 'infrastructure').get('route_name'),
+    'namespace': lambda data: _metadata(data, 'infrastructure').get('namespace'),
+    'api': lambda data: data.get('trace_name'),
+}
+
+
+class QuantileSketch:
+    """对数分桶的分位数草图（DDSketch 的简化版）：相对误差有界，两个草图按桶相加即可合并。"""
+    __slots__ = ('gamma', 'log_gamma', 'buckets', 'zeros', 'count', 'max')
+
+    def __init__(self, relative_accuracy: float = ROLLUP_RELATIVE_ACCURACY):
+        accuracy = min(0.5, max(1e-4, relative_accuracy))
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: 'QuantileSketch'):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return min(self.max, 2 * self.gamma ** index / (self.gamma + 1))
+        return self.max
+
+    def summary(self) -> Optional[Dict[str, float]]:
+        if self.count == 0:
+            return None
+        result = {f"p{int(q * 100)}": round(self.quantile(q), 1) for q in QUANTILES}
+        result['max'] = self.max
+        return result
+
+
+class RollupStats:
+    """一个 (维度, 键) 在一个窗口内的统计，可合并。"""
+    __slots__ = ('count', 'errors', 'client_errors', 'input_tokens', 'output_tokens', 'total_tokens',
+                 'llm_duration', 'total_duration')
+
+    def __init__(self, relative_accuracy: float = ROLLUP_RELATIVE_ACCURACY):
+        self.count = 0
+        self.errors = 0
+        self.client_errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.total_tokens = 0
+        self.llm_duration = QuantileSketch(relative_accuracy)
+        self.total_duration = QuantileSketch(relative_accuracy)
+
+    def add(self, level: Optional[str], usage: Dict[str, int], llm_ms: Any, total_ms: Any):
+        self.count += 1
+        if level == 'ERROR':
+            self.errors += 1
+        elif level == 'WARNING':
+            self.client_errors += 1
+        self.input_tokens += usage.get('input') or 0
+        self.output_tokens += usage.get('output') or 0
+        self.total_tokens += usage.get('total') or 0
+        if isinstance(llm_ms, (int, float)):
+            self.llm_duration.add(llm_ms)
+        if isinstance(total_ms, (int, float)):
+            self.total_duration.add(total_ms)
+
+    def merge(self, other: 'RollupStats'):
+        for name in ('count', 'errors', 'client_errors', 'input_tokens', 'output_tokens', 'total_tokens'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.llm_duration.merge(other.llm_duration)
+        self.total_duration.merge(other.total_duration)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'client_errors': self.client_errors,
+            'error_rate': round(self.errors / self.count, 4) if self.count else 0.0,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'total_tokens': self.total_tokens,
+            'llm_service_duration_ms': self.llm_duration.summary(),
+            'total_duration_ms': self.total_duration.summary(),
+        }
+
+
+class _Window:
+    __slots__ = ('start', 'opened', 'stats', 'keys')
+
+    def __init__(self, start: float):
+        self.start = start
+        self.opened = time.monotonic()
+        self.stats: Dict[Tuple[str, str], RollupStats] = {}
+        self.keys: Dict[str, int] = collections.Counter()  # 维度 -> 已有的键数
+
+
+class RollupAggregator:
+    """
+    在后台线程中汇总发送端转换好的记录，窗口关闭时交给 sinks。
+    observe() 只做一次 deque.append，可在任意线程调用。
+    """
+
+    def __init__(self, sinks: List[Callable[[List[Dict[str, Any]]], None]], window: float = ROLLUP_WINDOW_SECONDS,
+                 sliding_windows: int = ROLLUP_SLIDING_WINDOWS, lateness: float = ROLLUP_ALLOWED_LATENESS_SECONDS,
+                 dimensions: Optional[List[str]] = None, max_keys: int = ROLLUP_MAX_KEYS,
+                 relative_accuracy: float = ROLLUP_RELATIVE_ACCURACY,
+                 max_pending: int = ROLLUP_MAX_PENDING_BATCHES, flush_interval: float = 1.0):
+        dimensions = dimensions if dimensions is not None else [d.strip() for d in ROLLUP_DIMENSIONS.split(',') if d.strip()]
+        unknown = [name for name in dimensions if name not in DIMENSIONS]
+        if unknown:
+            raise ValueError(f"未知的汇总维度 {unknown}，可选值: {', '.join(DIMENSIONS)}")
+        self.sinks = sinks
+        self.window = max(1.0, window)
+        self.sliding_windows = sliding_windows
+        self.lateness = max(0.0, lateness)
+        self.dimensions = [(name, DIMENSIONS[name]) for name in dimensions]
+        self.max_keys = max(1, max_keys)
+        self.relative_accuracy = relative_accuracy
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.emitter = f"{socket.gethostname()}/{os.getpid()}"
+        self._pending: Deque[List[Dict[str, Any]]] = collections.deque()
+        self._windows: Dict[float, _Window] = {}
+        self._history: Deque[_Window] = collections.deque(maxlen=max(1, sliding_windows))
+        self._watermark = 0.0  # 观测到的最大事件时间
+        self._closed_until = 0.0  # 早于此时间的窗口已输出
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Rollups", daemon=True)
+        self._observed = metrics.ROLLUP_RECORDS.labels('observed')
+        self._late = metrics.ROLLUP_RECORDS.labels('late')
+        self._dropped = metrics.ROLLUP_RECORDS.labels('dropped')
+
+    def start(self) -> 'RollupAggregator':
+        self._thread.start()
+        logger.info(f"📐 窗口汇总已启用: 窗口 {self.window:.0f}s"
+                    f"{f', 滑动 {self.sliding_windows} 个窗口' if self.sliding_windows > 1 else ''}, "
+                    f"维度 {[name for name, _ in self.dimensions]}, 每维度最多 {self.max_keys} 个键")
+        return self
+
+    def observe(self, payloads: List[Dict[str, Any]]):
+        """发送端转换完一批后调用，只保存列表引用。"""
+        if len(self._pending) >= self.max_pending:
+            self._dropped.inc(len(payloads))
+            return
+        self._pending.append(payloads)
+
+    # --- 后台聚合 ---
+
+    def _add(self, data: Dict[str, Any]):
+        start_time = _parse_start_time(data.get('start_time'))
+        now = time.time()
+        event_time = min(start_time.timestamp(), now) if start_time is not None else now  # 时钟超前的记录按当前时间计
+        window_start = event_time - event_time % self.window
+        if window_start < self._closed_until:
+            self._late.inc()
+            return
+        self._watermark = max(self._watermark, event_time)
+        window = self._windows.get(window_start)
+        if window is None:
+            window = self._windows[window_start] = _Window(window_start)
+        performance = _metadata(data, 'performance')
+        level = data.get('level')
+        usage = data.get('usage_details') or {}
+        llm_ms = performance.get('llm_service_duration_ms')
+        total_ms = performance.get('total_duration_ms')
+        for name, get_key in self.dimensions:
+            key = str(get_key(data) or '-')
+            stats = window.stats.get((name, key))
+            if stats is None:
+                if window.keys[name] >= self.max_keys:
+                    key = OTHER_KEY
+                    stats = window.stats.get((name, key))
+                if stats is None:
+                    stats = window.stats[(name, key)] = RollupStats(self.relative_accuracy)
+                    window.keys[name] += 1
+            stats.add(level, usage, llm_ms, total_ms)
+        self._observed.inc()
+
+    def _records(self, kind: str, start: float, end: float, stats: Dict[Tuple[str, str], RollupStats]) -> List[Dict[str, Any]]:
+        return [{'kind': kind, 'window_start': start, 'window_end': end, 'window_seconds': end - start,
+                 'dimension': name, 'key': key, 'emitter': self.emitter, **item.to_dict()}
+                for (name, key), item in sorted(stats.items())]
+
+    def _close(self, window: _Window) -> List[Dict[str, Any]]:
+        end = window.start + self.window
+        self._closed_until = max(self._closed_until, end)
+        records = self._records('tumbling', window.start, end, window.stats)
+        if self.sliding_windows > 1:
+            self._history.append(window)
+            merged: Dict[Tuple[str, str], RollupStats] = {}
+            for past in self._history:
+                for key, item in past.stats.items():
+                    target = merged.get(key)
+                    if target is None:
+                        target = merged[key] = RollupStats(self.relative_accuracy)
+                    target.merge(item)
+            oldest = max(self._history[0].start, end - self.sliding_windows * self.window)
+            records.extend(self._records('sliding', oldest, end, merged))
+        return records
+
+    def _due(self, flush_all: bool) -> List[_Window]:
+        now = time.monotonic()
+        due = [window for start, window in self._windows.items()
+               if flush_all or start + self.window + self.lateness <= self._watermark
+               or now - window.opened >= self.window + self.lateness]
+        return sorted(due, key=lambda window: window.start)
+
+    def _flush(self, flush_all: bool = False):
+        records = []
+        for window in self._due(flush_all):
+            del self._windows[window.start]
+            records.extend(self._close(window))
+        if records:
+            self._emit(records)
+
+    def _emit(self, records: List[Dict[str, Any]]):
+        for sink in self.sinks:
+            try:
+                sink(records)
+            except Exception as e:
+                logger.error(f"❌ 汇总记录输出失败 ({getattr(sink, 'name', sink)}): {e}")
+
+    def _drain(self):
+        while self._pending:
+            for data in self._pending.popleft():
+                self._add(data)
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self._drain()
+            self._flush()
+        self._drain()
+        self._flush(flush_all=True)
+
+    def close(self, timeout: float = 30):
+        """处理剩余的观测并输出所有未关闭的窗口。"""
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+
+# --- 输出 ---
+
+def _iso(timestamp: float) -> str:
+    return _utc_iso(datetime.fromtimestamp(timestamp, timezone.utc))
+
+
+class FileSink:
+    """追加写入 JSON Lines 文件。"""
+    name = 'file'
+
+    def __init__(self, path: str = ROLLUP_FILE):
+        self.path = path
+
+    def __call__(self, records: List[Dict[str, Any]]):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(jsoncodec.dumpb(record) + b'\n' for record in records))
+        metrics.ROLLUP_EMITTED.labels(self.name).inc(len(records))
+
+
+class LogSink:
+    """每个窗口只输出每个维度错误率最高的几个键，完整结果请使用 file 或 langfuse。"""
+    name = 'log'
+
+    def __call__(self, records: List[Dict[str, Any]]):
+        for record in records:
+            if record['kind'] == 'tumbling' and (record['errors'] or record['count'] >= 100):
+                latency = record['llm_service_duration_ms'] or {}
+                logger.info(f"📐 {record['dimension']}={record['key']}: {record['count']} 条, "
+                            f"错误率 {record['error_rate']:.1%}, token {record['total_tokens']}, "
+                            f"LLM p95 {latency.get('p95', '-')}ms")
+        metrics.ROLLUP_EMITTED.labels(self.name).inc(len(records))
+
+
+class LangfuseSink:
+    """
+    每个窗口一个 trace（按窗口确定 id，多次输出时为同一个 trace 追加），
+    每个 (维度, 键) 一个 event，统计值放在 metadata 中。
+    """
+    name = 'langfuse'
+
+    def __init__(self, client: Optional[LangfuseIngestionClient] = None):
+        self.client = client or LangfuseIngestionClient(max_connections=1)
+
+    def __call__(self, records: List[Dict[str, Any]]):
+        events = []
+        traces = set()
+        now = _utc_now_iso()
+        for record in records:
+            start = _iso(record['window_start'])
+            trace_id = f"rollup-{record['kind']}-{int(record['window_seconds'])}s-{int(record['window_start'])}"
+            if trace_id not in traces:
+                traces.add(trace_id)
+                events.append({"id": str(uuid.uuid4()), "timestamp": now, "type": "trace-create",
+                               "body": {"id": trace_id, "name": f"SLS Rollup ({record['kind']}, {int(record['window_seconds'])}s)",
+                                        "timestamp": start, "tags": ["rollup", record['kind']],
+                                        "metadata": {"window_start": start, "window_end": _iso(record['window_end'])}}})
+            stats = {key: value for key, value in record.items() if key not in ('kind', 'dimension', 'key')}
+            events.append({"id": str(uuid.uuid4()), "timestamp": now, "type": "event-create",
+                           "body": {"id": str(uuid.uuid4()), "traceId": trace_id,
+                                    "name": f"{record['dimension']}:{record['key']}", "startTime": start,
+                                    "level": "ERROR" if record['errors'] else "DEFAULT", "metadata": stats}})
+        for begin in range(0, len(events), 200):
+            if not self.client.send_events(events[begin:begin + 200]):
+                metrics.ROLLUP_EMITTED.labels('failed').inc()
+                raise RuntimeError("Langfuse 拒绝了部分汇总事件")
+        metrics.ROLLUP_EMITTED.labels(self.name).inc(len(records))
+
+    def close(self):
+        self.client.close()
+
+
+SINKS = {'langfuse': LangfuseSink, 'file': FileSink, 'log': LogSink}
+
+_aggregator: Optional[RollupAggregator] = None
+_aggregator_lock = threading.Lock()
+
+
+def get_rollup_aggregator() -> Optional[RollupAggregator]:
+    """进程内共享的窗口汇总；ROLLUP_ENABLED=false 时返回 None。"""
+    global _aggregator
+    if not ROLLUP_ENABLED:
+        return None
+    with _aggregator_lock:
+        if _aggregator is None:
+            names = [name.strip() for name in ROLLUP_SINKS.split(',') if name.strip()]
+            unknown = [name for name in names if name not in SINKS]
+            if unknown:
+                raise ValueError(f"未知的 ROLLUP_SINKS {unknown}，可选值: {', '.join(SINKS)}")
+            _aggregator = RollupAggregator([SINKS[name]() for name in names]).start()
+        return _aggregator
+
+
+def close_rollups():
+    """输出剩余窗口并关闭 sinks。"""
+    global _aggregator
+    with _aggregator_lock:
+        aggregator, _aggregator = _aggregator, None
+    if aggregator is None:
+        return
+    aggregator.close()
+    for sink in aggregator.sinks:
+        if hasattr(sink, 'close'):
+            sink.close()
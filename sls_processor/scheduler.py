@@ -0,0 +1,360 @@
+# sls_processor/scheduler.py
+
+"""
+队列与发送端之间的公平调度阶段。
+
+所有记录原本按到达顺序（FIFO）发送：某个租户的批量任务涌入队列时，其他租户的交互请求要排在它后面。
+调度器从队列取出记录，按 FAIR_SCHEDULING_KEY（如 ai_log 的 consumer、_namespace_、route_name）
+放入各自的子队列，再按加权赤字轮询（DRR，按字节计量）交给发送端：
+
+- 权重：FAIR_SCHEDULING_WEIGHTS，每轮每个键可发送 quantum × 权重 字节，默认权重 1。
+- 限速：FAIR_SCHEDULING_RATE_LIMITS / FAIR_SCHEDULING_DEFAULT_RATE_LIMIT（条/秒，令牌桶），
+  超速的键暂不发送，记录留在子队列中。
+- 优先级：FAIR_SCHEDULING_PRIORITIZE_ERRORS 时 response_code >= 400 的记录（Langfuse 中的
+  WARNING/ERROR）先于其他记录发送，同一优先级内仍按 DRR 轮询。
+- 内存有界：缓冲的记录数、字节数达到上限时暂停取数，反压留在上游队列（上游仍为 FIFO），
+  因此公平性只在缓冲范围内生效。停止时忽略限速，把缓冲的记录全部交给发送端。
+
+记录的确认句柄随记录一起调度；不同键的记录会乱序确认，检查点仍只推进到最高的连续已确认游标。
+"""
+
+import collections
+import logging
+import math
+import os
+import re
+import threading
+import time
+from queue import Empty
+from typing import Callable, Deque, Dict, List, Mapping, Optional, Tuple
+
+from . import metrics
+from .mapping import to_int
+from .records import peek_field, record_size
+
+logger = logging.getLogger(__name__)
+
+# --- 公平调度配置 (键为空表示不启用) ---
+FAIR_SCHEDULING_KEY = os.getenv('FAIR_SCHEDULING_KEY', '')  # ai.consumer / _namespace_ / route_name / 任意日志字段
+FAIR_SCHEDULING_WEIGHTS = os.getenv('FAIR_SCHEDULING_WEIGHTS', '')  # tenant-a=4,batch=0.5
+FAIR_SCHEDULING_RATE_LIMITS = os.getenv('FAIR_SCHEDULING_RATE_LIMITS', '')  # batch=50 (条/秒)
+FAIR_SCHEDULING_DEFAULT_RATE_LIMIT = float(os.getenv('FAIR_SCHEDULING_DEFAULT_RATE_LIMIT', '0'))
+FAIR_SCHEDULING_PRIORITIZE_ERRORS = os.getenv('FAIR_SCHEDULING_PRIORITIZE_ERRORS', 'true').lower() in ('1', 'true', 'yes')
+FAIR_SCHEDULING_QUANTUM_KB = float(os.getenv('FAIR_SCHEDULING_QUANTUM_KB', '16'))
+FAIR_SCHEDULING_MAX_RECORDS = int(os.getenv('FAIR_SCHEDULING_MAX_RECORDS', '50000'))
+FAIR_SCHEDULING_MAX_MB = float(os.getenv('FAIR_SCHEDULING_MAX_MB', '256'))
+FAIR_SCHEDULING_MAX_KEYS = int(os.getenv('FAIR_SCHEDULING_MAX_KEYS', '500'))
+
+DEFAULT_KEY = '-'  # 记录中没有该字段
+OTHER_KEY = '_other'  # 超过 FAIR_SCHEDULING_MAX_KEYS 后出现的键
+PRIORITY_NAMES = ('error', 'normal')
+
+
+def _check_value(name: str, key: Optional[str], value: float, allow_zero: bool) -> float:
+    """权重必须大于 0（否则该键的赤字永不增长，轮询会空转），限速不能为负数。"""
+    if not math.isfinite(value) or value < 0 or (value == 0 and not allow_zero):
+        item = f"{key}={value:g}" if key is not None else f"{value:g}"
+        raise ValueError(f"无效的 {name} 项 {item}，数值必须{'不小于' if allow_zero else '大于'} 0")
+    return value
+
+
+def parse_key_values(spec: str, name: str = 'FAIR_SCHEDULING_WEIGHTS', allow_zero: bool = False) -> Dict[str, float]:
+    """解析 "a=1,b=2.5" 形式的配置；数值必须大于 0（allow_zero 时可以为 0）。"""
+    values = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        key, sep, value = part.rpartition('=')
+        if not sep or not key.strip():
+            raise ValueError(f"无效的配置项 {part!r}，格式应为 键=数值")
+        values[key.strip()] = _check_value(name, key.strip(), float(value), allow_zero)
+    return values
+
+
+def key_getter(field: str) -> Callable[[Mapping], str]:
+    """
+    返回从记录中读取调度键的函数。"ai.<字段>" 从 ai_log 中读取：只用正则查找该字段的值，
+    不解析整个 JSON（解析在发送端转换时进行）。
+    """
+    if field.startswith('ai.'):
+        pattern = re.compile(r'"' + re.escape(field[3:]) + r'"\s*:\s*"?([^",}]*)')
+
+        def get_ai(record: Mapping) -> str:
+            ai_log = peek_field(record, 'ai_log')
+            match = pattern.search(ai_log) if isinstance(ai_log, str) else None
+            return (match.group(1).strip() or DEFAULT_KEY) if match else DEFAULT_KEY
+        return get_ai
+
+    def get_log(record: Mapping) -> str:
+        return peek_field(record, field) or DEFAULT_KEY
+    return get_log
+
+
+class _TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.burst = max(1.0, rate)  # 最多允许 1 秒的突发
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class _KeyState:
+    __slots__ = ('key', 'weight', 'bucket', 'queues', 'deficits', 'dispatched')
+
+    def __init__(self, key: str, weight: float, rate: float):
+        self.key = key
+        self.weight = weight
+        self.bucket = _TokenBucket(rate) if rate > 0 else None
+        # 每个优先级一个子队列，元素为 (item, 字节数, 入队时间)
+        self.queues: Tuple[Deque[tuple], ...] = tuple(collections.deque() for _ in PRIORITY_NAMES)
+        self.deficits = [0.0] * len(PRIORITY_NAMES)
+        self.dispatched = [metrics.SCHEDULER_DISPATCHED.labels(key, name) for name in PRIORITY_NAMES]
+
+    def backlog(self) -> int:
+        return sum(len(queue) for queue in self.queues)
+
+    def oldest_age(self) -> float:
+        started = [queue[0][2] for queue in self.queues if queue]
+        return time.monotonic() - min(started) if started else 0.0
+
+
+class FairScheduler:
+    """
+    包装 SpillQueue 的调度阶段：后台线程从 source 取记录放入各键的子队列，
+    发送端通过 get_batch / get / get_nowait 按 DRR 顺序取出，接口与 SpillQueue 一致。
+    """
+
+    def __init__(self, source, key_field: str, weights: Optional[Dict[str, float]] = None,
+                 rate_limits: Optional[Dict[str, float]] = None,
+                 default_rate_limit: float = FAIR_SCHEDULING_DEFAULT_RATE_LIMIT,
+                 prioritize_errors: bool = FAIR_SCHEDULING_PRIORITIZE_ERRORS,
+                 quantum: int = int(FAIR_SCHEDULING_QUANTUM_KB * 1024),
+                 max_records: int = FAIR_SCHEDULING_MAX_RECORDS,
+                 max_bytes: int = int(FAIR_SCHEDULING_MAX_MB * 1024 * 1024),
+                 max_keys: int = FAIR_SCHEDULING_MAX_KEYS):
+        self.source = source
+        self.key_field = key_field
+        self.weights = {key: _check_value('FAIR_SCHEDULING_WEIGHTS', key, weight, False)
+                        for key, weight in (weights or {}).items()}
+        self.rate_limits = {key: _check_value('FAIR_SCHEDULING_RATE_LIMITS', key, rate, True)
+                            for key, rate in (rate_limits or {}).items()}
+        self.default_rate_limit = _check_value('FAIR_SCHEDULING_DEFAULT_RATE_LIMIT', None, default_rate_limit, True)
+        self.prioritize_errors = prioritize_errors
+        self.quantum = max(1, quantum)
+        self.max_records = max(1, max_records)
+        self.max_bytes = max_bytes
+        self.max_keys = max(1, max_keys)
+        self._get_key = key_getter(key_field)
+        self._keys: Dict[str, _KeyState] = {}
+        # 每个优先级一个轮询环，只包含该优先级子队列非空的键；_visiting 为本轮已获得配额的环首
+        self._active: Tuple[Deque[_KeyState], ...] = tuple(collections.deque() for _ in PRIORITY_NAMES)
+        self._visiting: List[Optional[_KeyState]] = [None] * len(PRIORITY_NAMES)
+        self._buffered = 0
+        self._buffered_bytes = 0
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="FairScheduler", daemon=True)
+
+    def start(self) -> 'FairScheduler':
+        self._thread.start()
+        logger.info(f"⚖️ 公平调度已启用: 按 {self.key_field} 分组, 权重 {self.weights or '均为 1'}, "
+                    f"限速 {self.rate_limits or '无'} (默认 {self.default_rate_limit or '不限'}), "
+                    f"错误优先 {'是' if self.prioritize_errors else '否'}, 最多缓冲 {self.max_records} 条 / "
+                    f"{self.max_bytes / 1024 / 1024:.0f}MB")
+        return self
+
+    # --- 入队 ---
+
+    def _state(self, key: str) -> _KeyState:
+        state = self._keys.get(key)
+        if state is None:
+            if len(self._keys) >= self.max_keys and key not in self.weights and key not in self.rate_limits:
+                key = OTHER_KEY
+                state = self._keys.get(key)
+                if state is not None:
+                    return state
+            state = self._keys[key] = _KeyState(key, self.weights.get(key, 1.0),
+                                                self.rate_limits.get(key, self.default_rate_limit))
+            metrics.SCHEDULER_BACKLOG.labels(key).set_function(state.backlog)
+            metrics.SCHEDULER_OLDEST_SECONDS.labels(key).set_function(state.oldest_age)
+        return state
+
+    def _priority(self, record: Mapping) -> int:
+        if self.prioritize_errors:
+            code = to_int(peek_field(record, 'response_code'))
+            if code is not None and code >= 400:
+                return 0
+        return 1
+
+    def _add(self, item: tuple):
+        record = item[0]
+        state = self._state(self._get_key(record))
+        priority = self._priority(record)
+        size = record_size(record)
+        queue = state.queues[priority]
+        if not queue:
+            self._active[priority].append(state)
+        queue.append((item, size, time.monotonic()))
+        self._buffered += 1
+        self._buffered_bytes += size
+
+    def _full(self) -> bool:
+        return self._buffered >= self.max_records or self._buffered_bytes >= self.max_bytes
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._full() and not self._closing:
+                    self._cond.wait(0.1)
+                closing = self._closing
+            try:
+                item = self.source.get_nowait() if closing else self.source.get(timeout=0.1)
+            except Empty:
+                item = None
+            with self._cond:
+                if item is not None:
+                    self._add(item)
+                    self._cond.notify_all()
+                elif closing:
+                    self._cond.notify_all()
+                    return
+
+    def close(self, timeout: float = 10):
+        """取空 source，之后忽略限速，把缓冲的记录全部交给发送端。"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    # --- 调度 ---
+
+    def _pick(self, now: float) -> Tuple[Optional[tuple], float]:
+        """按优先级和 DRR 取出一条记录；没有可发送的记录时返回 (None, 建议等待秒数)。"""
+        wait = 0.1
+        for priority, ring in enumerate(self._active):
+            throttled = 0  # 连续跳过的超速键，整个环都超速时转到下一优先级
+            while ring and throttled < len(ring):
+                state = ring[0]
+                queue = state.queues[priority]
+                bucket = None if self._closing else state.bucket
+                if bucket is not None and not bucket.available(now):
+                    wait = min(wait, bucket.wait_time(now))
+                    self._visiting[priority] = None
+                    ring.rotate(-1)
+                    throttled += 1
+                    continue
+                throttled = 0
+                if self._visiting[priority] is not state:
+                    self._visiting[priority] = state
+                    state.deficits[priority] += self.quantum * state.weight
+                item, size, _ = queue[0]
+                if size > state.deficits[priority]:
+                    self._visiting[priority] = None  # 配额不足，累积到下一轮
+                    ring.rotate(-1)
+                    continue
+                queue.popleft()
+                state.deficits[priority] -= size
+                if bucket is not None:
+                    bucket.take()
+                if not queue:
+                    state.deficits[priority] = 0  # 空闲的键不保留配额
+                    self._visiting[priority] = None
+                    ring.popleft()
+                self._buffered -= 1
+                self._buffered_bytes -= size
+                state.dispatched[priority].inc()
+                return item, 0.0
+        return None, wait
+
+    def _pop(self, max_items: int) -> List[tuple]:
+        now = time.monotonic()
+        batch = []
+        while len(batch) < max_items:
+            item, _ = self._pick(now)
+            if item is None:
+                break
+            batch.append(item)
+        if batch:
+            self._cond.notify_all()
+        return batch
+
+    def _wait_pop(self, max_items: int, timeout: Optional[float]) -> List[tuple]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            item, wait = self._pick(time.monotonic())
+            if item is not None:
+                self._cond.notify_all()
+                return [item] + self._pop(max_items - 1)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return []
+            self._cond.wait(wait if remaining is None else min(wait, remaining))
+
+    def get_batch(self, max_items: int, timeout: float, max_wait: float) -> List[tuple]:
+        """等待最多 timeout 秒取到第一条，再在 max_wait 秒内继续按调度顺序攒到 max_items 条。"""
+        with self._cond:
+            batch = self._wait_pop(max_items, timeout)
+            if not batch:
+                return batch
+            deadline = time.monotonic() + max_wait
+            while len(batch) < max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                more = self._wait_pop(max_items - len(batch), remaining)
+                if not more:
+                    break
+                batch.extend(more)
+            return batch
+
+    def get(self, block: bool = True, timeout: float = None) -> tuple:
+        with self._cond:
+            batch = self._wait_pop(1, timeout if block else 0)
+            if not batch:
+                raise Empty
+            return batch[0]
+
+    def get_nowait(self) -> tuple:
+        return self.get(block=False)
+
+    # --- 状态 ---
+
+    def qsize(self) -> int:
+        return self.source.qsize() + self._buffered
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def backlog(self) -> Dict[str, int]:
+        with self._cond:
+            return {key: state.backlog() for key, state in self._keys.items() if state.backlog()}
+
+    def watch(self):
+        self.source.watch()
+
+
+def maybe_schedule(source, key_field: str = FAIR_SCHEDULING_KEY):
+    """配置了 FAIR_SCHEDULING_KEY 时返回已启动的 FairScheduler，否则原样返回 source。"""
+    if not key_field:
+        return source
+    return FairScheduler(source, key_field, weights=parse_key_values(FAIR_SCHEDULING_WEIGHTS),
+                         rate_limits=parse_key_values(FAIR_SCHEDULING_RATE_LIMITS, 'FAIR_SCHEDULING_RATE_LIMITS',
+                                                      allow_zero=True)).start()
@@ -0,0 +1,413 @@
+# sls_processor/sender_pool.py
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from queue import Queue, Empty
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import metrics
+from .log_utils import RateLimitedLogger, Sampler
+from .profiling import DEQUEUED, SENT, TRANSFORMED, StageTracer, get_stage_tracer
+from .records import peek_field
+from .resilience import AdaptiveConcurrency, CircuitBreaker, SendResults, backoff_delay
+
+logger = logging.getLogger(__name__)
+limited_logger = RateLimitedLogger(logger)
+success_sampler = Sampler()
+
+# 队列元素：(SLS日志字典, 批次确认句柄)；句柄为 None 时无需确认
+QueueItem = Tuple[Dict[str, Any], Optional[Any]]
+
+# 重试堆中等待重写死信的记录（写入失败后）以它代替载荷
+_DEAD_LETTER = object()
+
+
+def _ack(item: QueueItem):
+    if item[1] is not None:
+        item[1].done()
+
+
+def short_trace_id(item: QueueItem) -> str:
+    return str(peek_field(item[0], 'trace_id') or 'N/A')[:16]
+
+
+def transform_guarded(transform_batch: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]],
+                      convert: Callable[[Dict[str, Any]], Dict[str, Any]],
+                      batch: List[QueueItem]) -> Tuple[List[QueueItem], List[Dict[str, Any]], List[QueueItem]]:
+    """
+    整批转换，返回 (可发送的元素, 对应的载荷, 无法转换的元素)。
+    整批转换抛出异常时改为逐条转换，只有出错的记录被剔除，同批其它记录照常发送。
+    """
+    try:
+        return batch, transform_batch([item[0] for item in batch]), []
+    except Exception as e:
+        limited_logger.error('transform_failed', f"❌ 批量转换失败，改为逐条转换: {e!r}")
+    kept, payloads, rejected = [], [], []
+    for item in batch:
+        try:
+            payloads.append(convert(item[0]))
+            kept.append(item)
+        except Exception as e:
+            limited_logger.error('convert_failed', f"❌ 记录无法转换，转入死信队列: Trace [ {short_trace_id(item)}... ] {e!r}")
+            rejected.append(item)
+    return kept, payloads, rejected
+
+
+def send_guarded(sender, payloads: List[Dict[str, Any]], breaker: Optional[CircuitBreaker],
+                 limiter: Optional[AdaptiveConcurrency]) -> Optional[SendResults]:
+    """
+    经熔断器和并发限制器发送一批；熔断打开时不发送并返回 None。
+    只有整批未送达（transport_failed：连接错误、超时、非 2xx）计为一次失败样本，
+    逐条被拒绝的记录不影响熔断和并发；批次耗时同时作为自适应并发的延迟样本。
+    """
+    if breaker is not None and not breaker.allow():
+        return None
+    if limiter is not None:
+        limiter.acquire()
+    started = time.monotonic()
+    results = SendResults.failed(len(payloads))
+    try:
+        results = SendResults.of(sender.send_batch(payloads))
+    finally:
+        latency = time.monotonic() - started
+        succeeded = sum(results)
+        metrics.record_send(latency, succeeded, len(results) - succeeded)
+        ok = not results.transport_failed
+        if limiter is not None:
+            limiter.release(latency, ok)
+        if breaker is not None:
+            breaker.record(ok)
+    return results
+
+
+def send_or_fail(sender, payloads: List[Dict[str, Any]], breaker: Optional[CircuitBreaker],
+                 limiter: Optional[AdaptiveConcurrency]) -> Optional[SendResults]:
+    """send_guarded 的异常（如编码失败）按整批发送失败处理，记录进入重试，最终写入死信。"""
+    try:
+        return send_guarded(sender, payloads, breaker, limiter)
+    except Exception as e:
+        limited_logger.error('send_error', f"❌ 批量发送异常 ({len(payloads)} 条): {e!r}", exc_info=True)
+        return SendResults.failed(len(payloads))
+
+
+class RetryScheduler:
+    """
+    带外重试调度器：失败的记录按带抖动的指数退避时间放入最小堆，由独立线程批量重发，
+    不阻塞从队列取数的发送线程。
+    """
+
+    def __init__(self, sender, dead_letter: Callable[[List[Dict[str, Any]]], bool], stats: Dict[str, int],
+                 stats_lock: threading.Lock, max_retries: int, retry_delay: float, batch_size: int,
+                 max_retry_delay: float = 60.0, breaker: Optional[CircuitBreaker] = None,
+                 limiter: Optional[AdaptiveConcurrency] = None):
+        self.sender = sender
+        self.dead_letter = dead_letter
+        self.stats = stats
+        self.stats_lock = stats_lock
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.batch_size = batch_size
+        self.breaker = breaker
+        self.limiter = limiter
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = self._new_thread()
+
+    def _new_thread(self) -> threading.Thread:
+        return threading.Thread(target=self._run, name="LangfuseRetryThread", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def supervise(self) -> bool:
+        """重试线程意外退出时重启（堆中的记录仍在），返回是否重启。"""
+        with self._cond:
+            if self._stopping or self._thread.is_alive():
+                return False
+        logger.error("🚨 重试线程意外退出，正在重启")
+        self._thread = self._new_thread()
+        self._thread.start()
+        return True
+
+    def schedule(self, item: QueueItem, payload: Dict[str, Any], attempt: int):
+        """attempt 为已失败的次数；超过上限直接进入死信队列。"""
+        if attempt >= self.max_retries:
+            self._give_up([item])
+            return
+        due = time.monotonic() + backoff_delay(attempt, self.retry_delay, self.max_retry_delay)
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), attempt, item, payload))
+            self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def stop(self, timeout: float = 30):
+        """停止时不再等待到期时间，剩余记录立即做最后一次尝试。"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout=timeout)
+
+    def _give_up(self, items: List[QueueItem]):
+        """写入死信队列成功才确认；写入失败则不确认，检查点不会越过这些记录。"""
+        with self.stats_lock:
+            self.stats['error'] += len(items)
+            self.stats['dead_letter'] += len(items)
+        metrics.DEAD_LETTER_RECORDS.labels('exhausted').inc(len(items))
+        limited_logger.error('give_up', f"🚨 {len(items)} 条记录发送最终失败，已转入死信队列: "
+                                        f"Trace [ {short_trace_id(items[0])}... ] 等")
+        self._write_dead_letter(items)
+
+    def reject(self, items: List[QueueItem]):
+        """无法转换的记录重试也不会成功，直接写入死信存储（回放时仍无法转换的移入 rejected 文件）。"""
+        with self.stats_lock:
+            self.stats['error'] += len(items)
+            self.stats['dead_letter'] += len(items)
+        metrics.DEAD_LETTER_RECORDS.labels('transform_error').inc(len(items))
+        self._write_dead_letter(items)
+
+    def divert(self, items: List[QueueItem]):
+        """熔断打开期间不再尝试发送，记录直接写入死信存储，由回放线程在恢复后补发。"""
+        with self.stats_lock:
+            self.stats['diverted'] += len(items)
+            self.stats['dead_letter'] += len(items)
+        metrics.DEAD_LETTER_RECORDS.labels('circuit_open').inc(len(items))
+        limited_logger.warning('divert', f"⚡ 熔断打开，{len(items)} 条记录直接写入死信存储")
+        self._write_dead_letter(items)
+
+    def _write_dead_letter(self, items: List[QueueItem], attempt: int = 0):
+        """
+        写入成功后确认。写入失败（磁盘满、加锁失败等）时记录留在重试堆中，退避后重写，
+        既不确认也不丢弃；停止时仍失败的记录不确认，由检查点保证重启后重新消费。
+        """
+        try:
+            written = self.dead_letter([item[0] for item in items])
+        except Exception as e:
+            logger.error(f"❌ 写入死信队列异常: {e!r}", exc_info=True)
+            written = False
+        if written:
+            for item in items:
+                _ack(item)
+            return
+        with self._cond:
+            if self._stopping:
+                logger.error(f"🚨 {len(items)} 条记录无法写入死信队列，停止前不再重试；"
+                             f"它们未被确认，重启后会重新消费")
+                return
+            delay = backoff_delay(attempt + 1, self.retry_delay, self.max_retry_delay)
+            due = time.monotonic() + delay
+            for item in items:
+                heapq.heappush(self._heap, (due, next(self._seq), attempt + 1, item, _DEAD_LETTER))
+            self._cond.notify()
+        limited_logger.error('dead_letter_failed', f"🚨 {len(items)} 条记录写入死信队列失败，"
+                                                   f"{delay:.0f}s 后重试")
+
+    def _take_due(self) -> List[tuple]:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._heap and (self._stopping or self._heap[0][0] <= now):
+                    due = []
+                    while self._heap and len(due) < self.batch_size and \
+                            (self._stopping or self._heap[0][0] <= now):
+                        due.append(heapq.heappop(self._heap))
+                    return due
+                if self._stopping:
+                    return []
+                self._cond.wait(timeout=(self._heap[0][0] - now) if self._heap else None)
+
+    def _run(self):
+        while True:
+            due = self._take_due()
+            if not due:
+                return
+            pending = [entry for entry in due if entry[4] is _DEAD_LETTER]
+            if pending:
+                self._write_dead_letter([entry[3] for entry in pending], attempt=max(entry[2] for entry in pending))
+                due = [entry for entry in due if entry[4] is not _DEAD_LETTER]
+                if not due:
+                    continue
+            metrics.RETRIES.inc(len(due))
+            results = send_or_fail(self.sender, [item[4] for item in due], self.breaker, self.limiter)
+            if results is None:
+                self.divert([item[3] for item in due])
+                continue
+            exhausted = []
+            for (_, _, attempt, item, payload), ok in zip(due, results):
+                if ok:
+                    with self.stats_lock:
+                        self.stats['success'] += 1
+                    _ack(item)
+                    continue
+                with self.stats_lock:
+                    self.stats['retries'] += 1
+                if self._stopping or attempt + 1 >= self.max_retries:
+                    exhausted.append(item)
+                else:
+                    self.schedule(item, payload, attempt + 1)
+            if exhausted:
+                self._give_up(exhausted)
+
+
+class SenderPool:
+    """
+    发送线程池：每个线程从共享队列按大小和时间上限攒批，
+    转换后通过批量接口并发发送到Langfuse，失败记录交给 RetryScheduler。
+    传入 breaker / limiter 时，发送经熔断器和自适应并发限制器控制，线程数即并发上限。
+    """
+
+    def __init__(self, log_queue: Queue, sender, convert: Callable[[Dict[str, Any]], Dict[str, Any]],
+                 dead_letter: Callable[[List[Dict[str, Any]]], bool], concurrency: int = 4,
+                 batch_size: int = 100, batch_max_wait: float = 0.5,
+                 max_retries: int = 3, retry_delay: float = 5.0, max_retry_delay: float = 60.0,
+                 breaker: Optional[CircuitBreaker] = None, limiter: Optional[AdaptiveConcurrency] = None,
+                 transform_batch: Optional[Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]] = None,
+                 rollups=None):
+        self.log_queue = log_queue
+        # SpillQueue / TraceAggregator 提供整批取数（聚合后的记录组不会被拆到不同批次）
+        self._get_batch = getattr(log_queue, 'get_batch', None)
+        self.sender = sender
+        self.convert = convert
+        # 可选的整批转换函数（如多进程 TransformPool.transform），默认逐条调用 convert
+        self.transform_batch = transform_batch or (lambda records: [convert(record) for record in records])
+        # 可选的窗口汇总：转换后的整批交给后台线程统计，不阻塞发送
+        self.rollups = rollups
+        self.tracer = get_stage_tracer()
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.batch_max_wait = batch_max_wait
+        self.stats = {'processed': 0, 'success': 0, 'error': 0, 'skipped': 0,
+                      'retries': 0, 'dead_letter': 0, 'diverted': 0, 'batches': 0}
+        self.stats_lock = threading.Lock()
+        self.breaker = breaker
+        self.limiter = limiter
+        self.retry = RetryScheduler(sender, dead_letter, self.stats, self.stats_lock,
+                                    max_retries, retry_delay, self.batch_size,
+                                    max_retry_delay=max_retry_delay, breaker=breaker, limiter=limiter)
+        self._stop_event = threading.Event()
+        self._threads = [self._new_thread(i) for i in range(self.concurrency)]
+
+    def _new_thread(self, index: int) -> threading.Thread:
+        return threading.Thread(target=self._guarded_run, name=f"LangfuseSender-{index}", daemon=True)
+
+    def start(self):
+        self.retry.start()
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"🚀 发送线程池已启动: 并发 {self.concurrency}, 批大小 {self.batch_size}, "
+                    f"最长攒批 {self.batch_max_wait * 1000:.0f}ms")
+
+    def stop(self, timeout: float = 30):
+        """通知发送线程在队列取空后退出，然后处理剩余的重试。"""
+        self._stop_event.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        self.retry.stop(timeout=max(0.0, deadline - time.monotonic()))
+
+    def is_alive(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def supervise(self) -> int:
+        """由主循环定期调用：重启意外退出的发送线程和重试线程，返回重启的线程数。"""
+        if self._stop_event.is_set():
+            return 0
+        restarted = int(self.retry.supervise())
+        for index, thread in enumerate(self._threads):
+            if not thread.is_alive():
+                logger.error(f"🚨 发送线程 {thread.name} 意外退出，正在重启")
+                self._threads[index] = self._new_thread(index)
+                self._threads[index].start()
+                restarted += 1
+        return restarted
+
+    def _drain(self) -> List[QueueItem]:
+        """取一批：先阻塞等待第一条，再在 batch_max_wait 内尽量凑满 batch_size。"""
+        if self._get_batch is not None:
+            return self._get_batch(self.batch_size, 0.5, self.batch_max_wait)
+        try:
+            batch = [self.log_queue.get(timeout=0.5)]
+        except Empty:
+            return []
+        deadline = time.monotonic() + self.batch_max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self.log_queue.get_nowait())
+                else:
+                    batch.append(self.log_queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _guarded_run(self):
+        """线程入口：批次处理中未预料的异常只记录日志，线程继续取下一批（supervise 之外的第一道防线）。"""
+        while True:
+            try:
+                self._run()
+                return
+            except Exception as e:
+                logger.error(f"❌ 发送线程异常，继续处理后续批次: {e!r}", exc_info=True)
+
+    def _run(self):
+        while True:
+            batch = self._drain()
+            if not batch:
+                if self._stop_event.is_set():
+                    return
+                continue
+
+            tracing = self.tracer is not None
+            if tracing:
+                StageTracer.mark(batch, DEQUEUED)
+            metrics.BATCH_SIZE.observe(len(batch))
+            started = time.monotonic()
+            batch, payloads, rejected = transform_guarded(self.transform_batch, self.convert, batch)
+            metrics.TRANSFORM_SECONDS.observe(time.monotonic() - started)
+            if rejected:
+                self.retry.reject(rejected)
+                with self.stats_lock:
+                    self.stats['processed'] += len(rejected)
+                if not batch:
+                    continue
+            if tracing:
+                StageTracer.mark(batch, TRANSFORMED)
+            if self.rollups is not None:
+                self.rollups.observe(payloads)
+            results = send_or_fail(self.sender, payloads, self.breaker, self.limiter)
+            if tracing and results is not None:
+                StageTracer.mark(batch, SENT)
+            if results is None:
+                self.retry.divert(batch)
+                with self.stats_lock:
+                    self.stats['processed'] += len(batch)
+                continue
+
+            succeeded = 0
+            for item, payload, ok in zip(batch, payloads, results):
+                if ok:
+                    succeeded += 1
+                    _ack(item)
+                    if success_sampler():
+                        logger.info(f"✅ 发送成功 (抽样 1/{success_sampler.every}): "
+                                    f"Trace [ {short_trace_id(item)}... ] | "
+                                    f"API [ {payload.get('trace_name', 'N/A')} ]")
+                else:
+                    self.retry.schedule(item, payload, attempt=1)
+            if succeeded < len(batch):
+                limited_logger.warning('send_failed', f"❌ 批量发送失败 {len(batch) - succeeded}/{len(batch)} 条，转入重试")
+
+            with self.stats_lock:
+                self.stats['processed'] += len(batch)
+                self.stats['success'] += succeeded
+                self.stats['batches'] += 1
+            logger.debug(f"批量发送完成: {succeeded}/{len(batch)} 条成功")
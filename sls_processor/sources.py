@@ -0,0 +1,262 @@
+# sls_processor/sources.py
+
+"""
+输入源：把 (日志内容, ack) 放入队列，之后的转换、聚合、发送阶段与输入来源无关。
+
+- SLSConsumerSource：消费组实时消费（默认），ack 推进 SLS 检查点。
+- FileSource：读取 SLS 导出的 JSON Lines 或 OSS 投递的 CSV（可为 .gz），"-" 表示标准输入。
+  用于批量补录导出文件，以及不需要 SLS 凭证的压测。文件是有限输入，读完后服务把队列发送完毕再退出。
+
+通过 INPUT_SOURCE=sls|file 选择；file 模式读取 INPUT_FILES（逗号分隔，支持通配符）。
+"""
+
+import concurrent.futures
+import csv
+import glob
+import gzip
+import io
+import itertools
+import logging
+import mmap
+import os
+import sys
+import threading
+import time
+from queue import Full
+from typing import Any, Dict, Iterator, List, Optional
+
+from . import jsoncodec, metrics
+from .consumer import is_valid_trace_id, start_sls_consumer_worker
+from .log_utils import RateLimitedLogger
+from .profiling import StageTracer, get_stage_tracer
+
+logger = logging.getLogger(__name__)
+limited_logger = RateLimitedLogger(logger)
+
+# --- 输入源配置 ---
+INPUT_SOURCE = os.getenv('INPUT_SOURCE', 'sls').lower()  # sls / file
+INPUT_FILES = os.getenv('INPUT_FILES', '')
+INPUT_FORMAT = os.getenv('INPUT_FORMAT', 'auto').lower()  # auto / jsonl / csv
+INPUT_FILE_PARALLELISM = int(os.getenv('INPUT_FILE_PARALLELISM', '4'))
+INPUT_CHUNK_MB = float(os.getenv('INPUT_CHUNK_MB', '4'))
+
+INPUT_FORMATS = ('auto', 'jsonl', 'csv')
+STDIN = '-'
+
+
+class Source:
+    """输入源接口。"""
+    name = 'source'
+
+    def start(self, log_queue):
+        """开始向 log_queue 放入 (日志内容, ack)，不阻塞调用方。"""
+        raise NotImplementedError
+
+    def finished(self) -> bool:
+        """有限输入已全部入队时返回 True；持续消费的输入源始终返回 False。"""
+        return False
+
+    def shutdown(self):
+        """停止产生新记录。"""
+        raise NotImplementedError
+
+
+class SLSConsumerSource(Source):
+    """SLS 消费组：由 SDK 的 ConsumerWorker 拉取，ack 推进检查点。"""
+    name = 'sls'
+
+    def __init__(self, config):
+        self.config = config
+        self.worker = None
+
+    def start(self, log_queue):
+        self.worker = start_sls_consumer_worker(self.config, log_queue)
+
+    def shutdown(self):
+        if self.worker is not None:
+            self.worker.shutdown()
+
+
+def _normalize(record: Dict[str, Any]) -> Dict[str, Any]:
+    """导出文件中的数字、嵌套对象（如已展开的 ai_log）转回与 SLS 日志一致的字符串。"""
+    for value in record.values():
+        if not isinstance(value, str):
+            break
+    else:
+        return record
+    return {key: value if isinstance(value, str) else
+            (jsoncodec.dumps(value) if isinstance(value, (dict, list)) else
+             ('' if value is None else str(value)))
+            for key, value in record.items()}
+
+
+def _detect_format(path: str, fmt: str) -> str:
+    if fmt != 'auto':
+        return fmt
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.endswith('.csv') else 'jsonl'
+
+
+def _iter_jsonl_chunks(path: str, chunk_bytes: int) -> Iterator[List[bytes]]:
+    """按约 chunk_bytes 字节一块产出行；普通文件用 mmap 读取，不整体载入内存。"""
+    if path == STDIN:
+        while lines := sys.stdin.buffer.readlines(chunk_bytes):
+            yield lines
+        return
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:  # zlib 解压时释放 GIL，多文件可并行解压
+            while lines := f.readlines(chunk_bytes):
+                yield lines
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            position, size = 0, len(data)
+            while position < size:
+                end = data.find(b'\n', min(size, position + chunk_bytes))
+                end = size if end < 0 else end + 1
+                yield data[position:end].splitlines()
+                position = end
+
+
+def _iter_csv_chunks(path: str, chunk_bytes: int) -> Iterator[List[Dict[str, str]]]:
+    """CSV 首行为字段名；按行数分块（按平均 1KB/行估算）。"""
+    if path == STDIN:
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    elif path.endswith('.gz'):
+        stream = gzip.open(path, 'rt', encoding='utf-8', newline='')
+    else:
+        stream = open(path, 'r', encoding='utf-8', newline='')
+    rows_per_chunk = max(1, chunk_bytes // 1024)
+    csv.field_size_limit(sys.maxsize)  # question/answer 可能远超默认的 128KB
+    with stream:
+        reader = csv.DictReader(stream)
+        while rows := list(itertools.islice(reader, rows_per_chunk)):
+            yield rows
+
+
+class FileSource(Source):
+    """
+    读取导出文件：多个文件并行读取，每个文件分块解析；无效 trace_id 和无法解析的行被跳过。
+    记录没有检查点（ack 为 None），中断后需重新导入整个文件（发送去重可过滤已发送的记录）。
+    """
+    name = 'file'
+
+    def __init__(self, paths: List[str], fmt: str = INPUT_FORMAT, parallelism: int = INPUT_FILE_PARALLELISM,
+                 chunk_bytes: int = int(INPUT_CHUNK_MB * 1024 * 1024)):
+        if fmt not in INPUT_FORMATS:
+            raise ValueError(f"无效的 INPUT_FORMAT={fmt!r}，可选值: {', '.join(INPUT_FORMATS)}")
+        self.paths = paths
+        self.fmt = fmt
+        self.parallelism = max(1, parallelism)
+        self.chunk_bytes = max(4096, chunk_bytes)
+        self.stats = {'files': 0, 'records': 0, 'skipped': 0, 'malformed': 0}
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._consumed = metrics.RECORDS_CONSUMED.labels('file')
+        self.tracer = get_stage_tracer()
+
+    @staticmethod
+    def expand(patterns: List[str]) -> List[str]:
+        """展开通配符，保持参数顺序并去重；"-" 原样保留。"""
+        paths: List[str] = []
+        for pattern in patterns:
+            matches = [pattern] if pattern == STDIN else sorted(glob.glob(pattern)) or [pattern]
+            paths.extend(path for path in matches if path not in paths)
+        return paths
+
+    def start(self, log_queue):
+        self._thread = threading.Thread(target=self._run, args=(log_queue,), name="FileSource", daemon=True)
+        self._thread.start()
+
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def shutdown(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def _run(self, log_queue):
+        logger.info(f"📄 开始读取 {len(self.paths)} 个文件 (并行 {self.parallelism})")
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.parallelism, thread_name_prefix="FileReader") as executor:
+                for path, future in [(path, executor.submit(self._read, path, log_queue)) for path in self.paths]:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"❌ 读取文件失败 {path}: {e}", exc_info=True)
+        finally:
+            logger.info(f"📄 文件读取{'已中止' if self._stop.is_set() else '完成'}: {self.stats}")
+            self._done.set()
+
+    def _put(self, log_queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                log_queue.put(item, block=True, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _read(self, path: str, log_queue):
+        fmt = _detect_format(path, self.fmt)
+        chunks = _iter_csv_chunks(path, self.chunk_bytes) if fmt == 'csv' else _iter_jsonl_chunks(path, self.chunk_bytes)
+        records = skipped = malformed = 0
+        for chunk in chunks:
+            queued = records
+            pulled_ns = time.monotonic_ns() if self.tracer is not None else 0
+            for row in chunk:
+                if fmt == 'jsonl':
+                    if not row.strip():
+                        continue
+                    try:
+                        row = jsoncodec.loads(row)
+                    except ValueError:
+                        malformed += 1
+                        limited_logger.warning(f"malformed:{path}", f"⚠️ {path} 中有无法解析的行，已跳过")
+                        continue
+                    if not isinstance(row, dict):
+                        malformed += 1
+                        continue
+                trace_id = row.get('trace_id')
+                if isinstance(trace_id, (int, float)):
+                    trace_id = str(trace_id)  # 与 _normalize 一致，数字形式的 trace_id 按字符串处理
+                if not is_valid_trace_id(trace_id):
+                    skipped += 1
+                    continue
+                row = _normalize(row)
+                ack = None if self.tracer is None else self.tracer.wrap(None, row, path, pulled_ns)
+                if not self._put(log_queue, (row, ack)):
+                    break
+                if self.tracer is not None:
+                    StageTracer.queued(ack)
+                records += 1
+            self._consumed.inc(records - queued)
+            if self._stop.is_set():
+                break
+        with self._stats_lock:
+            self.stats['files'] += 1
+            self.stats['records'] += records
+            self.stats['skipped'] += skipped
+            self.stats['malformed'] += malformed
+        logger.info(f"📄 {path}: 入队 {records} 条, 跳过 {skipped} 条无效 trace, {malformed} 行无法解析")
+
+
+def build_source(config, worker_index: int = 0, workers: int = 1) -> Source:
+    """按 INPUT_SOURCE 创建输入源；多进程时文件按序号分给各工作进程。"""
+    if INPUT_SOURCE == 'file':
+        paths = FileSource.expand([p.strip() for p in INPUT_FILES.split(',') if p.strip()])
+        if not paths:
+            raise ValueError("INPUT_SOURCE=file 时必须通过 INPUT_FILES 指定文件")
+        if STDIN in paths and workers > 1:
+            raise ValueError("标准输入只能由单个工作进程读取，请设置 WORKER_PROCESSES=1")
+        return FileSource(paths[worker_index::workers])
+    if INPUT_SOURCE != 'sls':
+        raise ValueError(f"无效的 INPUT_SOURCE={INPUT_SOURCE!r}，可选值: sls, file")
+    return SLSConsumerSource(config)
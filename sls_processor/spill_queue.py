@@ -0,0 +1,264 @@
+# sls_processor/spill_queue.py
+
+"""
+按字节计量的有界队列，内存超限时溢写到本地 mmap 分段文件。
+
+- 内存中的记录按序列化大小计入 QUEUE_MAX_MEMORY_MB（同时保留条数上限），超过后新记录序列化写入
+  溢写分段；只要溢写区非空，后续记录也写入溢写区，保证整体 FIFO。
+- 未物化的 LogRecordView 固定着整个拉取结果：同一次拉取的视图在内存中时，按拉取大小计一次，
+  最后一条离开队列内存时释放；溢写的视图已序列化，不再固定拉取结果。
+- 溢写区也写满（QUEUE_SPILL_MAX_MB）时 put 阻塞，对 SLS 拉取形成反压，不丢弃记录。
+- 溢写分段是创建后即删除的临时文件（进程退出后不残留）；写满一个分段后把它的页从进程
+  RSS 中释放，由内核按需回写。溢写只用于缓解内存压力，不做持久化：未确认的记录在重启后由
+  SLS 检查点重新投递。
+- 确认句柄 (ack) 始终留在内存中，只有日志内容会被溢写。
+"""
+
+import collections
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from queue import Empty, Full
+from typing import Deque, List, Optional, Tuple
+
+from . import jsoncodec, metrics
+from .log_utils import RateLimitedLogger
+from .records import as_dict, pinned_arena, record_size
+
+logger = logging.getLogger(__name__)
+limited_logger = RateLimitedLogger(logger)
+
+# --- 队列容量配置 ---
+QUEUE_MAX_RECORDS = int(os.getenv('QUEUE_MAX_RECORDS', '10000'))
+QUEUE_MAX_MEMORY_MB = float(os.getenv('QUEUE_MAX_MEMORY_MB', '256'))
+QUEUE_SPILL_DIR = os.getenv('QUEUE_SPILL_DIR', '') or tempfile.gettempdir()
+QUEUE_SPILL_MAX_MB = float(os.getenv('QUEUE_SPILL_MAX_MB', '1024'))  # 0 表示不溢写
+QUEUE_SPILL_SEGMENT_MB = float(os.getenv('QUEUE_SPILL_SEGMENT_MB', '64'))
+
+_MB = 1024 * 1024
+_ENCODE = object()  # _try_put 的返回值：需要溢写，但记录还没有在锁外序列化
+
+
+class _SpillSegment:
+    """一个 mmap 映射的临时分段文件，只追加写、顺序读。"""
+    __slots__ = ('file', 'map', 'size', 'write_pos', 'pending', 'sealed')
+
+    def __init__(self, directory: str, size: int):
+        self.file = tempfile.TemporaryFile(dir=directory, prefix='sls-spill-')
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.size = size
+        self.write_pos = 0
+        self.pending = 0  # 已写入尚未读出的记录数
+        self.sealed = False
+
+    def append(self, data: bytes) -> int:
+        offset = self.write_pos
+        self.map[offset:offset + len(data)] = data
+        self.write_pos += len(data)
+        self.pending += 1
+        return offset
+
+    def seal(self):
+        """不再写入：把已写的页移出进程 RSS（数据保留在页缓存/磁盘上）。"""
+        self.sealed = True
+        if hasattr(self.map, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+            try:
+                self.map.madvise(mmap.MADV_DONTNEED)
+            except OSError:
+                pass
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SpillQueue:
+    """
+    线程安全的队列，接口与 queue.Queue 的 put/get/get_nowait/qsize/empty 一致。
+    元素为 (日志内容, ack)；日志内容按 records.record_size 计量。
+    """
+
+    def __init__(self, maxsize: int = QUEUE_MAX_RECORDS, max_memory_bytes: int = int(QUEUE_MAX_MEMORY_MB * _MB),
+                 spill_dir: str = QUEUE_SPILL_DIR, max_spill_bytes: int = int(QUEUE_SPILL_MAX_MB * _MB),
+                 segment_bytes: int = int(QUEUE_SPILL_SEGMENT_MB * _MB)):
+        self.maxsize = maxsize
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.segment_bytes = max(1, segment_bytes)
+        self._memory: Deque[Tuple[tuple, int, object]] = collections.deque()  # (元素, 计量字节, 拉取结果)
+        self._spilled: Deque[Tuple[_SpillSegment, int, int, object]] = collections.deque()
+        self._segment: Optional[_SpillSegment] = None
+        self.memory_bytes = 0
+        self.spill_bytes = 0
+        self.memory_high_water = 0
+        self.spill_high_water = 0
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        if self.max_spill_bytes > 0:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    # --- 写入 ---
+
+    def _fits_memory(self, size: int) -> bool:
+        if not self._memory:
+            return True  # 空队列总能放下一条，避免超大记录永久阻塞
+        # size 为 0：所属拉取结果已经计入，放入内存不再增加占用
+        return len(self._memory) < self.maxsize and (size == 0 or self.memory_bytes + size <= self.max_memory_bytes)
+
+    def _try_put(self, item: tuple, size: int, data: Optional[bytes]):
+        """放入内存或溢写区并返回 True，放不下返回 False；需要溢写但 data 为 None 时返回 _ENCODE。"""
+        arena = pinned_arena(item[0])
+        charge = size if arena is None else (0 if arena.queued else arena.nbytes)
+        if not self._spilled and self._fits_memory(charge):
+            if arena is not None:
+                arena.queued += 1
+                self._memory.append((item, 0, arena))
+            else:
+                self._memory.append((item, size, None))
+            self.memory_bytes += charge
+            self.memory_high_water = max(self.memory_high_water, self.memory_bytes)
+            return True
+        if self.max_spill_bytes <= 0 or self.spill_bytes + (size if data is None else len(data)) > self.max_spill_bytes:
+            return False  # 编码前按估算大小判断，避免溢写区已满时反复编码
+        if data is None:
+            return _ENCODE
+            return False
+        self._spill(item, data)
+        return True
+
+    def _spill(self, item: tuple, data: bytes):
+        segment = self._segment
+        if segment is None or segment.write_pos + len(data) > segment.size:
+            if segment is not None:
+                segment.seal()
+                if not segment.pending:
+                    segment.close()
+            segment = self._segment = _SpillSegment(self.spill_dir, max(self.segment_bytes, len(data)))
+        offset = segment.append(data)
+        self._spilled.append((segment, offset, len(data), item[1]))
+        self.spill_bytes += len(data)
+        self.spill_high_water = max(self.spill_high_water, self.spill_bytes)
+        metrics.QUEUE_SPILLED_RECORDS.inc()
+        if len(self._spilled) == 1:
+            limited_logger.warning("spill_start", f"💽 队列内存已达上限 ({self.memory_bytes / _MB:.1f}MB)，后续记录溢写到 {self.spill_dir}")
+
+    def put(self, item: tuple, block: bool = True, timeout: float = None):
+        size = record_size(item[0])
+        data = None  # 溢写时的序列化结果
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._not_full:
+            while True:
+                placed = self._try_put(item, size, data)
+                if placed is _ENCODE:
+                    # 物化和序列化在锁外进行，不阻塞其他生产者和取数的线程；重新加锁后再判断放在哪里
+                    self._mutex.release()
+                    try:
+                        data = jsoncodec.dumpb(as_dict(item[0]))
+                    finally:
+                        self._mutex.acquire()
+                    continue
+                if placed:
+                    break
+                if not block:
+                    raise Full
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Full
+                self._not_full.wait(remaining)
+            self._not_empty.notify()
+
+    def put_nowait(self, item: tuple):
+        self.put(item, block=False)
+
+    # --- 读取 ---
+
+    def _pop(self) -> tuple:
+        if self._memory:
+            item, size, arena = self._memory.popleft()
+            if arena is not None:
+                arena.queued -= 1
+                if not arena.queued:
+                    size = arena.nbytes  # 这次拉取的最后一条视图离开队列内存
+            self.memory_bytes -= size
+            return item
+        segment, offset, length, ack = self._spilled.popleft()
+        data = segment.map[offset:offset + length]
+        segment.pending -= 1
+        if segment.sealed and not segment.pending:
+            segment.close()
+        self.spill_bytes -= length
+        if not self._spilled:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            self.spill_bytes = 0
+            limited_logger.log(logging.INFO, "spill_drained", "💽 溢写区已排空，队列恢复为纯内存模式")
+        return data, ack
+
+    def _decode(self, entry: tuple) -> tuple:
+        record, ack = entry
+        if type(record) is bytes:  # 溢写的记录在锁外解码
+            record = jsoncodec.loads(record)
+        return record, ack
+
+    def get(self, block: bool = True, timeout: float = None) -> tuple:
+        with self._not_empty:
+            if not block:
+                if not (self._memory or self._spilled):
+                    raise Empty
+            elif not self._not_empty.wait_for(lambda: self._memory or self._spilled, timeout):
+                raise Empty
+            entry = self._pop()
+            self._not_full.notify_all()
+        return self._decode(entry)
+
+    def get_nowait(self) -> tuple:
+        return self.get(block=False)
+
+    def get_batch(self, max_items: int, timeout: float, max_wait: float) -> List[tuple]:
+        """等待最多 timeout 秒取到第一条，再在 max_wait 秒内尽量攒够 max_items 条（超时后仍取走已就绪的记录）。"""
+        try:
+            batch = [self.get(timeout=timeout)]
+        except Empty:
+            return []
+        deadline = time.monotonic() + max_wait
+        while len(batch) < max_items:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.get(block=remaining > 0, timeout=max(0.0, remaining)))
+            except Empty:
+                break
+        return batch
+
+    # --- 状态 ---
+
+    def qsize(self) -> int:
+        return len(self._memory) + len(self._spilled)
+
+    def empty(self) -> bool:
+        return not (self._memory or self._spilled)
+
+    def watch(self):
+        """把队列深度、内存/溢写字节数及其高水位绑定为抓取时取值的指标。"""
+        metrics.QUEUE_DEPTH.set_function(self.qsize)
+        metrics.QUEUE_BYTES.labels('memory').set_function(lambda: self.memory_bytes)
+        metrics.QUEUE_BYTES.labels('spill').set_function(lambda: self.spill_bytes)
+        metrics.QUEUE_BYTES_HIGH_WATER.labels('memory').set_function(lambda: self.memory_high_water)
+        metrics.QUEUE_BYTES_HIGH_WATER.labels('spill').set_function(lambda: self.spill_high_water)
+
+    def close(self):
+        with self._mutex:
+            segments = {entry[0] for entry in self._spilled}
+            if self._segment is not None:
+                segments.add(self._segment)
+            for segment in segments:
+                segment.close()
+            self._spilled.clear()
+            self._segment = None
+            self.spill_bytes = 0
@@ -0,0 +1,57 @@
+# sls_processor/transform_pool.py
+
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Mapping
+
+from . import jsoncodec
+from .processor import LangfuseDataProcessor
+from .records import as_dict
+
+logger = logging.getLogger(__name__)
+
+
+def _transform_chunk(blob: bytes) -> bytes:
+    """
+    子进程中执行：输入为一组 log_contents 的紧凑JSON，输出为对应的发送载荷JSON。
+    进程间只传递字节串，避免逐个 pickle 嵌套字典。
+    """
+    records = jsoncodec.loads(blob)
+    payloads = [LangfuseDataProcessor.convert_to_langfuse_format(record) for record in records]
+    return jsoncodec.dumpb(payloads)
+
+
+class TransformPool:
+    """
+    多进程转换阶段：把一批原始日志切成块分发给工作进程，按输入顺序返回载荷，
+    因此同一 trace_id 的记录顺序保持不变。进程池不可用时退回当前线程内转换。
+    """
+
+    def __init__(self, workers: int, chunk_size: int = 25):
+        self.workers = workers
+        self.chunk_size = max(1, chunk_size)
+        # spawn 启动：发送进程中已有拉取、发送、日志和指标等线程，fork 可能把它们持有的锁带进子进程造成死锁
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self._broken = False
+        logger.info(f"🚀 多进程转换池已启动: {workers} 个进程, 每块 {self.chunk_size} 条")
+
+    def transform(self, records: List[Mapping[str, Any]]) -> List[Dict[str, Any]]:
+        if self._broken or len(records) <= 1:
+            return [LangfuseDataProcessor.convert_to_langfuse_format(record) for record in records]
+
+        chunks = [jsoncodec.dumpb([as_dict(record) for record in records[i:i + self.chunk_size]])
+                  for i in range(0, len(records), self.chunk_size)]
+        try:
+            payloads = []
+            for blob in self.executor.map(_transform_chunk, chunks):
+                payloads.extend(jsoncodec.loads(blob))
+            return payloads
+        except BrokenProcessPool as e:
+            self._broken = True
+            logger.error(f"❌ 转换进程池已损坏，退回单线程转换: {e}")
+            return [LangfuseDataProcessor.convert_to_langfuse_format(record) for record in records]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)